@@ -6,6 +6,7 @@ import numpy as np
 # own packages
 from deeptools.utilities import *
 from deeptools import bamHandler
+from deeptools import coverageIndex
 from deeptools.countReadsPerBin import getNumReadsPerBin
 
 debug = 0
@@ -14,7 +15,7 @@ debug = 0
 def estimateScaleFactor(bamFilesList, binLength, numberOfSamples,
                         defaultFragmentLength, normalizationLength,
                         avg_method='median', numberOfProcessors=1,
-                        verbose=False, chrsToSkip=[]):
+                        verbose=False, chrsToSkip=[], blackListFileName=None):
     r"""
     Subdivides the genome into chunks to be analyzed in parallel
     using several processors. The code handles the creation of
@@ -39,6 +40,9 @@ def estimateScaleFactor(bamFilesList, binLength, numberOfSamples,
          'chrsToSkip', name of the chromosomes to be excluded from the
                        scale stimation. Usually the chrX is included.
 
+         'blackListFileName', BED file with the regions whose bins are
+                       not sampled.
+
     For example, to test about 1 million regions of length 500 bp,
     the binLength will be 500 and the numberOfSamples is going
     to be the size of the genome divided by the 1 million. This number
@@ -58,7 +62,10 @@ def estimateScaleFactor(bamFilesList, binLength, numberOfSamples,
         raise NameError("SES scale factors are only defined for 2 files")
 
     bamFilesHandlers = [bamHandler.openBam(x) for x in bamFilesList]
-    mappedReads = [x.mapped for x in bamFilesHandlers]
+    # with a coverage index, the reads of the bam files added to it
+    options = coverageIndex.getIndexOptions(defaultFragmentLength)
+    mappedReads = [coverageIndex.getMappedReads(x, options)
+                   for x in bamFilesHandlers]
 
     sizeFactorBasedOnMappedReads = np.array(mappedReads, dtype='float64')
 
@@ -70,7 +77,8 @@ def estimateScaleFactor(bamFilesList, binLength, numberOfSamples,
                                           defaultFragmentLength,
                                           numberOfProcessors=numberOfProcessors,
                                           verbose=verbose,
-                                          chrsToSkip=chrsToSkip)
+                                          chrsToSkip=chrsToSkip,
+                                          blackListFileName=blackListFileName)
 
     sitesSampled = len(num_reads_per_bin)
 
@@ -86,8 +94,9 @@ def estimateScaleFactor(bamFilesList, binLength, numberOfSamples,
     # using the same names as in Diaz paper
     # p refers to ChIP, q to input
 
-    p = np.sort(num_reads_per_bin[0, :]).cumsum()
-    q = np.sort(num_reads_per_bin[1, :]).cumsum()
+    # the counts are integers, their sums are normalized as floats
+    p = np.sort(num_reads_per_bin[0, :]).cumsum(dtype='float64')
+    q = np.sort(num_reads_per_bin[1, :]).cumsum(dtype='float64')
 
     # p[-1] and q[-1] are the maximun values in the  arrays.
     # both p and q are normalized by this value
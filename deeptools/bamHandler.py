@@ -1,5 +1,10 @@
 import pysam
 import tempfile, os
+import struct
+import numpy as np
+
+# size in bp of the windows of the bam linear index
+LINEAR_INDEX_WINDOW = 16384
 
 def openBam(bamFile, bamIndex=None):
     if bamIndex and bamIndex != bamFile + ".bai":
@@ -43,3 +48,174 @@ def openBam(bamFile, bamIndex=None):
         
          
     return bam
+
+
+def getLinearIndex(bamFile):
+    """
+    Reads the .bai index of a bam file and returns, for each
+    chromosome, the linear index (the virtual file offset of the first
+    read overlapping each window of 16384 bp), the virtual file offset
+    at which the chromosome reads end and the number of mapped reads.
+
+    Returns a list of tuples (offsets, endOffset, mapped) in the
+    order of the bam header, or None if the index can not be read.
+
+    >>> index = getLinearIndex("./test/test_data/test1.bam")
+    >>> offsets, endOffset, mapped = index[0]
+    >>> len(offsets), mapped
+    (1, 144)
+    """
+    try:
+        data = open(bamFile + ".bai", 'rb').read()
+    except IOError:
+        return None
+    if data[0:4] != "BAI\1":
+        return None
+
+    index = []
+    pos = 8
+    numRefs = struct.unpack('<i', data[4:8])[0]
+    for ref in range(numRefs):
+        endOffset = 0
+        mapped = 0
+        numBins = struct.unpack('<i', data[pos:pos + 4])[0]
+        pos += 4
+        for binIndex in range(numBins):
+            binId, numChunks = struct.unpack('<Ii', data[pos:pos + 8])
+            pos += 8
+            if binId == 37450:
+                # pseudo bin: the first chunk contains the file
+                # offsets of the chromosome reads and the second
+                # chunk the number of mapped and unmapped reads
+                endOffset, mapped = struct.unpack('<QQ',
+                                                  data[pos + 8: pos + 24])
+            pos += 16 * numChunks
+        numIntervals = struct.unpack('<i', data[pos:pos + 4])[0]
+        pos += 4
+        offsets = np.frombuffer(data, dtype='<u8', count=numIntervals,
+                                offset=pos)
+        pos += 8 * numIntervals
+        index.append((offsets, endOffset, mapped))
+
+    return index
+
+
+def getMappedPerChrom(bamFile):
+    """
+    Returns a dictionary with the number of mapped reads of each
+    chromosome, read from the bam index.
+
+    >>> getMappedPerChrom("./test/test_data/test1.bam")
+    {'3R': 144}
+    """
+    bam = pysam.Samfile(bamFile, 'rb')
+    index = getLinearIndex(bamFile)
+    if index is not None and len(index) == len(bam.references):
+        return dict([(chrom, int(mapped)) for chrom, (offsets, endOffset,
+                     mapped) in zip(bam.references, index)])
+    # the index is not at bamFile.bai
+    stats = [line.split("\t") for line in
+             "".join(pysam.idxstats(bamFile)).splitlines()]
+    return dict([(y[0], int(y[2])) for y in stats if y[0] != '*'])
+
+
+def getReadDensity(bamFile, chromSizes):
+    """
+    Estimates the number of reads found in each window of
+    LINEAR_INDEX_WINDOW bp of each chromosome using the linear
+    index of the bam file. The reads mapped to a chromosome are
+    distributed among the windows proportionally to the amount of
+    bam data (in bytes) found for each window.
+
+    Returns a dictionary of chromosome names containing
+    one value per window, or None if the bam index can not be read.
+
+    >>> density = getReadDensity("./test/test_data/test1.bam",
+    ... [('3R', 1500)])
+    >>> density['3R']
+    array([ 144.])
+
+    The reads of test_gap.bam are in the second and the fifth
+    windows. The empty windows in between repeat the index offset
+    of the second window.
+    >>> density = getReadDensity("./test/test_data/test_gap.bam",
+    ... [('chr1', 100000)])
+    >>> density['chr1'].round(1)
+    array([  0.,  20.,   0.,   0.,  10.,   0.,   0.])
+    """
+    bam = pysam.Samfile(bamFile, 'rb')
+    index = getLinearIndex(bamFile)
+    if index is None or len(index) != len(bam.references):
+        return None
+
+    chromIndex = dict(zip(bam.references, index))
+    density = {}
+    for chrom, size in chromSizes:
+        numWindows = (size + LINEAR_INDEX_WINDOW - 1) / LINEAR_INDEX_WINDOW
+        density[chrom] = np.zeros(numWindows)
+        if chrom not in chromIndex:
+            continue
+        offsets, endOffset, mapped = chromIndex[chrom]
+        if mapped == 0 or len(offsets) == 0:
+            continue
+        # the windows before the first read have either a zero offset
+        # or the offset of the first read, thus they are left out
+        firstRead = next(bam.fetch(chrom), None)
+        if firstRead is None:
+            continue
+        first = min(firstRead.pos / LINEAR_INDEX_WINDOW, len(offsets) - 1)
+        if first >= numWindows:
+            continue
+        offsets = offsets[first:]
+        # an empty window repeats the offset of the previous window,
+        # thus the data up to the next different offset belongs to
+        # the first window of each run of equal offsets
+        runStarts = np.flatnonzero(np.concatenate(
+            [[True], offsets[1:] != offsets[:-1]]))
+        runOffsets = np.append(offsets[runStarts],
+                               np.array([max(endOffset, offsets[-1])],
+                                        dtype='uint64'))
+        position = getCompressedPosition(bamFile, runOffsets)
+        weights = np.zeros(len(offsets))
+        weights[runStarts] = np.clip(np.diff(position), 0, None)
+        weights = weights[:numWindows - first]
+        if weights.sum() == 0:
+            weights = np.ones(len(weights))
+        density[chrom][first:first + len(weights)] = \
+            mapped * weights / weights.sum()
+
+    return density
+
+
+def getCompressedPosition(bamFile, virtualOffsets):
+    """
+    Converts bam virtual file offsets (the offset of a compressed
+    block combined with an offset inside the uncompressed block)
+    into approximate positions in the compressed file. For this,
+    the compressed and uncompressed sizes of each of the blocks
+    referred by the virtual offsets are read from the bam file.
+    """
+    virtualOffsets = np.asarray(virtualOffsets, dtype='uint64')
+    blockOffsets = (virtualOffsets >> np.uint64(16)).astype('int64')
+    inBlockOffsets = (virtualOffsets & np.uint64(0xffff)).astype('float64')
+
+    blocks = np.unique(blockOffsets)
+    ratio = np.zeros(len(blocks))
+    fh = open(bamFile, 'rb')
+    for index, blockStart in enumerate(blocks):
+        fh.seek(blockStart)
+        header = fh.read(18)
+        if len(header) < 18:
+            # end of file
+            continue
+        # the BGZF header stores the compressed block size minus 1
+        # and the last four bytes of the block the uncompressed size
+        compressedSize = struct.unpack('<H', header[16:18])[0] + 1
+        fh.seek(blockStart + compressedSize - 4)
+        uncompressedSize = struct.unpack('<I', fh.read(4))[0]
+        if uncompressedSize > 0:
+            ratio[index] = float(compressedSize) / uncompressedSize
+    fh.close()
+
+    ratio = ratio[np.searchsorted(blocks, blockOffsets)]
+    return blockOffsets + inBlockOffsets * ratio
@@ -0,0 +1,512 @@
+import itertools
+import struct
+import zlib
+import numpy as np
+
+debug = 0
+
+# The bigWig format is described in Kent et al., Bioinformatics 2010,
+# 26(17):2204. The files are written as bedGraphToBigWig writes them:
+# data blocks of bedGraph items with an R tree index, followed by
+# zoom levels, each with its own blocks of summaries and R tree.
+BIGWIG_MAGIC = 0x888FFC26
+BPT_MAGIC = 0x78CA8C91
+CIRTREE_MAGIC = 0x2468ACE0
+VERSION = 4
+# items per data block, summaries per zoom block and children
+# per index node
+ITEMS_PER_SLOT = 1024
+BLOCK_SIZE = 256
+# each zoom level summarizes the previous one in bins ZOOM_INCREMENT
+# times larger
+MAX_ZOOM_LEVELS = 10
+ZOOM_INCREMENT = 4
+# type of the data blocks holding bedGraph items
+BEDGRAPH_SECTION = 1
+
+HEADER = struct.Struct('<IHHQQQHHQQIQ')
+ZOOM_HEADER = struct.Struct('<IIQQ')
+TOTAL_SUMMARY = struct.Struct('<Qdddd')
+SECTION_HEADER = struct.Struct('<IIIIIBBH')
+BPT_HEADER = struct.Struct('<IIIIQQ')
+CIRTREE_HEADER = struct.Struct('<IIQIIIIQII')
+NODE_HEADER = struct.Struct('<BBH')
+LEAF_ITEM = struct.Struct('<IIIIQQ')
+NODE_ITEM = struct.Struct('<IIIIQ')
+
+BEDGRAPH_ITEM = np.dtype([('start', '<u4'), ('end', '<u4'),
+                          ('value', '<f4')])
+ZOOM_RECORD = np.dtype([('chromId', '<u4'), ('start', '<u4'),
+                        ('end', '<u4'), ('validCount', '<u4'),
+                        ('min', '<f4'), ('max', '<f4'),
+                        ('sum', '<f4'), ('sumSquares', '<f4')])
+
+
+class BigWigWriter(object):
+    """
+    Writes a bigWig file from the runs of bases having the same value
+    (the intervals of a bedGraph file). The runs of each chromosome
+    are given in order by addRuns, and the runs of a chromosome can
+    not follow those of another chromosome. The data blocks are
+    written as the runs arrive, thus only the runs of one block are
+    kept in memory. The zoom levels are computed by close, from the
+    data blocks written.
+
+    >>> import os, tempfile
+    >>> fileName = tempfile.NamedTemporaryFile(suffix='.bw').name
+    >>> writer = BigWigWriter(fileName, [('chr1', 1000), ('chr2', 500)])
+    >>> writer.addRuns('chr2', [0, 100], [100, 150], [1.5, 2])
+    >>> writer.addRuns('chr1', [10], [20], [3])
+    >>> writer.close()
+    >>> from bx.bbi.bigwig_file import BigWigFile
+    >>> bigWig = BigWigFile(open(fileName))
+    >>> list(bigWig.get_as_array('chr2', 98, 102))
+    [1.5, 1.5, 2.0, 2.0]
+    >>> bigWig.get('chr1', 0, 1000)
+    [(10, 20, 3.0)]
+    >>> list(bigWig.summarize('chr2', 0, 200, 1).sum_data)
+    [250.0]
+    >>> getChromSizes(fileName)
+    [('chr2', 500), ('chr1', 1000)]
+    >>> os.remove(fileName)
+    """
+
+    def __init__(self, fileName, chromSizes, compress=True):
+        self.handle = open(fileName, 'w+b')
+        self.chromSizes = list(chromSizes)
+        self.sizes = dict(self.chromSizes)
+        self.compress = compress
+        # the chromosomes are numbered in the order of their runs, such
+        # that the blocks are sorted by chromosome number in the index
+        self.chromIds = {}
+        self.chrom = None
+        self.lastEnd = 0
+        self.pending = np.zeros(0, dtype=BEDGRAPH_ITEM)
+        # (chromId, start, end, offset, size) of each data block
+        self.dataBlocks = []
+        self.maxBlockSize = 0
+        self.runCount = 0
+        self.basesCovered = 0
+        self.minVal = np.inf
+        self.maxVal = -np.inf
+        self.sumData = 0.0
+        self.sumSquares = 0.0
+
+        # the header, zoom headers and total summary are written at
+        # the end, when they are known
+        self.handle.write('\0' * (HEADER.size +
+                                  MAX_ZOOM_LEVELS * ZOOM_HEADER.size +
+                                  TOTAL_SUMMARY.size))
+        self.dataOffset = self.handle.tell()
+        # number of data blocks
+        self.handle.write(struct.pack('<Q', 0))
+
+    def addRuns(self, chrom, starts, ends, values):
+        """
+        Adds the runs of chrom from starts[i] to ends[i] having
+        values[i]. The runs follow the runs previously added.
+        """
+        if chrom not in self.sizes:
+            raise NameError("chromosome {} not in the chromosome "
+                            "sizes of the bigWig file".format(chrom))
+        if chrom != self.chrom:
+            if chrom in self.chromIds:
+                raise NameError("the runs of chromosome {} are not "
+                                "together".format(chrom))
+            self.writeBlocks(self.pending)
+            self.pending = self.pending[:0]
+            self.chrom = chrom
+            self.chromIds[chrom] = len(self.chromIds)
+            self.lastEnd = 0
+        if len(starts) == 0:
+            return
+
+        starts = np.asarray(starts, dtype='int64')
+        ends = np.asarray(ends, dtype='int64')
+        if starts[0] < self.lastEnd or np.any(ends <= starts) or \
+                np.any(starts[1:] < ends[:-1]) or \
+                ends[-1] > self.sizes[chrom]:
+            raise NameError("the runs of chromosome {} overlap, are not "
+                            "sorted or go past its end".format(chrom))
+        self.lastEnd = ends[-1]
+
+        items = np.zeros(len(starts), dtype=BEDGRAPH_ITEM)
+        items['start'] = starts
+        items['end'] = ends
+        items['value'] = values
+        # the statistics of the values as they are stored
+        values = items['value'].astype('float64')
+        lengths = ends - starts
+        self.runCount += len(items)
+        self.basesCovered += int(lengths.sum())
+        self.minVal = min(self.minVal, values.min())
+        self.maxVal = max(self.maxVal, values.max())
+        self.sumData += float((values * lengths).sum())
+        self.sumSquares += float((values * values * lengths).sum())
+
+        self.pending = np.concatenate([self.pending, items])
+        fullBlocks = len(self.pending) - len(self.pending) % ITEMS_PER_SLOT
+        self.writeBlocks(self.pending[:fullBlocks])
+        self.pending = self.pending[fullBlocks:]
+
+    def writeBlocks(self, items):
+        """
+        Writes the items of the current chromosome into data blocks.
+        """
+        chromId = self.chromIds.get(self.chrom)
+        for first in range(0, len(items), ITEMS_PER_SLOT):
+            block = items[first:first + ITEMS_PER_SLOT]
+            start, end = int(block['start'][0]), int(block['end'][-1])
+            header = SECTION_HEADER.pack(chromId, start, end, 0, 0,
+                                         BEDGRAPH_SECTION, 0, len(block))
+            self.dataBlocks.append(
+                (chromId, start, end) + self.writeBlock(header +
+                                                        block.tostring()))
+
+    def writeBlock(self, data):
+        """
+        Writes a (compressed) block and returns its offset and size.
+        """
+        self.maxBlockSize = max(self.maxBlockSize, len(data))
+        if self.compress:
+            data = zlib.compress(data)
+        offset = self.handle.tell()
+        self.handle.write(data)
+        return offset, len(data)
+
+    def readBlocks(self, blocks):
+        """
+        Returns the uncompressed content of the blocks.
+        """
+        content = []
+        for offset, size in blocks:
+            self.handle.seek(offset)
+            data = self.handle.read(size)
+            content.append(zlib.decompress(data) if self.compress else data)
+        self.handle.seek(0, 2)
+        return content
+
+    def close(self):
+        self.writeBlocks(self.pending)
+        self.pending = self.pending[:0]
+        # the chromosomes without runs are numbered after the others
+        for chrom, size in self.chromSizes:
+            if chrom not in self.chromIds:
+                self.chromIds[chrom] = len(self.chromIds)
+
+        handle = self.handle
+        handle.seek(self.dataOffset)
+        handle.write(struct.pack('<Q', len(self.dataBlocks)))
+        handle.seek(0, 2)
+        indexOffset = handle.tell()
+        writeIndex(handle, self.dataBlocks, indexOffset)
+
+        zoomLevels = self.writeZoomLevels()
+
+        chromTreeOffset = handle.tell()
+        sizes = [(chrom, self.chromIds[chrom], size)
+                 for chrom, size in self.chromSizes]
+        writeChromTree(handle, sizes)
+
+        handle.seek(0)
+        handle.write(HEADER.pack(
+            BIGWIG_MAGIC, VERSION, len(zoomLevels), chromTreeOffset,
+            self.dataOffset, indexOffset, 0, 0, 0,
+            HEADER.size + MAX_ZOOM_LEVELS * ZOOM_HEADER.size,
+            self.maxBlockSize if self.compress else 0, 0))
+        for reduction, dataOffset, zoomIndexOffset in zoomLevels:
+            handle.write(ZOOM_HEADER.pack(reduction, 0, dataOffset,
+                                          zoomIndexOffset))
+        handle.seek(HEADER.size + MAX_ZOOM_LEVELS * ZOOM_HEADER.size)
+        if self.runCount:
+            handle.write(TOTAL_SUMMARY.pack(
+                self.basesCovered, self.minVal, self.maxVal,
+                self.sumData, self.sumSquares))
+        handle.close()
+
+    def writeZoomLevels(self):
+        """
+        Writes the zoom levels and returns the reduction, data offset
+        and index offset of each one. The first zoom level summarizes
+        the runs in bins of about four times their mean length, and
+        each of the next levels summarizes the bins of the previous
+        one. No more levels are written once the number of bins does
+        not halve.
+        """
+        if self.runCount == 0:
+            return []
+        handle = self.handle
+        chromSizes = dict([(self.chromIds[chrom], size)
+                           for chrom, size in self.chromSizes])
+        reduction = ZOOM_INCREMENT * max(
+            self.basesCovered / self.runCount, 10)
+        zoomLevels = []
+        blocks = self.dataBlocks
+        previousCount = self.runCount
+        while len(zoomLevels) < MAX_ZOOM_LEVELS and reduction < 2 ** 32:
+            dataOffset = handle.tell()
+            # number of summaries
+            handle.write(struct.pack('<I', 0))
+            zoomBlocks = []
+            count = 0
+            for chromId, chromBlocks in itertools.groupby(
+                    blocks, lambda block: block[0]):
+                content = self.readBlocks([block[3:] for block in
+                                           chromBlocks])
+                if zoomLevels:
+                    records = np.frombuffer("".join(content),
+                                            dtype=ZOOM_RECORD)
+                    records = reduceSummaries(records, reduction,
+                                              chromSizes[chromId])
+                else:
+                    items = np.frombuffer(
+                        "".join([data[SECTION_HEADER.size:]
+                                 for data in content]),
+                        dtype=BEDGRAPH_ITEM)
+                    records = summarizeRuns(items, reduction,
+                                            chromSizes[chromId])
+                records['chromId'] = chromId
+                count += len(records)
+                for first in range(0, len(records), ITEMS_PER_SLOT):
+                    block = records[first:first + ITEMS_PER_SLOT]
+                    zoomBlocks.append(
+                        (chromId, int(block['start'][0]),
+                         int(block['end'][-1])) +
+                        self.writeBlock(block.tostring()))
+
+            if zoomLevels and count * 2 > previousCount:
+                handle.seek(dataOffset)
+                handle.truncate()
+                break
+            handle.seek(dataOffset)
+            handle.write(struct.pack('<I', count))
+            handle.seek(0, 2)
+            indexOffset = handle.tell()
+            writeIndex(handle, zoomBlocks, indexOffset)
+            zoomLevels.append((reduction, dataOffset, indexOffset))
+            blocks = zoomBlocks
+            previousCount = count
+            reduction *= ZOOM_INCREMENT
+        return zoomLevels
+
+
+def summarizeRuns(items, reduction, chromSize):
+    """
+    Returns the summaries (zoom records) of the bedGraph items of a
+    chromosome in the bins of reduction bases that have items.
+
+    >>> items = np.array([(0, 10, 1.0), (10, 30, 2.0)],
+    ... dtype=BEDGRAPH_ITEM)
+    >>> records = summarizeRuns(items, 20, 25)
+    >>> zip(records['start'], records['end'], records['validCount'],
+    ...     records['sum'])
+    [(0, 20, 20, 30.0), (20, 25, 10, 20.0)]
+    """
+    starts = items['start'].astype('int64')
+    ends = items['end'].astype('int64')
+    values = items['value'].astype('float64')
+    # the runs are cut at the bin boundaries
+    firstBin = starts / reduction
+    pieces = (ends - 1) / reduction - firstBin + 1
+    run = np.repeat(np.arange(len(items)), pieces)
+    binIndex = firstBin[run] + np.arange(len(run)) - \
+        np.repeat(np.cumsum(pieces) - pieces, pieces)
+    bases = np.minimum(ends[run], (binIndex + 1) * reduction) - \
+        np.maximum(starts[run], binIndex * reduction)
+    values = values[run]
+
+    binStart = np.flatnonzero(np.r_[True, binIndex[1:] != binIndex[:-1]])
+    records = np.zeros(len(binStart), dtype=ZOOM_RECORD)
+    records['start'] = binIndex[binStart] * reduction
+    records['end'] = np.minimum(records['start'].astype('int64') +
+                                reduction, chromSize)
+    records['validCount'] = np.add.reduceat(bases, binStart)
+    records['min'] = np.minimum.reduceat(values, binStart)
+    records['max'] = np.maximum.reduceat(values, binStart)
+    records['sum'] = np.add.reduceat(values * bases, binStart)
+    records['sumSquares'] = np.add.reduceat(values * values * bases,
+                                            binStart)
+    return records
+
+
+def reduceSummaries(records, reduction, chromSize):
+    """
+    Returns the summaries of the zoom records of a chromosome in the
+    bins of reduction bases, which must be a multiple of the bins of
+    the records.
+    """
+    binIndex = records['start'].astype('int64') / reduction
+    binStart = np.flatnonzero(np.r_[True, binIndex[1:] != binIndex[:-1]])
+    reduced = np.zeros(len(binStart), dtype=ZOOM_RECORD)
+    reduced['start'] = binIndex[binStart] * reduction
+    reduced['end'] = np.minimum(reduced['start'].astype('int64') +
+                                reduction, chromSize)
+    reduced['validCount'] = np.add.reduceat(
+        records['validCount'].astype('int64'), binStart)
+    reduced['min'] = np.minimum.reduceat(records['min'], binStart)
+    reduced['max'] = np.maximum.reduceat(records['max'], binStart)
+    for field in ('sum', 'sumSquares'):
+        reduced[field] = np.add.reduceat(
+            records[field].astype('float64'), binStart)
+    return reduced
+
+
+def writeIndex(handle, blocks, endFileOffset):
+    """
+    Writes, at the current position of handle, the R tree that
+    indexes the blocks, given as (chromId, start, end, offset, size)
+    sorted by chromosome and position. The nodes are written from
+    the root down.
+    """
+    # the nodes of each level, from the leaves up. Each node is
+    # given by its first and last child (or block) in the level below
+    levels = []
+    count = len(blocks)
+    while True:
+        levels.append([(first, min(first + BLOCK_SIZE, count))
+                       for first in range(0, max(count, 1), BLOCK_SIZE)])
+        count = len(levels[-1])
+        if count == 1:
+            break
+    levels.reverse()
+
+    # the chromosome range of the nodes of each level
+    ranges = []
+    children = [block[:3] for block in blocks]
+    for level in reversed(levels):
+        children = [(children[first][0], children[first][1],
+                     children[last - 1][0], children[last - 1][2])
+                    if last > first else (0, 0, 0, 0)
+                    for first, last in level]
+        ranges.insert(0, children)
+        children = [(startChrom, start, end) for startChrom, start,
+                    endChrom, end in children]
+
+    startChrom, start, endChrom, end = ranges[0][0]
+    handle.write(CIRTREE_HEADER.pack(
+        CIRTREE_MAGIC, BLOCK_SIZE, len(blocks), startChrom, start,
+        endChrom, end, endFileOffset, ITEMS_PER_SLOT, 0))
+
+    offset = handle.tell()
+    for levelIndex, level in enumerate(levels):
+        isLeaf = levelIndex == len(levels) - 1
+        itemSize = LEAF_ITEM.size if isLeaf else NODE_ITEM.size
+        # the nodes of the next level follow those of this level
+        offset += sum([NODE_HEADER.size + (last - first) * itemSize
+                       for first, last in level])
+        childOffset = offset
+        for first, last in level:
+            data = [NODE_HEADER.pack(int(isLeaf), 0, last - first)]
+            for child in range(first, last):
+                if isLeaf:
+                    chromId, start, end, blockOffset, size = blocks[child]
+                    data.append(LEAF_ITEM.pack(chromId, start, chromId, end,
+                                               blockOffset, size))
+                else:
+                    startChrom, start, endChrom, end = \
+                        ranges[levelIndex + 1][child]
+                    data.append(NODE_ITEM.pack(startChrom, start, endChrom,
+                                               end, childOffset))
+                    nextLevel = levels[levelIndex + 1][child]
+                    childOffset += NODE_HEADER.size + \
+                        (nextLevel[1] - nextLevel[0]) * (
+                            LEAF_ITEM.size if levelIndex + 2 == len(levels)
+                            else NODE_ITEM.size)
+            handle.write("".join(data))
+
+
+def writeChromTree(handle, chroms):
+    """
+    Writes, at the current position of handle, the B+ tree of the
+    chromosomes, given as (name, chromId, size). All the chromosomes
+    are kept in one leaf node, sorted by name.
+    """
+    keySize = max([len(chrom) for chrom, chromId, size in chroms] + [1])
+    handle.write(BPT_HEADER.pack(BPT_MAGIC, max(len(chroms), 1), keySize,
+                                 8, len(chroms), 0))
+    data = [NODE_HEADER.pack(1, 0, len(chroms))]
+    for chrom, chromId, size in sorted(chroms):
+        data.append(chrom.ljust(keySize, '\0') +
+                    struct.pack('<II', chromId, size))
+    handle.write("".join(data))
+
+
+def getChromSizes(fileName):
+    """
+    Returns the (name, size) of the chromosomes of a bigWig file, in
+    the order of their ids, as read from its header and chromosome
+    B+ tree.
+
+    >>> import os
+    >>> getChromSizes(os.path.join(os.path.dirname(__file__), 'test',
+    ...                            'test_data', 'test1.bw.bw'))
+    [('3R', 1500)]
+    """
+    handle = open(fileName, 'rb')
+    header = handle.read(HEADER.size)
+    # the files written on big endian machines are read as well
+    for byteOrder in '<>':
+        if len(header) == HEADER.size and struct.unpack(
+                byteOrder + 'I', header[:4])[0] == BIGWIG_MAGIC:
+            break
+    else:
+        raise NameError("{} is not a bigWig file".format(fileName))
+
+    def unpack(structure, data):
+        return struct.unpack(byteOrder + structure.format[1:], data)
+
+    chromTreeOffset = unpack(HEADER, header)[3]
+    handle.seek(chromTreeOffset)
+    magic, blockSize, keySize, valSize, itemCount, reserved = \
+        unpack(BPT_HEADER, handle.read(BPT_HEADER.size))
+    if magic != BPT_MAGIC:
+        raise NameError("the chromosome tree of {} is "
+                        "corrupt".format(fileName))
+
+    chroms = []
+    nodes = [handle.tell()]
+    while nodes:
+        handle.seek(nodes.pop())
+        isLeaf, reserved, count = unpack(NODE_HEADER,
+                                         handle.read(NODE_HEADER.size))
+        itemSize = keySize + (valSize if isLeaf else 8)
+        data = handle.read(count * itemSize)
+        for item in range(count):
+            itemData = data[item * itemSize:(item + 1) * itemSize]
+            if isLeaf:
+                chromId, size = struct.unpack(
+                    byteOrder + 'II', itemData[keySize:keySize + 8])
+                chroms.append((chromId, itemData[:keySize].rstrip('\0'),
+                               size))
+            else:
+                nodes.append(struct.unpack(byteOrder + 'Q',
+                                           itemData[keySize:])[0])
+    handle.close()
+    return [(chrom, size) for chromId, chrom, size in sorted(chroms)]
+
+
+def readBedGraph(handle, linesPerBatch=1000000):
+    """
+    Yields the (chrom, starts, ends, values) of the consecutive lines
+    of a bedGraph file that have the same chromosome, reading up to
+    linesPerBatch lines at once.
+
+    >>> import StringIO
+    >>> bedGraph = StringIO.StringIO("chr1\\t0\\t10\\t1.5\\n"
+    ... "chr1\\t10\\t20\\t2\\nchr2\\t5\\t8\\t0.5\\n")
+    >>> [(chrom, list(starts), list(ends), list(values))
+    ...  for chrom, starts, ends, values in readBedGraph(bedGraph)]
+    [('chr1', [0, 10], [10, 20], [1.5, 2.0]), ('chr2', [5], [8], [0.5])]
+    """
+    while True:
+        lines = list(itertools.islice(handle, linesPerBatch))
+        if not lines:
+            return
+        fields = np.array("".join(lines).split()).reshape(-1, 4)
+        chroms = fields[:, 0]
+        boundaries = [0] + list(np.flatnonzero(chroms[1:] != chroms[:-1])
+                                + 1) + [len(chroms)]
+        for first, last in zip(boundaries[:-1], boundaries[1:]):
+            yield (chroms[first], fields[first:last, 1].astype('int64'),
+                   fields[first:last, 2].astype('int64'),
+                   fields[first:last, 3].astype('float64'))
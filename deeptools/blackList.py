@@ -0,0 +1,129 @@
+import numpy as np
+
+# own modules
+import mapReduce
+
+
+class BlackList(object):
+    """
+    Regions of the genome that are excluded from the analyses, for
+    example the ENCODE blacklist, read from a BED file. The intervals
+    of each chromosome are merged and kept as sorted arrays of starts
+    and ends, such that the positions, bins or chunks that overlap
+    them are found with numpy.searchsorted instead of one interval
+    at a time.
+
+    >>> blackList = BlackList([('chr1', 100, 200), ('chr1', 150, 300),
+    ...                        ('chr1', 300, 350), ('chr1', 500, 600)])
+    >>> blackList.starts['chr1'], blackList.ends['chr1']
+    (array([100, 500]), array([350, 600]))
+    """
+
+    def __init__(self, fileName):
+        """
+        fileName can also be a list of (chrom, start, end) intervals.
+        """
+        if isinstance(fileName, basestring):
+            regions = mapReduce.getBedRegions(fileName)
+        else:
+            regions = fileName
+
+        chromIntervals = {}
+        for chrom, start, end in regions:
+            if start < end:
+                chromIntervals.setdefault(chrom, []).append((start, end))
+
+        self.starts = {}
+        self.ends = {}
+        for chrom, intervals in chromIntervals.iteritems():
+            intervals = np.array(sorted(intervals), dtype='int64')
+            starts, ends = intervals[:, 0], intervals[:, 1]
+            # an interval that starts after the end of all the previous
+            # ones begins a new merged interval
+            maxEnds = np.maximum.accumulate(ends)
+            first = np.flatnonzero(np.r_[True, starts[1:] > maxEnds[:-1]])
+            last = np.r_[first[1:] - 1, len(starts) - 1]
+            self.starts[chrom] = starts[first]
+            self.ends[chrom] = maxEnds[last]
+
+    def maskBins(self, chrom, binStarts, binEnds):
+        """
+        Returns a boolean array that is True for the bins, given by
+        the arrays binStarts and binEnds, that overlap the blacklist.
+
+        >>> blackList = BlackList([('chr1', 100, 200), ('chr1', 500, 600)])
+        >>> blackList.maskBins('chr1', np.arange(0, 700, 100),
+        ...                    np.arange(50, 750, 100))
+        array([False,  True, False, False, False,  True, False], dtype=bool)
+        >>> blackList.maskBins('chr2', np.array([0]), np.array([50]))
+        array([False], dtype=bool)
+        """
+        binStarts = np.asarray(binStarts)
+        if chrom not in self.starts:
+            return np.zeros(len(binStarts), dtype=bool)
+        starts, ends = self.starts[chrom], self.ends[chrom]
+        # first interval ending after the start of each bin
+        index = np.searchsorted(ends, binStarts, side='right')
+        inside = index < len(starts)
+        masked = np.zeros(len(binStarts), dtype=bool)
+        masked[inside] = starts[index[inside]] < np.asarray(binEnds)[inside]
+        return masked
+
+    def maskPositions(self, chrom, positions):
+        """
+        Returns a boolean array that is True for the positions that
+        are in the blacklist.
+
+        >>> BlackList([('chr1', 100, 200)]).maskPositions(
+        ...     'chr1', np.array([99, 100, 199, 200]))
+        array([False,  True,  True, False], dtype=bool)
+        """
+        positions = np.asarray(positions)
+        return self.maskBins(chrom, positions, positions + 1)
+
+    def covers(self, chrom, start, end):
+        """
+        Returns True if the whole region is in the blacklist.
+
+        >>> blackList = BlackList([('chr1', 100, 200), ('chr1', 200, 300)])
+        >>> blackList.covers('chr1', 150, 300), blackList.covers('chr1', 0, 150)
+        (True, False)
+        """
+        if chrom not in self.starts:
+            return False
+        starts, ends = self.starts[chrom], self.ends[chrom]
+        index = np.searchsorted(ends, start, side='right')
+        return bool(index < len(starts) and starts[index] <= start and
+                    ends[index] >= end)
+
+    def getUnmaskedRegions(self, chrom, start, end, tileSize=1):
+        """
+        Returns the (start, end) parts of the region that do not
+        overlap the blacklist. The region is divided into tiles of
+        tileSize, starting at start, and the tiles that overlap the
+        blacklist are excluded as a whole.
+
+        >>> blackList = BlackList([('chr1', 120, 130), ('chr1', 500, 600)])
+        >>> blackList.getUnmaskedRegions('chr1', 0, 1000)
+        [(0, 120), (130, 500), (600, 1000)]
+        >>> blackList.getUnmaskedRegions('chr1', 0, 550, tileSize=50)
+        [(0, 100), (150, 500)]
+        >>> blackList.getUnmaskedRegions('chr2', 0, 550)
+        [(0, 550)]
+        """
+        if chrom not in self.starts:
+            return [(start, end)]
+        starts, ends = self.starts[chrom], self.ends[chrom]
+        first = np.searchsorted(ends, start, side='right')
+        last = np.searchsorted(starts, end, side='left')
+        # the blacklisted intervals are extended to the tiles
+        # that they overlap
+        maskStarts = start + \
+            (np.maximum(starts[first:last], start) - start) // tileSize * \
+            tileSize
+        maskEnds = np.minimum(
+            start - (start - ends[first:last]) // tileSize * tileSize, end)
+        partStarts = np.r_[start, maskEnds]
+        partEnds = np.r_[maskStarts, end]
+        keep = partStarts < partEnds
+        return zip(partStarts[keep].tolist(), partEnds[keep].tolist())
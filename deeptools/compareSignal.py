@@ -56,8 +56,9 @@ NOTE: retains duplicate BED values (=same chrom, chromStart values)
 
 def computeLambda(tileCoverage, args):
     """
-    This function is called by the writeBedGraph workers for every 
-    tile in the genome that is considered
+    This function is called by the writeBedGraph workers with
+    the treatment and control coverage (rows) of the tiles
+    (columns) in the genome that are considered
     """
 
     treatmentWindowTags = tileCoverage[0]
@@ -67,20 +68,25 @@ def computeLambda(tileCoverage, args):
     controlLambda = args['controlMean'] + (treatmentExtraSignalTags * args['controlSignalRatio'])
     
     return controlLambda
+computeLambda.vectorized = True
 
 
 def computePvalue(tileCoverage, args):
     """
-    This function is called by the writeBedGraph workers for every 
-    tile in the genome that is considered
+    This function is called by the writeBedGraph workers with
+    the treatment and control coverage (rows) of the tiles
+    (columns) in the genome that are considered
+
+    >>> args = {'treatmentMean': 1, 'controlMean': 2,
+    ... 'controlSignalRatio': 0.5}
+    >>> computePvalue(np.array([[5.0, 3.0], [0.0, 2.0]]), args)
+    array([        nan,  0.37346452])
     """
 #    if tileCoverage == (0,0):
 #        return np.nan
 
     treatmentWindowTags = tileCoverage[0]
     controlWindowTags = tileCoverage[1]
-    if controlWindowTags == 0:
-        return np.nan
 
     treatmentExtraSignalTags = treatmentWindowTags - args['treatmentMean']
     
@@ -88,8 +94,10 @@ def computePvalue(tileCoverage, args):
     
     log10pvalue = -1* poisson.logcdf(controlWindowTags, controlLambda) / np.log(10)
 #    log10pvalue = -1* poisson.logsf(controlWindowTags, controlLambda) / np.log(10)
+    log10pvalue[controlWindowTags == 0] = np.nan
 
     return log10pvalue
+computePvalue.vectorized = True
 
 
 def compareSignal(bamFilesList, binLength, numberOfSamples, defaultFragmentLength, 
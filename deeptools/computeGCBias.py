@@ -0,0 +1,469 @@
+import sys
+import time
+import multiprocessing
+
+import numpy as np
+import pysam
+from bx.intervals.intersection import IntervalTree, Interval
+from bx.seq import twobit
+
+# own modules
+from utilities import getGC_content
+import config as cfg
+import fileHandles
+import mapReduce
+import perfLog
+
+debug = 1
+
+# variables read by the workers, set by the computeGCBias
+# program and sent to the workers by mapReduce
+global_vars = dict()
+
+
+def getPositionsToSample(chrom, start, end, stepSize):
+    """
+    check if the region submitted to the worker
+    overlaps with the region to take extra effort to sample.
+    If that is the case, the regions to sample array is
+    increased to match each of the positions in the extra
+    effort region sampled at the same stepSize along the interval.
+
+    If a filter out file is given, then from positions to sample
+    those regions are cleaned (see blackList.BlackList)
+    """
+    positions_to_sample = np.arange(start, end, stepSize)
+
+    if global_vars['extra_sampling_file']:
+        extra_tree = get_intervals(global_vars['extra_sampling_file'])
+    else:
+        extra_tree = None
+
+    if extra_tree:
+        orig_len = len(positions_to_sample)
+        try:
+            extra_match = extra_tree[chrom].find(start, end)
+        except KeyError:
+            extra_match = []
+
+        if len(extra_match) > 0:
+            for intval in extra_match:
+                positions_to_sample = np.append(positions_to_sample,
+                                                range(intval.start,
+                                                      intval.end, stepSize))
+        # remove duplicates
+        positions_to_sample = np.unique(np.sort(positions_to_sample))
+        if debug:
+            print "sampling increased to {} from {}".format(
+                len(positions_to_sample),
+                orig_len)
+
+    # skip regions that are filtered out
+    if global_vars['filter_out']:
+        filter_out = fileHandles.getBlackList(global_vars['filter_out'])
+        positions_to_sample = positions_to_sample[
+            ~filter_out.maskPositions(chrom, positions_to_sample)]
+    return positions_to_sample
+
+
+def countReadsPerGC_wrapper(args):
+    return countReadsPerGC_worker(*args)
+
+
+def countReadsPerGC_worker(chromNameBam,
+                           start, end, stepSize, regionSize,
+                           chrNameBamToBit, verbose=False):
+    """given a genome region defined by
+    (start, end), the GC content is quantified for
+    regions of size regionSize that are contiguous
+    """
+
+    chromNameBit = chrNameBamToBit[chromNameBam]
+    tbit = fileHandles.getTwoBit(global_vars['2bit'])
+    bam  = fileHandles.getBam(global_vars['bam'])
+    c = 1
+    sub_reads_per_gc = []
+    positions_to_sample = getPositionsToSample(chromNameBit,
+                                               start, end, stepSize)
+
+    for index in xrange(len(positions_to_sample)):
+#    for i in xrange(start, end, step):
+        i = positions_to_sample[index]
+        # stop if region extends over the chromosome end
+        if tbit[chromNameBit].size < start + regionSize:
+            break
+
+        try:
+            gc = getGC_content(tbit[chromNameBit].get(i, i + regionSize))
+        except Exception as detail:
+            if verbose:
+                print detail
+            continue
+        numberReads = bam.count(chromNameBam, i, i + regionSize)
+        sub_reads_per_gc.append((numberReads, gc))
+        c += 1
+
+    return sub_reads_per_gc
+
+
+def tabulateGCcontent_wrapper(args):
+    return tabulateGCcontent_worker(*args)
+
+
+def tabulateGCcontent_worker(chromNameBam, start, end, stepSize,
+                             fragmentLength,
+                             chrNameBamToBit, verbose=False):
+    r""" given genome regions, the GC content of the genome is tabulated for
+    fragments of length 'fragmentLength' each 'stepSize' positions.
+
+    >>> test = Tester()
+    >>> args = test.testTabulateGCcontentWorker()
+    >>> N_gc, F_gc = tabulateGCcontent_worker(*args)
+
+    The forward read positions are:
+    [1,  4,  10, 10, 16, 18]
+    which correspond to a GC of
+    [1,  1,  1,  1,  2,  1]
+
+    The evaluated position are
+    [0,  2,  4,  6,  8, 10, 12, 14, 16, 18]
+    the corresponding GC is
+    [2,  1,  1,  2,  2,  1,  2,  3,  2,  1]
+
+    >>> print N_gc
+    [0 4 5 1]
+    >>> print F_gc
+    [0 4 1 0]
+    >>> test.set_filter_out_file()
+    >>> chrNameBam2bit =  {'2L': 'chr2L'}
+
+    Test for the filter out option
+    >>> N_gc, F_gc = tabulateGCcontent_worker('2L', 0, 20, 2,
+    ... {'median': 3}, chrNameBam2bit)
+    >>> test.unset_filter_out_file()
+
+    The evaluated positions are
+    [ 0  2  8 10 12 14 16 18]
+    >>> print N_gc
+    [0 3 4 1]
+    >>> print F_gc
+    [0 3 1 0]
+
+    Test for extra_sampling option
+    >>> test.set_extra_sampling_file()
+    >>> chrNameBam2bit =  {'2L': 'chr2L'}
+    >>> res = tabulateGCcontent_worker('2L', 0, 20, 2,
+    ... {'median': 3}, chrNameBam2bit)
+
+    The new positions evaluated are
+    [0, 1, 2, 3, 4, 6, 8, 10, 12, 14, 16, 18]
+    and the GC is
+    [2, 1, 1, 0, 1, 2, 2, 1,  2,  3,  2,  1]
+    >>> print res[0]
+    [1 5 5 1]
+    >>> print res[1]
+    [0 5 1 0]
+
+    """
+    if start > end:
+        raise NameError("start %d bigger that end %d" % (start, end))
+
+    chromNameBit = chrNameBamToBit[chromNameBam]
+
+    # array to keep track of the GC from regions of length 'fragmentLength'
+    # from the genome. The index of the array is used to
+    # indicate the gc content. The values inside the
+    # array are counts. Thus, if N_gc[10] = 3, that means
+    # that 3 regions have a gc_content of 10.
+    subN_gc = np.zeros(fragmentLength['median'] + 1, dtype='int')
+    subF_gc = np.zeros(fragmentLength['median'] + 1, dtype='int')
+
+    tbit = fileHandles.getTwoBit(global_vars['2bit'])
+    bam  = fileHandles.getBam(global_vars['bam'])
+    peak = 0
+    startTime = time.time()
+
+    if verbose:
+        print "[{:.3f}] computing positions to " \
+            "sample".format(time.time() - startTime)
+
+    positions_to_sample = getPositionsToSample(chromNameBit,
+                                               start, end, stepSize)
+
+    read_counts = []
+    # reads fetched from the bam file
+    fetched = 0
+    # Optimize IO.
+    # if the sample regions are far appart from each
+    # other is faster to go to each location and fetch
+    # the reads found there.
+    # Otherwise, if the regions to sample are close to
+    # each other, is faster to load all the reads in
+    # a large region into memory and consider only
+    # those falling into the positions to sample.
+    # The following code gets the reads
+    # that are at sampling positions that lie close together
+    if np.mean(np.diff(positions_to_sample)) < 1000:
+        start_pos = min(positions_to_sample)
+        end_pos = max(positions_to_sample)
+        if verbose:
+            print "[{:.3f}] caching reads".format(time.time() - startTime)
+
+        reads = [r for r in bam.fetch(chromNameBam, start_pos, end_pos + 1)]
+        fetched = len(reads)
+        counts = np.bincount([r.pos - start_pos for r in reads
+                              if not r.is_reverse and r.pos >= start_pos],
+                             minlength=end_pos - start_pos + 2)
+
+        read_counts = counts[positions_to_sample - min(positions_to_sample)]
+        if verbose:
+            print "[{:.3f}] finish caching reads.".format(
+                time.time() - startTime)
+
+    countTime = time.time()
+
+    c = 1
+    for index in xrange(len(positions_to_sample)):
+        i = positions_to_sample[index]
+        # stop if the end of the chromosome is reached
+        if i + fragmentLength['median'] > tbit[chromNameBit].size:
+            break
+
+        try:
+            gc = getGC_content(
+                tbit[chromNameBit].get(i, i + fragmentLength['median']),
+                as_fraction=False)
+        except Exception as detail:
+            if verbose:
+                print detail
+            continue
+
+        subN_gc[gc] += 1
+
+        # count all reads at position 'i'
+        if len(read_counts) == 0:  # case when no cache was done
+            reads = [x for x in bam.fetch(chromNameBam, i, i + 1)]
+            fetched += len(reads)
+            num_reads = len([x.pos for x in reads
+                             if x.is_reverse is False and x.pos == i])
+        else:
+            num_reads = read_counts[index]
+
+        if num_reads >= global_vars['max_reads']:
+            peak += 1
+            continue
+
+        subF_gc[gc] += num_reads
+        if verbose:
+            if index % 50000 == 0:
+                endTime = time.time()
+                print "%s processing %d (%.1f per sec) @ %s:%s-%s %s"  % \
+                    (multiprocessing.current_process().name,
+                     index, index / (endTime - countTime),
+                     chromNameBit, start, end, stepSize)
+        c += 1
+
+    if verbose:
+        endTime = time.time()
+        print "%s processing %d (%.1f per sec) @ %s:%s-%s %s"  % \
+            (multiprocessing.current_process().name,
+             index, index / (endTime - countTime),
+             chromNameBit, start, end, stepSize)
+        print "%s total time %.1f @ %s:%s-%s %s"  % \
+            (multiprocessing.current_process().name,
+             (endTime - startTime), chromNameBit, start, end, stepSize)
+
+    perfLog.countReads(fetched, int(subF_gc.sum()))
+    return(subN_gc, subF_gc)
+
+
+def tabulateGCcontent(fragmentLength, chrNameBitToBam, stepSize,
+                      chromSizes, numberOfProcessors=None, verbose=False,
+                      region=None, checkpointDir=None):
+    r"""
+    Subdivides the genome or the reads into chunks to be analyzed in parallel
+    using several processors. This codes handles the creation of
+    workers that tabulate the GC content for small regions and then
+    collects and integrates the results. The results of each region
+    can be kept in a checkpointDir to be reused by a later run.
+    >>> test = Tester()
+    >>> arg = test.testTabulateGCcontent()
+    >>> res = tabulateGCcontent(*arg)
+    >>> res
+    array([[   0.        ,   18.        ,    1.        ],
+           [   3.        ,   63.        ,    0.42857143],
+           [   7.        ,  159.        ,    0.39622642],
+           [  25.        ,  192.        ,    1.171875  ],
+           [  28.        ,  215.        ,    1.17209302],
+           [  16.        ,  214.        ,    0.6728972 ],
+           [  12.        ,   95.        ,    1.13684211],
+           [   9.        ,   24.        ,    3.375     ],
+           [   3.        ,   11.        ,    2.45454545],
+           [   0.        ,    0.        ,    1.        ],
+           [   0.        ,    0.        ,    1.        ]])
+    """
+    global global_vars
+
+    chrNameBamToBit = dict([(v, k) for k, v in chrNameBitToBam.iteritems()])
+    chunkSize = int(min(2e6, 4e5 / global_vars['reads_per_bp']))
+
+    imap_res = mapReduce.imapReduce((stepSize,
+                                     fragmentLength, chrNameBamToBit,
+                                     verbose),
+                                    tabulateGCcontent_wrapper,
+                                    chromSizes,
+                                    genomeChunkLength=chunkSize,
+                                    numberOfProcessors=numberOfProcessors,
+                                    region=region,
+                                    moduleGlobals={'global_vars':
+                                                   global_vars},
+                                    checkpointDir=checkpointDir)
+
+    for subN_gc, subF_gc in imap_res:
+        try:
+            F_gc += subF_gc
+            N_gc += subN_gc
+        except NameError:
+            F_gc = subF_gc
+            N_gc = subN_gc
+
+    scaling = sum(N_gc) / sum(F_gc)
+
+    R_gc = np.array([float(F_gc[x] ) / N_gc[x] * scaling
+                     if N_gc[x] and F_gc[x] > 0 else 1
+                     for x in xrange(len(F_gc))])
+
+    data = np.transpose(np.vstack((F_gc, N_gc, R_gc)))
+    return data
+
+
+def countReadsPerGC(regionSize, chrNameBitToBam, stepSize,
+                    chromSizes, numberOfProcessors=None, verbose=False,
+                    region=None):
+    r"""
+    Computes for a region of size regionSize, the GC of the region
+    and the number of reads that overlap it.
+    >>> test = Tester()
+    >>> arg = test.testCountReadsPerGC()
+    >>> reads_per_gc = countReadsPerGC(*arg)
+    >>> reads_per_gc[0:5,:]
+    array([[ 132.        ,    0.44      ],
+           [ 132.        ,    0.44      ],
+           [ 133.        ,    0.44      ],
+           [ 134.        ,    0.43666667],
+           [ 134.        ,    0.44      ]])
+    """
+    global global_vars
+
+    chrNameBamToBit = dict([(v, k) for k, v in chrNameBitToBam.iteritems()])
+    chunkSize = int(min(2e6, 4e5 / global_vars['reads_per_bp']))
+
+    imap_res = mapReduce.imapReduce((stepSize,
+                                     regionSize, chrNameBamToBit,
+                                     verbose),
+                                    countReadsPerGC_wrapper,
+                                    chromSizes,
+                                    genomeChunkLength=chunkSize,
+                                    numberOfProcessors=numberOfProcessors,
+                                    region=region,
+                                    moduleGlobals={'global_vars':
+                                                   global_vars})
+
+    reads_per_gc = []
+    for sub_reads_per_gc in imap_res:
+        reads_per_gc += sub_reads_per_gc
+
+    reads_per_gc = np.asarray(reads_per_gc)
+    return reads_per_gc
+
+
+def get_intervals(intervalsFile):
+    """
+    Creates an index of intervals for each restriction site
+
+    :param intervalsFile: file handler of a BED file
+    """
+    intervals_tree = {}
+    ff = open(intervalsFile, 'r')
+    for line in ff:
+        fields = line.strip().split()
+        chrom, start_int, end_int, = fields[0], int(fields[1]), int(fields[2])
+
+        if chrom not in intervals_tree:
+            intervals_tree[chrom] = IntervalTree()
+
+        try:
+            intervals_tree[chrom].add_interval(Interval(start_int, end_int))
+        except:
+            sys.stderr.write("Problem with line:{}\n".format(line))
+            sys.stderr.write(fields)
+    ff.close()
+    return intervals_tree
+
+
+class Tester():
+    def __init__(self):
+        self.root = cfg.config.get('general', 'test_root') + "/test_corrGC/"
+        self.tbitFile = self.root + "sequence.2bit"
+        self.bamFile  = self.root + "test.bam"
+        self.mappability  = self.root + "mappability.bw"
+        self.chrNameBam = '2L'
+        self.chrNameBit = 'chr2L'
+        self.samtools = cfg.config.get('external_tools', 'samtools')
+        bam = pysam.Samfile(self.bamFile)
+        bit = twobit.TwoBitFile(open(self.tbitFile ))
+        global debug
+        debug = 0
+        global global_vars
+        global_vars = {'2bit': self.tbitFile,
+                       'bam': self.bamFile,
+                       'filter_out': None,
+                       'mappability': self.mappability,
+                       'extra_sampling_file': None,
+                       'max_reads': 5,
+                       'min_reads': 0,
+                       'min_reads': 0,
+                       'reads_per_bp': 0.3,
+                       'total_reads': bam.mapped,
+                       'genome_size': sum([bit[x].size for x in bit.index])}
+
+    def testTabulateGCcontentWorker(self):
+        stepSize  = 2
+        fragmentLength = {'min': 1, 'median': 3, 'max': 5}
+        start = 0
+        end = 20
+        chrNameBam2bit = {'2L': 'chr2L'}
+        return (self.chrNameBam,
+                start, end, stepSize, fragmentLength, chrNameBam2bit)
+
+    def set_filter_out_file(self):
+        global global_vars
+        global_vars['filter_out']  = self.root + "filter_out.bed"
+
+    def unset_filter_out_file(self):
+        global global_vars
+        global_vars['filter_out']  = None
+
+    def set_extra_sampling_file(self):
+        global global_vars
+        global_vars['extra_sampling_file']  = self.root + "extra_sampling.bed"
+
+    def testTabulateGCcontent(self):
+        fragmentLength = {'median': 10}
+        chrNameBitToBam = {'chr2L': '2L'}
+        stepSize = 1
+        bam = pysam.Samfile(global_vars['bam'])
+        chromSizes = [(bam.references[i], bam.lengths[i])
+                      for i in range(len(bam.references))]
+        return (fragmentLength,
+                chrNameBitToBam, stepSize, chromSizes, 1)
+
+    def testCountReadsPerGC(self):
+        regionSize = 300
+        chrNameBitToBam = {'chr2L': '2L'}
+        stepSize = 1
+        bam = pysam.Samfile(global_vars['bam'])
+        chromSizes = [(bam.references[i], bam.lengths[i])
+                      for i in range(len(bam.references))]
+        return (regionSize,
+                chrNameBitToBam, stepSize, chromSizes, 1)
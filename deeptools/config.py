@@ -14,10 +14,7 @@ if  os.environ.get('DEEP_TOOLS_NO_CONFIG', False):
     config.set('general', 'default_proc_number', 'max/2')
 
     config.add_section('external_tools')
-    config.set('external_tools', 'sort', 'sort')
     config.set('external_tools', 'samtools', 'samtools')
-    config.set('external_tools', 'bedgraph_to_bigwig', 'bedGraphToBigWig')
-    config.set('external_tools', 'bigwig_info', 'bigWigInfo')
 
 else:
     config = ConfigParser.ConfigParser()
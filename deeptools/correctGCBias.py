@@ -0,0 +1,406 @@
+import os
+import tempfile
+import time
+import multiprocessing
+
+import numpy as np
+import pysam
+from bx.seq import twobit
+
+# own modules
+from utilities import getGC_content
+from countReadsPerBin import getFragmentFromRead
+import config as cfg
+import fileHandles
+import perfLog
+import writeBedGraph
+
+samtools = cfg.config.get('external_tools', 'samtools')
+debug = 0
+
+# variables read by the workers, set by the correctGCBias
+# program and sent to the workers by mapReduce
+global_vars = dict()
+R_gc = None
+
+
+def getReadGCcontent(tbit, read, fragmentLength, chrNameBit):
+    """
+    The fragments for forward and reverse reads are defined as follows
+
+       |- read.pos       |- read.aend
+    ---+=================>-----------------------+---------    Forward strand
+
+       |-fragStart                               |-fragEnd
+
+    ---+-----------------------<=================+---------    Reverse strand
+                               |-read.pos        |-read.aend
+
+       |-----------------------------------------|
+                        read.tlen
+    """
+    fragStart = None
+    fragEnd = None
+
+    if read.is_paired and read.is_proper_pair and \
+            abs(read.tlen) < 2 * fragmentLength:
+        if read.is_reverse and read.tlen < 0:
+            fragEnd   = read.aend
+            fragStart = read.aend + read.tlen
+        elif read.tlen >= read.qlen:
+            fragStart = read.pos
+            fragEnd   = read.pos + read.tlen
+
+    if not fragStart:
+        if read.is_reverse:
+            fragEnd    = read.aend
+            fragStart  = read.aend  - fragmentLength
+        else:
+            fragStart  = read.pos
+            fragEnd    = fragStart + fragmentLength
+    try:
+        gc = getGC_content(tbit[chrNameBit].get(fragStart,
+                                                fragEnd),
+                           as_fraction=True)
+    except Exception:
+        return None
+        """
+        print "getReadGCcontent exception."
+        print detail
+        """
+    # match the gc to the given fragmentLength
+    gc = int(np.round(gc * fragmentLength))
+    return gc
+
+
+def writeCorrected_wrapper(args):
+    return writeCorrected_worker(*args)
+
+
+def writeCorrected_worker(chrNameBam, chrNameBit, start, end, step):
+    r"""returns the bedgraph runs (see writeBedGraph.getTileRuns)
+    of the GC correction of a region from the genome
+    >>> test = Tester()
+    >>> res = writeCorrected_worker(*test.testWriteCorrectedChunk())
+    >>> writeBedGraph.getBedGraphLines(*res).splitlines(True)
+    ['chr2L\t200\t225\t31.6\n', 'chr2L\t225\t250\t33.8\n', 'chr2L\t250\t275\t37.9\n', 'chr2L\t275\t300\t40.9\n']
+    """
+    global R_gc
+    fragmentLength = len(R_gc) - 1
+
+    cvg_corr = np.zeros(end - start)
+
+    i = 0
+
+    tbit = fileHandles.getTwoBit(global_vars['2bit'])
+    bam  = fileHandles.getBam(global_vars['bam'])
+    read_repetitions = 0
+    removed_duplicated_reads = 0
+    startTime = time.time()
+
+    # caching seems to be faster
+    reads = [r for r in bam.fetch(chrNameBam, start, end)]
+    r_index = -1
+    for read in reads:
+        r_index += 1
+        try:
+            # calculate GC content of read fragment
+            gc = getReadGCcontent(tbit, read, fragmentLength,
+                                  chrNameBit)
+        except Exception as detail:
+            print detail
+            """ this exception happens when the end of a
+            chromosome is reached """
+            continue
+        if not gc:
+            continue
+
+        # is this read in the same orientation and position as the previous?
+        if r_index > 0 and read.pos == reads[r_index - 1].pos and \
+                read.is_reverse == reads[r_index - 1].is_reverse \
+                and read.pnext == reads[r_index - 1].pnext:
+            read_repetitions += 1
+            if read_repetitions >= global_vars['max_dup_gc'][gc]:
+                removed_duplicated_reads += 1
+                continue
+        else:
+            read_repetitions = 0
+
+        try:
+            fragmentStart, fragmentEnd = \
+                getFragmentFromRead(read,
+                                    fragmentLength,
+                                    extendPairedEnds=True)
+            vectorStart = max(fragmentStart - start, 0)
+            vectorEnd   = min(fragmentEnd   - start, end - start)
+        except TypeError:
+            # the getFragmentFromRead functions returns None in some cases.
+            # Those cases are to be skiped, hence the continue line.
+            continue
+
+        cvg_corr[vectorStart:vectorEnd] += float(1) / R_gc[gc]
+        i += 1
+    perfLog.countReads(len(reads), i)
+    if debug:
+        endTime = time.time()
+        print "{}, processing {} ({:.1f} per sec) "
+        "reads @ {}:{}-{}".format(multiprocessing.current_process().name,
+                                  i, i / (endTime - startTime),
+                                  chrNameBit, start, end)
+
+    if i == 0:
+        return None
+
+    # one run per bin, written with one decimal
+    bins = np.arange(0, len(cvg_corr), step)
+    runs = np.zeros(len(bins), dtype=writeBedGraph.BEDGRAPH_RUN)
+    runs['start'] = start + bins
+    runs['end'] = np.minimum(start + bins + step, end)
+    runs['value'] = [np.mean(cvg_corr[bin:min(bin + step, end)])
+                     for bin in bins]
+    runs['decimals'] = 1
+    return chrNameBit, runs[runs['value'] > 0]
+
+
+def numCopiesOfRead(value):
+    """
+    Based int he R_gc value, decides
+    whether to keep, duplicate, triplicate or delete the read.
+    It returns an integer, that tells the number of copies of the read
+    that should be keep.
+    >>> np.random.seed(1)
+    >>> numCopiesOfRead(0.8)
+    1
+    >>> numCopiesOfRead(2.5)
+    2
+    >>> numCopiesOfRead(None)
+    1
+    """
+    copies = 1
+    if value:
+        copies = int(value) + (1 if np.random.rand() < value % 1 else 0)
+    return copies
+
+
+def writeCorrectedSam_wrapper(args):
+    return writeCorrectedSam_worker(*args)
+
+
+def writeCorrectedSam_worker(chrNameBam, chrNameBit, start, end,
+                             step=None,
+                             tag_but_not_change_number=False,
+                             verbose=True):
+    r"""
+    Writes a SAM file, deleting and adding some reads in order to compensate
+    for the GC bias. **This is a probabilistic method.**
+    >>> np.random.seed(1)
+    >>> test = Tester()
+    >>> args = test.testWriteCorrectedSam()
+    >>> tempFile = writeCorrectedSam_worker(*args, \
+    ... tag_but_not_change_number=True, verbose=False)
+    >>> res = os.system("{} index {}".format(test.samtools, tempFile))
+    >>> bam = pysam.Samfile(tempFile)
+    >>> [dict(r.tags)['CP'] for r in bam.fetch(args[0], 200, 250)]
+    [1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 0, 1, 1, 1, 1, 1, 1, 1]
+    >>> res = os.remove(tempFile)
+    >>> res = os.remove(tempFile+".bai")
+    >>> tempFile = \
+    ... writeCorrectedSam_worker(*test.testWriteCorrectedSam_paired(),\
+    ... tag_but_not_change_number=True, verbose=False)
+    >>> res = os.system("{} index {}".format(test.samtools, tempFile))
+    >>> bam = pysam.Samfile(tempFile)
+    >>> [dict(r.tags)['CP'] for r in bam.fetch('chr2L', 0, 50)]
+    [1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1]
+    >>> res = os.remove(tempFile)
+    >>> res = os.remove(tempFile+".bai")
+    """
+    global R_gc
+    fragmentLength = len(R_gc) - 1
+
+    if verbose: print "Sam for %s %s %s " % (chrNameBit, start, end)
+    i = 0
+
+    tbit = fileHandles.getTwoBit(global_vars['2bit'])
+
+    bam = fileHandles.getBam(global_vars['bam'])
+    # is /dev/shm available?
+    # working in this directory speeds the process
+    try:
+        _file = tempfile.NamedTemporaryFile(suffix=".sam",
+                                            dir='/dev/shm', delete=False)
+    except OSError:
+        _file = tempfile.NamedTemporaryFile(suffix=".sam", delete=False)
+
+    tempFileName = _file.name
+    _file.close()
+
+    outfile = pysam.Samfile(tempFileName, 'wh', template=bam)
+    startTime = time.time()
+    matePairs = {}
+    read_repetitions = 0
+    removed_duplicated_reads = 0
+    # cache data
+    reads = [r for r in bam.fetch(chrNameBam, start, end) if r.pos > start]
+
+    r_index = -1
+    for read in reads:
+        r_index += 1
+        copies = None
+        gc     = None
+
+        # check if a mate has already been procesed
+        # to apply the same correction
+        try:
+            copies = matePairs[read.qname]['copies']
+            gc = matePairs[read.qname]['gc']
+            del(matePairs[read.qname])
+        except:
+            # this exception happens when a mate is
+            # not present. This could
+            # happen because of removal of the mate
+            # by some filtering
+            gc = getReadGCcontent(tbit, read, fragmentLength,
+                                  chrNameBit)
+            if gc:
+                copies = numCopiesOfRead(float(1) / R_gc[gc])
+            else:
+                copies = 1
+        # is this read in the same orientation and position as the previous?
+        if gc and r_index > 0 and read.pos == reads[r_index - 1].pos \
+                and read.is_reverse == reads[r_index - 1].is_reverse \
+                and read.pnext == reads[r_index - 1].pnext:
+            read_repetitions += 1
+            if read_repetitions >= global_vars['max_dup_gc'][gc]:
+                copies = 0  # in other words do not take into account this read
+                removed_duplicated_reads += 1
+        else:
+            read_repetitions = 0
+
+        readName = read.qname
+        readTag = read.tags
+        if gc:
+            GC = int(100 * np.round(float(gc) / fragmentLength,
+                                    decimals=2))
+            readTag.append(
+                ('CO', float(round(float(1) / R_gc[gc], 2))))
+            readTag.append(('CP', copies ))
+        else:
+            GC = -1
+
+        readTag.append(('GC', GC))
+        read.tags = readTag
+
+        if read.is_paired and read.is_proper_pair \
+                and not read.mate_is_unmapped \
+                and not read.is_reverse:
+            matePairs[readName] = {'copies': copies,
+                                   'gc': gc}
+
+        """
+        outfile.write(read)
+        """
+        if tag_but_not_change_number:
+            outfile.write(read)
+            continue
+
+        for numCop in range(1, copies + 1):
+            # the read has to be renamed such that newly
+            # formed pairs will match
+            if numCop > 1:
+                read.qname  = readName + "_%d" % (numCop)
+            outfile.write(read)
+
+        if verbose:
+            if i % 500000 == 0 and i > 0:
+                endTime = time.time()
+                print "{},  processing {} ({:.1f} per sec) reads " \
+                    "@ {}:{}-{}".format(multiprocessing.current_process().name,
+                                        i, i / (endTime - startTime),
+                                        chrNameBit, start, end)
+        i += 1
+
+    outfile.close()
+    perfLog.countReads(len(reads), len(reads) - removed_duplicated_reads)
+    if verbose:
+        endTime = time.time()
+        print "{},  processing {} ({:.1f} per sec) reads " \
+            "@ {}:{}-{}".format(multiprocessing.current_process().name,
+                                i, i / (endTime - startTime),
+                                chrNameBit, start, end)
+        percentage = float(removed_duplicated_reads) * 100 / len(reads) \
+            if len(reads) > 0 else 0
+        print "duplicated reads removed %d of %d (%.2f) " % \
+            (removed_duplicated_reads, len(reads), percentage)
+
+    if verbose: print tempFileName
+    # convert sam to bam.
+    os.system("{} view -bS {} 2> /dev/null > {}.bam".format(samtools,
+                                                            tempFileName,
+                                                            tempFileName))
+
+    os.remove(tempFileName)
+    return tempFileName + ".bam"
+
+
+class Tester():
+    def __init__(self):
+        self.root = cfg.config.get('general', 'test_root') + "/test_corrGC/"
+        self.tbitFile = self.root + "sequence.2bit"
+        self.bamFile  = self.root + "test.bam"
+        self.chrNameBam = '2L'
+        self.chrNameBit = 'chr2L'
+        self.samtools = cfg.config.get('external_tools', 'samtools')
+        bam = pysam.Samfile(self.bamFile)
+        bit = twobit.TwoBitFile(open(self.tbitFile ))
+        global debug
+        debug = 0
+        global global_vars
+        global_vars = {'2bit': self.tbitFile,
+                       'bam': self.bamFile,
+                       'filter_out': None,
+                       'extra_sampling_file': None,
+                       'max_reads': 5,
+                       'min_reads': 0,
+                       'min_reads': 0,
+                       'reads_per_bp': 0.3,
+                       'total_reads': bam.mapped,
+                       'genome_size': sum([bit[x].size for x in bit.index])}
+
+    def testWriteCorrectedChunk(self):
+        """ prepare arguments for test
+        """
+        global R_gc, R_gc_min, R_gc_max
+        R_gc = np.loadtxt(self.root + "R_gc_paired.txt")
+
+        global_vars['max_dup_gc'] = np.ones(301)
+
+        start = 200
+        end = 300
+        bedGraphStep = 25
+        return (self.chrNameBam,
+                self.chrNameBit, start, end, bedGraphStep )
+
+    def testWriteCorrectedSam(self):
+        """ prepare arguments for test
+        """
+        global R_gc, R_gc_min, R_gc_max
+        R_gc = np.loadtxt(self.root + "R_gc_paired.txt")
+
+        global_vars['max_dup_gc'] = np.ones(301)
+
+        start = 200
+        end = 250
+        return (self.chrNameBam,
+                self.chrNameBit, start, end)
+
+    def testWriteCorrectedSam_paired(self):
+        """ prepare arguments for test.
+        """
+        global R_gc, R_gc_min, R_gc_max
+        R_gc = np.loadtxt(self.root + "R_gc_paired.txt")
+        
+        start = 0
+        end = 500
+        global global_vars
+        global_vars['bam']  = self.root + "paired.bam"
+        return ('chr2L', 'chr2L', start, end )
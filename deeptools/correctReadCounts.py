@@ -12,8 +12,9 @@ debug = 1
 
 def computeLambda(tileCoverage, args):
     """
-    This function is called by the writeBedGraph workers for every 
-    tile in the genome that is considered
+    This function is called by the writeBedGraph workers with
+    the treatment and control coverage (rows) of the tiles
+    (columns) in the genome that are considered
     """
 
     treatmentWindowTags = tileCoverage[0]
@@ -25,14 +26,20 @@ def computeLambda(tileCoverage, args):
     log10pvalue = -1* poisson.logsf(controlWindowTags, controlLambda) / np.log(10)
 
     return log10pvalue
+computeLambda.vectorized = True
 
 def computePvalue(tileCoverage, args):
     """
-    This function is called by the writeBedGraph workers for every 
-    tile in the genome that is considered
+    This function is called by the writeBedGraph workers with
+    the treatment and control coverage (rows) of the tiles
+    (columns) in the genome that are considered
 
     It computes a pvalue based on an expected lambda comming from 
     the correction of treatment when the input is considered.
+
+    >>> computePvalue(np.array([[4.0, 1000.0], [2.0, 1.0]]),
+    ... {'treatmentControlRatio': 1})
+    array([   1.27857674,  300.        ])
     """
 
     treatmentWindowTags = tileCoverage[0]
@@ -40,14 +47,16 @@ def computePvalue(tileCoverage, args):
     
     treatmentLambda = controlWindowTags * args['treatmentControlRatio']
         
-    log10pvalue = min(300, -1* poisson.logsf(treatmentWindowTags, treatmentLambda) / np.log(10))
+    log10pvalue = np.fmin(300, -1* poisson.logsf(treatmentWindowTags, treatmentLambda) / np.log(10))
 
     return log10pvalue
+computePvalue.vectorized = True
 
 def computeCorrectedReadcounts(tileCoverage, args):
     """
-    This function is called by the writeBedGraph workers for every 
-    tile in the genome that is considered
+    This function is called by the writeBedGraph workers with
+    the treatment and control coverage (rows) of the tiles
+    (columns) in the genome that are considered
 
     It computes a pvalue based on an expected lambda comming from 
     the correction of treatment when the input is considered.
@@ -61,6 +70,7 @@ def computeCorrectedReadcounts(tileCoverage, args):
     treatmentCorrectedTags = treatmentWindowTags - args['treatmentControlRatio'] * ( controlWindowTags - args['controlMean'] )
         
     return treatmentCorrectedTags
+computeCorrectedReadcounts.vectorized = True
 
 def correctReadCounts(bamFilesList, binLength, numberOfSamples, defaultFragmentLength, 
                   outFileName, outFileFormat, outFileNameCorr=None, region=None,
@@ -11,7 +11,11 @@ import pysam
 # my packages
 from utilities import *
 import bamHandler
+import coverageIndex
+import fileHandles
+import perfLog
 import mapReduce 
+from blackList import BlackList
 
 
 def countReadsInRegions_wrapper(args):
@@ -19,7 +23,7 @@ def countReadsInRegions_wrapper(args):
 
 def countReadsInRegions_worker(chrom, start, end, bamFilesList, 
                                stepSize, binLength, defaultFragmentLength, 
-                               skipZeros = False):
+                               skipZeros = False, blackListFileName=None):
     """ counts the reads in each bam file at each 'stepSize' position
     within the interval start, end 
     for a 'binLength' window.
@@ -31,55 +35,47 @@ def countReadsInRegions_worker(chrom, start, end, bamFilesList,
     The transpose is used to get better looking numbers. the first line corresponds to
     the number of reads per bin in the first bamfile
     >>> np.transpose(countReadsInRegions_worker(test.chrom, 0, 200, [test.bamFile1, test.bamFile2], 50, 25, 0))
-    array([[ 0.,  0.,  1.,  1.],
-           [ 0.,  1.,  1.,  2.]])
+    array([[0, 0, 1, 1],
+           [0, 1, 1, 2]], dtype=uint16)
 
     When skipZeros is set to true, those cases in which *all* of the
     bamfiles have zero counts for a certain bin are ignored
     >>> np.transpose(countReadsInRegions_worker(test.chrom, 0, 200, [test.bamFile1, test.bamFile2], 50, 25, 0, skipZeros=True))
-    array([[ 0.,  1.,  1.],
-           [ 1.,  1.,  2.]])
+    array([[0, 1, 1],
+           [1, 1, 2]], dtype=uint16)
 
     >>> np.transpose(countReadsInRegions_worker(test.chrom, 0, 200, [test.bamFile1, test.bamFile2], 200, 200, 0))
-    array([[ 2.],
-           [ 4.]])
+    array([[2],
+           [4]], dtype=uint16)
 
+    The bins overlapping the regions of the blackListFileName are skipped
+    >>> np.transpose(countReadsInRegions_worker(test.chrom, 0, 200, [test.bamFile1, test.bamFile2], 50, 25, 0, blackListFileName=test.blackListFile))
+    array([[1, 1],
+           [1, 2]], dtype=uint16)
      """
 
     if start > end:
         raise NameError("start %d bigger that end %d" % (start, end))
 
-    # array to keep the read counts for the regions
-    subNum_reads_per_bin = []
-
-    rows = 0
     startTime = time.time()
     extendPairedEnds = True
-    zerosToNans = False
     
-    bamHandlers = [bamHandler.openBam(bam) for bam in bamFilesList]
-    for i in xrange(start, end, stepSize):
-        if i + binLength > end:
-            break
-        avgReadsArray = []
-        for bam in bamHandlers:
-            avgReadsArray.append( \
-                getCoverageOfRegion( bam, 
-                                     chrom, i, i+binLength, 
-                                     binLength, 
-                                     defaultFragmentLength, 
-                                     extendPairedEnds, 
-                                     zerosToNans )[0] )
-
-        if np.isnan(sum(avgReadsArray)):
-            continue
-
-        if skipZeros and sum(avgReadsArray) == 0:
-            continue
-
-        subNum_reads_per_bin.extend(avgReadsArray)
-
-        rows += 1
+    bamHandlers = [fileHandles.getBam(bam) for bam in bamFilesList]
+    blackList = None
+    if blackListFileName:
+        blackList = fileHandles.getBlackList(blackListFileName)
+    # each bam file is read once for all the bins of the chunk
+    subNum_reads_per_bin = np.column_stack(
+        [countReadsInBins(bam, chrom, start, end, stepSize, binLength,
+                          defaultFragmentLength, extendPairedEnds,
+                          blackList=blackList)
+         for bam in bamHandlers])
+
+    if skipZeros:
+        subNum_reads_per_bin = subNum_reads_per_bin[
+            subNum_reads_per_bin.any(axis=1)]
+
+    rows = len(subNum_reads_per_bin)
 
     if debug:
         endTime = time.time()
@@ -89,28 +85,146 @@ def countReadsInRegions_worker(chrom, start, end, bamFilesList,
                   rows, rows / (endTime - startTime) , chrom, start, end )
 
 
-    return np.array(subNum_reads_per_bin).reshape(rows,len(bamFilesList)) 
+    return subNum_reads_per_bin
+
+def countReadsInBins(bamHandle, chrom, start, end, stepSize, binLength,
+                     defaultFragmentLength, extendPairedEnds=True,
+                     blackList=None):
+    """
+    Returns the number of reads in each of the bins of binLength
+    that start every stepSize bp between start and end. The counts
+    are those of getCoverageOfRegion for each bin (with tileSize
+    equal to binLength), but the reads are fetched only once: a read
+    counts for a bin if both the read and its fragment overlap the bin.
+    The counts are integers, as for getCoverageCounts.
+
+    If a blackList (see blackList.BlackList) is given, the bins
+    overlapping it are left out and the reads inside it are not
+    fetched.
+
+    >>> test = Tester()
+    >>> bam = pysam.Samfile(test.bamFile2)
+    >>> counts = countReadsInBins(bam, test.chrom, 0, 200, 20, 50, 0)
+    >>> counts
+    array([0, 1, 1, 2, 2, 1, 3, 3], dtype=uint16)
+    >>> list(counts) == [getCoverageOfRegion(bam, test.chrom, i, i + 50, 50, 0,
+    ...                                      zerosToNans=False)[0]
+    ...                  for i in range(0, 151, 20)]
+    True
+    >>> countReadsInBins(bam, test.chrom, 0, 200, 20, 50, 0,
+    ...                  blackList=BlackList(test.blackListFile))
+    array([2, 2, 1, 3, 3], dtype=uint16)
+    """
+    if end - start < binLength:
+        return np.zeros(0, dtype=getCountDtype(0))
+    numberOfBins = (end - start - binLength) / stepSize + 1
+    if chrom not in bamHandle.references:
+        raise NameError( "chromosome {} not found in bam file".format(chrom) )
+
+    binStarts = start + np.arange(numberOfBins) * stepSize
+    masked = None
+    if blackList is not None:
+        masked = blackList.maskBins(chrom, binStarts, binStarts + binLength)
+
+    index = getCoverageIndex(bamHandle, chrom, defaultFragmentLength,
+                             extendPairedEnds)
+    if indexApplies(index, start, stepSize, binLength):
+        counts = index.countFragments(chrom, binStarts, binStarts + binLength)
+        if masked is not None:
+            counts = counts[~masked]
+        return counts
+
+    reads = fetchReads(bamHandle, chrom, start, end, blackList)
+
+    readArrays = getReadArrays(reads)
+    pos, aend = readArrays[:2]
+    fragmentStart, fragmentEnd, valid = getFragmentsFromReads(
+        readArrays, defaultFragmentLength, extendPairedEnds)
+
+    # the reads fetched for a bin are those whose alignment overlaps
+    # it (reads without alignment take one base)
+    overlapStart = np.maximum(pos, fragmentStart)[valid]
+    overlapEnd = np.minimum(np.where(aend >= 0, aend, pos + 1),
+                            fragmentEnd)[valid]
+
+    # bin j, which starts at start + j * stepSize, overlaps
+    # [overlapStart, overlapEnd) for firstBin <= j < lastBin
+    firstBin = np.clip((overlapStart - binLength - start) // stepSize + 1,
+                       0, numberOfBins)
+    lastBin = np.clip(-((start - overlapEnd) // stepSize), 0, numberOfBins)
+    overlap = firstBin < lastBin
+    difference = np.bincount(firstBin[overlap], minlength=numberOfBins + 1)
+    difference -= np.bincount(lastBin[overlap], minlength=numberOfBins + 1)
+
+    counted = int(overlap.sum())
+    perfLog.countReads(len(reads), counted)
+    counts = np.cumsum(difference[:numberOfBins],
+                       dtype=getCountDtype(counted))
+    if masked is not None:
+        counts = counts[~masked]
+    return counts
+
+
+def fetchReads(bamHandle, chrom, start, end, blackList=None, tileSize=1):
+    """
+    Returns the reads of bamHandle that overlap the region. If a
+    blackList is given, only the parts of the region outside of it
+    (see blackList.BlackList.getUnmaskedRegions) are fetched, and
+    the reads overlapping several parts are returned once.
+
+    >>> test = Tester()
+    >>> bam = pysam.Samfile(test.bamFile2)
+    >>> len(fetchReads(bam, test.chrom, 0, 200))
+    4
+    >>> blackList = BlackList([(test.chrom, 120, 130)])
+    >>> [(read.pos, read.aend) for read in
+    ...  fetchReads(bam, test.chrom, 0, 200, blackList)]
+    [(50, 100), (100, 150), (150, 200), (150, 200)]
+    >>> [(read.pos, read.aend) for read in
+    ...  fetchReads(bam, test.chrom, 0, 200, blackList, tileSize=50)]
+    [(50, 100), (150, 200), (150, 200)]
+    """
+    if blackList is None:
+        return [r for r in bamHandle.fetch(chrom, start, end)]
+
+    reads = []
+    previousEnd = None
+    for partStart, partEnd in blackList.getUnmaskedRegions(chrom, start, end,
+                                                           tileSize):
+        for read in bamHandle.fetch(chrom, partStart, partEnd):
+            # the reads starting before the end of the previous part
+            # overlap it, thus they were already fetched
+            if previousEnd is None or read.pos >= previousEnd:
+                reads.append(read)
+        previousEnd = partEnd
+    return reads
+
 
 def getNumReadsPerBin(bamFilesList, binLength, numberOfSamples, defaultFragmentLength, 
                       numberOfProcessors=1, skipZeros=True, verbose=False, region=None,
-                      chrsToSkip=[]):
+                      chrsToSkip=[], blackListFileName=None):
     r"""
     This function visits a number of sites and returs a list containing read counts.
-    Each row to one sampled site and each column correspond to each of the bamFiles
+    Each row to one sampled site and each column correspond to each of the bamFiles.
+    The counts are unsigned integers (see getCountDtype), thus they have to be
+    converted to float before dividing them.
 
     If the chrsToSkip is given, then counts are filter out from this chromosome which, 
     unless a female sample is used, the counts are less compared to 
     autosomes. For most applications this is irrelevant but for other cases,
     like when stimating the best scaling factor, this is important.
 
+    The bins overlapping the regions of the blackListFileName, a BED
+    file, are skipped.
+
     The test data contains reads for 200 bp
     >>> test = Tester()
 
     The transpose function is used to get a nicer looking output.
     The first line corresponds to the number of reads per bin in bam file 1
     >>> np.transpose(getNumReadsPerBin([test.bamFile1, test.bamFile2], 50, 4, 0, skipZeros=True))
-    array([[ 0.,  1.,  1.],
-           [ 1.,  1.,  2.]])
+    array([[0, 1, 1],
+           [1, 1, 2]], dtype=uint16)
 
     >>> aa = np.transpose(getNumReadsPerBin([test.bamFile1, test.bamFile2], 50, 4, 0, skipZeros=True))
     >>> np.savez('/tmp/aa', aa)
@@ -141,6 +255,17 @@ def getNumReadsPerBin(bamFilesList, binLength, numberOfSamples, defaultFragmentL
 
     stepSize = max(int( float(genomeSize) / numberOfSamples ), 1 )
 
+    # if all the bam files have a coverage index, the bins are placed
+    # at multiples of its resolution such that the counts are read
+    # from the indices (see countReadsInBins)
+    options = coverageIndex.getIndexOptions(defaultFragmentLength)
+    indices = [coverageIndex.findIndex(x, options) for x in bamFilesList]
+    if None not in indices:
+        resolution = indices[0].resolution
+        if all([index.resolution == resolution for index in indices]) \
+                and binLength % resolution == 0:
+            stepSize += -stepSize % resolution
+
     chunkSize =  int (stepSize * 1e3 / ( reads_per_bp  * len(bamFilesHandlers)) )
     [ bam_h.close() for bam_h in bamFilesHandlers]
 
@@ -152,12 +277,21 @@ def getNumReadsPerBin(bamFilesList, binLength, numberOfSamples, defaultFragmentL
         region += ":{}".format(tileSize)
 
     imap_res = mapReduce.mapReduce( (bamFilesList, stepSize, binLength, 
-                                     defaultFragmentLength, skipZeros),
+                                     defaultFragmentLength, skipZeros,
+                                     blackListFileName),
                                     countReadsInRegions_wrapper,
                                     chromSizes,
                                     genomeChunkLength=chunkSize,
                                     region=region,
-                                    numberOfProcessors = numberOfProcessors)
+                                    numberOfProcessors = numberOfProcessors,
+                                    bamFilesList=bamFilesList,
+                                    tileSize=stepSize,
+                                    skipEmptyRegions=skipZeros,
+                                    blackListFileName=blackListFileName)
+
+    if len(imap_res) == 0:
+        # all regions were skipped because they contain no reads
+        return np.zeros((0, len(bamFilesList)), dtype=getCountDtype(0))
 
     num_reads_per_bin = np.concatenate( imap_res, axis=0)
             
@@ -247,15 +381,190 @@ def getFragmentFromRead(read, defaultFragmentLength, extendPairedEnds=True,
 
     return (fragmentStart, fragmentEnd)
 
+def getFragmentCenter(read, defaultFragmentLength, extendPairedEnds=True,
+                      maxPairedFragmentLength=None):
+    """
+    Takes a proper pair fragment of high quaility and limited
+    to a certain length and outputs the center
+    """
+    fragmentStart = fragmentEnd = None
+
+    if not maxPairedFragmentLength:
+        maxPairedFragmentLength = 2*defaultFragmentLength if defaultFragmentLength > 0 else 1000;
+
+    # only paired forward reads are considered
+    if read.is_proper_pair and not read.is_reverse \
+            and abs(read.tlen) < 250 and read.mapq > 10:
+
+        if read.tlen % 2 == 0:
+            fragmentStart = read.pos + read.tlen/2 -1
+            fragmentEnd   = fragmentStart + 2
+
+        else:
+            fragmentStart = read.pos + read.tlen/2 - 1
+            fragmentEnd   = fragmentStart + 3
+
+    return (fragmentStart, fragmentEnd)
+
+def getReadArrays(reads):
+    """
+    Returns the position, end, mate position, template length, flag
+    and mapping quality of the reads as numpy arrays, in that order.
+    The end of reads without alignment (read.aend is None) is -1.
+
+    >>> test = Tester()
+    >>> arrays = getReadArrays([test.getRead("paired-forward")])
+    >>> [int(x[0]) for x in arrays]
+    [5000000, 5000036, 5000063, 100, 99, 255]
+    """
+    # the end of a mapped read is never 0
+    values = np.array([(read.pos, read.aend or -1, read.pnext, read.tlen,
+                        read.flag, read.mapq) for read in reads],
+                      dtype='int64').reshape(-1, 6)
+    return tuple(values.T)
+
+
+def getFragmentsFromReads(readArrays, defaultFragmentLength,
+                          extendPairedEnds=True, maxPairedFragmentLength=None):
+    """
+    Vectorized version of getFragmentFromRead for the arrays returned
+    by getReadArrays. Returns the arrays of fragment starts and ends,
+    plus a boolean array that is False for the reads for which
+    getFragmentFromRead fails (reads without alignment).
+
+    >>> test = Tester()
+    >>> types = ["paired-forward", "paired-reverse",
+    ...          "single-forward", "single-reverse"]
+    >>> reads = [test.getRead(x) for x in types]
+    >>> for length in [0, 20, 200]:
+    ...     starts, ends, valid = getFragmentsFromReads(getReadArrays(reads), length)
+    ...     zip(starts, ends) == [getFragmentFromRead(x, length) for x in reads]
+    True
+    True
+    True
+    """
+    pos, aend, pnext, tlen, flag, mapq = readArrays
+    if not maxPairedFragmentLength:
+        maxPairedFragmentLength = 2*defaultFragmentLength if defaultFragmentLength > 0 else 1000;
+
+    isReverse = (flag & 16) > 0
+    if extendPairedEnds == True:
+        absTlen = np.abs(tlen)
+        paired = ((flag & 1) > 0) & (absTlen < maxPairedFragmentLength) & (absTlen > 0)
+    else:
+        paired = np.zeros(len(pos), dtype=bool)
+
+    # single reads and pairs that are too far apart are extended
+    # to the fragment length, unless the read is longer
+    extend = ~paired & (defaultFragmentLength > aend - pos)
+    fragmentStart = np.where(extend & isReverse, aend - defaultFragmentLength, pos)
+    fragmentEnd = np.where(extend & ~isReverse, pos + defaultFragmentLength, aend)
+    fragmentStart = np.where(paired & isReverse, pnext, fragmentStart)
+    fragmentEnd = np.where(paired & ~isReverse, pos + tlen, fragmentEnd)
+
+    # only the paired forward reads do not need the read end
+    valid = (aend >= 0) | (paired & ~isReverse)
+    return fragmentStart, fragmentEnd, valid
+
+
+def getFragmentsOfReads(reads, defaultFragmentLength, extendPairedEnds=True,
+                        maxPairedFragmentLength=None, minMappingQuality=None,
+                        ignoreDuplicates=False,
+                        fragmentFromRead_func=getFragmentFromRead):
+    """
+    Returns the arrays of getReadArrays, the arrays of fragment
+    starts and ends of the reads and a boolean array with the reads
+    to count: those with a valid fragment that pass the mapping
+    quality and duplicate filters.
+
+    >>> test = Tester()
+    >>> bam = pysam.Samfile(test.bamFile2)
+    >>> reads = list(bam.fetch(test.chrom, 0, 200))
+    >>> getFragmentsOfReads(reads, 0, ignoreDuplicates=True)[3]
+    array([ True,  True,  True, False], dtype=bool)
+    """
+    # the fragments of all the reads are computed at once
+    readArrays = getReadArrays(reads)
+    pos, aend, pnext, tlen, flag, mapq = readArrays
+    if fragmentFromRead_func is getFragmentFromRead:
+        fragmentStart, fragmentEnd, keep = getFragmentsFromReads(
+            readArrays, defaultFragmentLength, extendPairedEnds,
+            maxPairedFragmentLength)
+    else:
+        fragmentStart, fragmentEnd, keep = getFragmentsWithFunction(
+            reads, fragmentFromRead_func, defaultFragmentLength,
+            extendPairedEnds, maxPairedFragmentLength)
+
+    if minMappingQuality:
+        keep &= mapq >= minMappingQuality
+
+    # get rid of duplicate reads that have same position on each of the 
+    # pairs. A read is a duplicate of the previous read that was kept,
+    # thus of the previous read that passed the other filters.
+    if ignoreDuplicates:
+        index = np.flatnonzero(keep)
+        key = np.column_stack((pos[index], pnext[index], flag[index] & 16))
+        duplicate = np.zeros(len(index), dtype=bool)
+        duplicate[1:] = (key[1:] == key[:-1]).all(axis=1)
+        keep[index[duplicate]] = False
+
+    return readArrays, fragmentStart, fragmentEnd, keep
+
+
+def getCoverageIndex(bamHandle, chrom, defaultFragmentLength,
+                     extendPairedEnds=True, maxPairedFragmentLength=None,
+                     minMappingQuality=None, ignoreDuplicates=False):
+    """
+    Returns the coverage index (see coverageIndex.buildIndex) of the
+    bam file for the given read processing options, or None if there
+    is no such index or if it does not contain the chromosome.
+
+    >>> test = Tester()
+    >>> getCoverageIndex(pysam.Samfile(test.bamFile2), '3R', 0) is None
+    True
+    """
+    options = coverageIndex.getIndexOptions(
+        defaultFragmentLength, extendPairedEnds, maxPairedFragmentLength,
+        minMappingQuality, ignoreDuplicates)
+    index = coverageIndex.findIndex(bamHandle.filename, options)
+    if index is None or not index.hasChrom(chrom):
+        return None
+    return index
+
+
+def indexApplies(index, *positions):
+    """
+    Returns True if the coverage index (see getCoverageIndex) can
+    count the bins that begin at the given positions. An index to
+    which other bam files were added can not be replaced by the bam
+    file, which lacks their reads.
+    """
+    if index is None:
+        return False
+    if index.isAligned(*positions):
+        return True
+    if len(index.bamFiles) > 1:
+        raise NameError("The coverage index of {} includes other bam files, "
+                        "use bins that are multiples of its resolution "
+                        "({} bp)".format(index.bamFiles[0]['fileName'],
+                                         index.resolution))
+    return False
+
+
 def getCoverageOfRegion(bamHandle, chrom, start, end, tileSize, 
                         defaultFragmentLength, extendPairedEnds=True, 
                         zerosToNans=True, maxPairedFragmentLength=None,
                         minMappingQuality=None, ignoreDuplicates=False,
-                        fragmentFromRead_func = getFragmentFromRead):
+                        fragmentFromRead_func = getFragmentFromRead,
+                        blackList=None):
     """
     Returns a numpy array that corresponds to the number of reads 
     that overlap with each tile.
 
+    The tiles that overlap the blackList (see blackList.BlackList) are
+    nan. The reads inside them are not fetched, thus their fragments
+    are not counted in the neighboring tiles either.
+
     >>> test = Tester()
 
     For this case the reads are length 36. For the positions given
@@ -282,6 +591,49 @@ def getCoverageOfRegion(bamHandle, chrom, start, end, tileSize,
     Test long regions
     >>> getCoverageOfRegion(pysam.Samfile(test.bamFile2), '3R', 0, 200, 200, 0, False)
     array([ 4.])
+
+    Test blacklisted tiles
+    >>> getCoverageOfRegion(pysam.Samfile(test.bamFile2), '3R', 0, 200, 50, 0, False,
+    ...                     zerosToNans=False,
+    ...                     blackList=BlackList(test.blackListFile))
+    array([ nan,  nan,   1.,   2.])
+    """
+    counts, masked = getCoverageCounts(
+        bamHandle, chrom, start, end, tileSize, defaultFragmentLength,
+        extendPairedEnds, maxPairedFragmentLength, minMappingQuality,
+        ignoreDuplicates, fragmentFromRead_func, blackList)
+    coverage = counts.astype('float64')
+
+    # change zeros to NAN
+    if zerosToNans:
+        coverage[counts == 0] = np.nan
+    if masked is not None:
+        coverage[masked] = np.nan
+
+    return coverage
+
+
+def getCoverageCounts(bamHandle, chrom, start, end, tileSize,
+                      defaultFragmentLength, extendPairedEnds=True,
+                      maxPairedFragmentLength=None, minMappingQuality=None,
+                      ignoreDuplicates=False,
+                      fragmentFromRead_func=getFragmentFromRead,
+                      blackList=None):
+    """
+    Same as getCoverageOfRegion, but the number of fragments of each
+    tile is returned as integers of the smallest type that holds them
+    (see getCountDtype), which takes a fourth of the memory of the
+    float coverage for most data. The tiles that overlap the blackList
+    are returned as a boolean array (None without blackList) and
+    have zero counts.
+
+    >>> test = Tester()
+    >>> getCoverageCounts(pysam.Samfile(test.bamFile2), '3R', 0, 200, 50, 0,
+    ...                   False)
+    (array([0, 1, 1, 2], dtype=uint16), None)
+    >>> getCoverageCounts(pysam.Samfile(test.bamFile2), '3R', 0, 200, 50, 0,
+    ...                   False, blackList=BlackList(test.blackListFile))
+    (array([0, 0, 1, 2], dtype=uint16), array([ True,  True, False, False], dtype=bool))
     """
     if not fragmentFromRead_func:
         fragmentFromRead_func = getFragmentFromRead
@@ -292,59 +644,114 @@ def getCoverageOfRegion(bamHandle, chrom, start, end, tileSize,
             print  "length of region ({}) is not a multiple of tileSize {}\nThe region is being chopped to length {} bp".format(length, tileSize, newLength)
 
     vectorLength = length/tileSize
-    coverage   = np.zeros( vectorLength, dtype='float64' )
 
     startTime = time.time()
-    #caching seems faster. TODO: profile the function
-    c = 0
-    if chrom in bamHandle.references:
-        reads = [ r for r in bamHandle.fetch( chrom, start, end )]
-    else:
+    if chrom not in bamHandle.references:
         raise NameError( "chromosome {} not found in bam file".format(chrom) )
 
-    prev_start_pos = None # to store the start positions
-                          # of previous processed read pair
+    masked = None
+    if blackList is not None:
+        tileStarts = start + np.arange(vectorLength) * tileSize
+        masked = blackList.maskBins(chrom, tileStarts, tileStarts + tileSize)
+        if masked.all():
+            return np.zeros(vectorLength, dtype=getCountDtype(0)), masked
+
+    if fragmentFromRead_func is getFragmentFromRead:
+        index = getCoverageIndex(bamHandle, chrom, defaultFragmentLength,
+                                 extendPairedEnds, maxPairedFragmentLength,
+                                 minMappingQuality, ignoreDuplicates)
+        if indexApplies(index, start, tileSize):
+            counts = index.getCoverage(chrom, start,
+                                       start + vectorLength * tileSize,
+                                       tileSize)
+            if masked is not None:
+                counts[masked] = 0
+            return counts, masked
+
+    reads = fetchReads(bamHandle, chrom, start, end, blackList, tileSize)
+
+    fragmentStart, fragmentEnd, keep = getFragmentsOfReads(
+        reads, defaultFragmentLength, extendPairedEnds,
+        maxPairedFragmentLength, minMappingQuality, ignoreDuplicates,
+        fragmentFromRead_func)[1:]
+
+    vectorStart = np.clip((fragmentStart[keep] - start) // tileSize,
+                          0, vectorLength)
+    # fragments ending before the region start (e.g. pairs
+    # with negative tlen) must not wrap around the vector
+    vectorEnd = np.clip(-((start - fragmentEnd[keep]) // tileSize),
+                        0, vectorLength)
+    # each fragment adds one to the tiles [vectorStart, vectorEnd),
+    # which is +1 at vectorStart and -1 at vectorEnd of the differences
+    overlap = vectorStart < vectorEnd
+    difference = np.bincount(vectorStart[overlap], minlength=vectorLength + 1)
+    difference -= np.bincount(vectorEnd[overlap], minlength=vectorLength + 1)
+
+    c = int(keep.sum())
+    # no tile is covered by more than the fragments kept. The sums are
+    # accumulated in the count type, where the negative differences
+    # wrap around but the partial sums, being counts, are exact
+    counts = np.cumsum(difference[:vectorLength], dtype=getCountDtype(c))
+    if masked is not None:
+        # the reads of the masked tiles at the edges of the unmasked
+        # parts are fetched
+        counts[masked] = 0
+
+    perfLog.countReads(len(reads), c)
+    if debug:
+        endTime = time.time()
+        print "%s,  processing %s (%.1f per sec) reads @ %s:%s-%s" % (multiprocessing.current_process().name, c, c / (endTime - startTime) ,chrom, start, end)
 
-    for read in reads:
-        if minMappingQuality and read.mapq < minMappingQuality:
-            continue
+    return counts, masked
 
-        # get rid of duplicate reads that have same position on each of the 
-        # pairs
-        if ignoreDuplicates and prev_start_pos  \
-                and prev_start_pos == (read.pos, read.pnext, read.is_reverse):
-            continue
 
-        try:
-            fragmentStart, fragmentEnd = fragmentFromRead_func(read, defaultFragmentLength, 
-                                                               extendPairedEnds,
-                                                               maxPairedFragmentLength=maxPairedFragmentLength)
-            fragmentLength = fragmentEnd - fragmentStart
-            if fragmentLength == 0:
-                fragmentLength = defaultFragmentLength
-
-            vectorStart = max( (fragmentStart - start)/tileSize, 0)
-            vectorEnd   = min( np.ceil(float(fragmentEnd   - start)/tileSize).astype('int'), 
-                               vectorLength)
-
-            coverage[vectorStart:vectorEnd] +=  1
-        except TypeError:
-            # the getFragmentFromRead functions returns None in some cases.
-            # Those cases are to be skiped, hence the continue line.
-            continue
+def getCountDtype(maxCount):
+    """
+    Returns the smallest unsigned integer type for counts up to
+    maxCount.
 
-        prev_start_pos = (read.pos, read.pnext, read.is_reverse)
-        c += 1
+    >>> getCountDtype(100), getCountDtype(100000)
+    (dtype('uint16'), dtype('uint32'))
+    """
+    for dtype in ('uint16', 'uint32'):
+        if maxCount <= np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    return np.dtype('uint64')
 
-    if debug:
-        endTime = time.time()
-        print "%s,  processing %s (%.1f per sec) reads @ %s:%s-%s" % (multiprocessing.current_process().name, c, c / (endTime - startTime) ,chrom, start, end)
+def getFragmentsWithFunction(reads, fragmentFromRead_func, defaultFragmentLength,
+                             extendPairedEnds=True, maxPairedFragmentLength=None):
+    """
+    Like getFragmentsFromReads, for fragment functions other than
+    getFragmentFromRead (e.g. the fragment centers of bam2nucleosome).
+    The function is called once per read; the reads for which it
+    returns None are not valid.
 
-    # change zeros to NAN
-    if zerosToNans:
-        coverage[coverage == 0] = np.nan
+    >>> test = Tester()
+    >>> reads = [test.getRead("paired-forward"), test.getRead("single-forward")]
+    >>> def forwardOnly(read, length, extend, maxPairedFragmentLength=None):
+    ...     if read.is_paired:
+    ...         return None
+    ...     return (read.pos, read.pos + length)
+    >>> getFragmentsWithFunction(reads, forwardOnly, 10)
+    (array([      0, 5001491]), array([      0, 5001501]), array([False,  True], dtype=bool))
+    """
+    fragmentStart = np.zeros(len(reads), dtype='int64')
+    fragmentEnd = np.zeros(len(reads), dtype='int64')
+    valid = np.zeros(len(reads), dtype=bool)
+    for index, read in enumerate(reads):
+        try:
+            fragment = fragmentFromRead_func(read, defaultFragmentLength,
+                                             extendPairedEnds,
+                                             maxPairedFragmentLength=maxPairedFragmentLength)
+            fragmentStart[index] = fragment[0]
+            fragmentEnd[index] = fragment[1]
+        except TypeError:
+            # the fragment functions return None in some cases.
+            # Those reads are skipped.
+            continue
+        valid[index] = True
+    return fragmentStart, fragmentEnd, valid
 
-    return coverage 
 
 def getSmoothRange(tileIndex, tileSize, smoothRange, maxPosition):
     
@@ -395,6 +802,53 @@ def getSmoothRange(tileIndex, tileSize, smoothRange, maxPosition):
     indexEnd   = min( maxPosition, tileIndex + smoothTilesRight )
     return (indexStart, indexEnd)
 
+def getSmoothCoverage(coverage, tileSize, smoothRange):
+    """
+    Returns the coverage of each tile averaged over the tiles of its
+    smooth range (see getSmoothRange), which is truncated at the
+    edges of the coverage vector. The coverage can be a matrix, in
+    which case each row is smoothed. The averages are computed from
+    cumulative sums, thus the time does not depend on the smooth
+    range. As for numpy.mean, the average of a range that contains a
+    nan is nan. Smooth ranges shorter than two tiles leave the
+    coverage as it is.
+
+    >>> getSmoothCoverage(np.array([1.0, 2, 3, 4, 11]), 10, 30)
+    array([ 1.5,  2. ,  3. ,  6. ,  7.5])
+    >>> getSmoothCoverage(np.array([[1.0, np.nan, 3, 4, 5, 6]]), 1, 3)
+    array([[ nan,  nan,  nan,  4. ,  5. ,  5.5]])
+    >>> c = np.random.randint(0, 10, 50).astype('float64')
+    >>> np.allclose(getSmoothCoverage(c, 10, 45),
+    ... [np.mean(c[slice(*getSmoothRange(i, 10, 45, 50))])
+    ...  for i in range(50)])
+    True
+    """
+    coverage = np.asarray(coverage, dtype='float64')
+    smoothTiles = int(smoothRange/tileSize)
+    if smoothTiles <= 1:
+        return coverage.copy()
+
+    smoothTilesSide = float(smoothTiles - 1) / 2
+    smoothTilesLeft = int(np.ceil(smoothTilesSide))
+    smoothTilesRight = int(np.floor(smoothTilesSide)) + 1
+
+    length = coverage.shape[-1]
+    tileIndex = np.arange(length)
+    indexStart = np.clip(tileIndex - smoothTilesLeft, 0, length)
+    indexEnd = np.clip(tileIndex + smoothTilesRight, 0, length)
+
+    isNan = np.isnan(coverage)
+    zeros = np.zeros(coverage.shape[:-1] + (1,))
+    cumCoverage = np.concatenate(
+        [zeros, np.cumsum(np.where(isNan, 0, coverage), axis=-1)], axis=-1)
+    cumNans = np.concatenate([zeros, np.cumsum(isNan, axis=-1)], axis=-1)
+
+    smoothCoverage = (cumCoverage[..., indexEnd] -
+                      cumCoverage[..., indexStart]) / (indexEnd - indexStart)
+    smoothCoverage[cumNans[..., indexEnd] > cumNans[..., indexStart]] = np.nan
+    return smoothCoverage
+
+
 class Tester():
     def __init__( self ):
         """
@@ -416,6 +870,7 @@ class Tester():
         self.bamFile1  = self.root + "testA.bam"
         self.bamFile2  = self.root + "testB.bam"
         self.bamFile_PE  = self.root + "test_paired2.bam"
+        self.blackListFile = self.root + "test_blacklist.bed"
         self.chrom = '3R'
         bam = pysam.Samfile(self.bamFile1)
         global debug
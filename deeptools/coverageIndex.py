@@ -0,0 +1,496 @@
+import hashlib
+import json
+import os
+import struct
+import numpy as np
+
+# own modules
+import bamHandler
+import countReadsPerBin
+import fileHandles
+import mapReduce
+import perfLog
+
+debug = 0
+
+# first bytes of the coverage index files
+MAGIC = "DTCOVIDX"
+VERSION = 1
+# arrays kept for each chromosome (see CoverageIndex)
+ARRAYS = ('starts', 'ends', 'bases')
+
+
+def getIndexOptions(defaultFragmentLength, extendPairedEnds=True,
+                    maxPairedFragmentLength=None, minMappingQuality=None,
+                    ignoreDuplicates=False):
+    """
+    Returns the read processing options that define the counts of a
+    coverage index (see getCoverageOfRegion), such that equivalent
+    options give equal dictionaries.
+
+    >>> getIndexOptions(200) == getIndexOptions(200, True, 400, 0)
+    True
+    >>> getIndexOptions(0, False)['maxPairedFragmentLength']
+    0
+    """
+    if extendPairedEnds != True:
+        maxPairedFragmentLength = 0
+    elif not maxPairedFragmentLength:
+        maxPairedFragmentLength = 2 * defaultFragmentLength \
+            if defaultFragmentLength > 0 else 1000
+    return {'fragmentLength': int(defaultFragmentLength),
+            'extendPairedEnds': extendPairedEnds == True,
+            'maxPairedFragmentLength': int(maxPairedFragmentLength),
+            'minMappingQuality': int(minMappingQuality or 0),
+            'ignoreDuplicates': bool(ignoreDuplicates)}
+
+
+def getIndexFileName(bamFile, options):
+    """
+    Returns the name of the coverage index of bamFile for the given
+    options. The index is kept next to the bam file, and a bam file
+    can have one index for each set of options.
+
+    >>> getIndexFileName("a.bam", getIndexOptions(200))
+    'a.bam.8f0b78fc.covidx'
+    """
+    key = hashlib.md5(json.dumps(options, sort_keys=True)).hexdigest()
+    return "{}.{}.covidx".format(bamFile, key[:8])
+
+
+def findIndex(bamFile, options):
+    """
+    Returns the CoverageIndex of bamFile for the given options, or
+    None if there is no such index or if the bam file changed after
+    the index was built. The index is opened once per process.
+    """
+    return fileHandles.getHandle(getIndexFileName(bamFile, options),
+                                 openIndex)
+
+
+def getMappedReads(bamHandle, options, chrsToSkip=[]):
+    """
+    Returns the mapped reads of the bam file, excluding those of the
+    chromosomes in chrsToSkip. If the bam file has a coverage index for
+    the options, the reads of the bam files added to the index (see
+    addToIndex) are included, as they are in the coverage.
+
+    >>> test = countReadsPerBin.Tester()
+    >>> bamHandle = bamHandler.openBam(test.bamFile1)
+    >>> getMappedReads(bamHandle, getIndexOptions(0))
+    2
+    >>> getMappedReads(bamHandle, getIndexOptions(0), ['3R'])
+    0
+    """
+    index = findIndex(bamHandle.filename, options)
+    if index is not None:
+        return index.getMapped(chrsToSkip)
+    if not chrsToSkip:
+        return int(bamHandle.mapped)
+    chromMapped = bamHandler.getMappedPerChrom(bamHandle.filename)
+    return sum([mapped for chrom, mapped in chromMapped.items()
+                if chrom not in chrsToSkip])
+
+
+def openIndex(fileName):
+    if not os.path.isfile(fileName):
+        return None
+    index = CoverageIndex(fileName)
+    if not index.isCurrent():
+        if debug:
+            print "{} is older than its bam files, it is not used".format(
+                fileName)
+        return None
+    return index
+
+
+def numberOfBins(length, resolution):
+    return -(-length // resolution)
+
+
+class CoverageIndex(object):
+    """
+    Reads the coverage index files written by buildIndex.
+
+    The file starts with MAGIC, the length of a JSON header, the header
+    and then, for each chromosome, three arrays of uint32 with one value
+    per boundary between the bins of the index resolution (thus the
+    number of bins plus one): the number of fragments that start before
+    the boundary ('starts'), the number of fragments that end before or
+    at the boundary ('ends') and the number of bases covered by the
+    fragments before the boundary ('bases'). The arrays are cumulative
+    modulo 2**32, such that the differences between two boundaries,
+    which are computed with uint32 as well, are exact. The arrays are
+    memory mapped, thus only the regions that are read are loaded.
+
+    The fragments that overlap a region starting and ending at bin
+    boundaries are those that start before its end minus those that
+    end before its start.
+    """
+
+    def __init__(self, fileName):
+        self.fileName = fileName
+        handle = open(fileName, 'rb')
+        if handle.read(len(MAGIC)) != MAGIC:
+            raise NameError("{} is not a coverage index".format(fileName))
+        headerLength = struct.unpack('<Q', handle.read(8))[0]
+        self.header = json.loads(handle.read(headerLength))
+        handle.close()
+        self.resolution = self.header['resolution']
+        self.options = self.header['options']
+        self.bamFiles = self.header['bamFiles']
+        self.mapped = sum([bam['mapped'] for bam in self.bamFiles])
+        self.chromSizes = [(chrom, length) for chrom, length, offset
+                           in self.header['chromosomes']]
+        self.offsets = dict([(chrom, (length, offset)) for chrom, length,
+                             offset in self.header['chromosomes']])
+        self.data = None
+        if os.path.getsize(fileName) > getDataOffset(headerLength):
+            self.data = np.memmap(fileName, dtype='<u4', mode='r',
+                                  offset=getDataOffset(headerLength))
+
+    def isCurrent(self):
+        """
+        Returns False if any of the bam files of the index is missing
+        or was modified after the index was built.
+        """
+        for bam in self.bamFiles:
+            if not os.path.isfile(bam['fileName']):
+                return False
+            stat = os.stat(bam['fileName'])
+            if (stat.st_size, int(stat.st_mtime)) != \
+                    (bam['size'], bam['mtime']):
+                return False
+        return True
+
+    def getMapped(self, chrsToSkip=[]):
+        """
+        Returns the mapped reads of all the bam files of the index,
+        excluding those of the chromosomes in chrsToSkip.
+        """
+        mapped = self.mapped
+        for bam in self.bamFiles:
+            for chrom in chrsToSkip:
+                mapped -= bam.get('chromMapped', {}).get(chrom, 0)
+        return mapped
+
+    def hasChrom(self, chrom):
+        return chrom in self.offsets
+
+    def isAligned(self, *positions):
+        """
+        Returns True if the positions (region starts and tile sizes)
+        are multiples of the index resolution.
+        """
+        return all([position % self.resolution == 0
+                    for position in positions])
+
+    def getArrays(self, chrom):
+        length, offset = self.offsets[chrom]
+        boundaries = numberOfBins(length, self.resolution) + 1
+        return self.data[offset:offset + len(ARRAYS) * boundaries].reshape(
+            len(ARRAYS), boundaries)
+
+    def countFragments(self, chrom, starts, ends):
+        """
+        Returns the number of fragments that overlap each of the
+        regions given by the starts and ends arrays, which have to be
+        at bin boundaries (or at the chromosome end), as uint32.
+        """
+        length = self.offsets[chrom][0]
+        bins = numberOfBins(length, self.resolution)
+        cumStarts, cumEnds = self.getArrays(chrom)[:2]
+        startBins = np.minimum(np.asarray(starts) // self.resolution, bins)
+        endBins = np.minimum(-(-np.asarray(ends) // self.resolution), bins)
+        return cumStarts[endBins] - cumEnds[startBins]
+
+    def getCoverage(self, chrom, start, end, tileSize):
+        """
+        Returns the number of fragments that overlap each tile of
+        the region, like countReadsPerBin.getCoverageCounts.
+        """
+        tileStarts = start + np.arange((end - start) / tileSize) * tileSize
+        return self.countFragments(chrom, tileStarts, tileStarts + tileSize)
+
+    def getBaseCoverage(self, chrom, start, end):
+        """
+        Returns the coverage of each base of the region, which is
+        the mean coverage of the bin of the base. The positions out
+        of the chromosome have zero coverage.
+        """
+        length = self.offsets[chrom][0]
+        coverage = np.zeros(end - start)
+        first, last = max(start, 0), min(end, length)
+        if first >= last:
+            return coverage
+
+        firstBin = first // self.resolution
+        lastBin = (last - 1) // self.resolution + 1
+        cumBases = self.getArrays(chrom)[2][firstBin:lastBin + 1]
+        boundaries = np.minimum(
+            np.arange(firstBin, lastBin + 1) * self.resolution, length)
+        binCoverage = np.diff(cumBases).astype('float64') / \
+            np.diff(boundaries)
+        coverage[first - start:last - start] = binCoverage[
+            np.arange(first, last) // self.resolution - firstBin]
+        return coverage
+
+    def close(self):
+        self.data = None
+
+
+def getDataOffset(headerLength):
+    """
+    The arrays start after the header, at a multiple of 8 bytes.
+    """
+    offset = len(MAGIC) + 8 + headerLength
+    return offset + (-offset % 8)
+
+
+def countFragments_wrapper(args):
+    return countFragments_worker(*args)
+
+
+def countFragments_worker(chrom, start, end, bamFile, resolution, options):
+    """
+    Counts the fragments of the reads that start in the region, for
+    each bin of the chromosome: the fragments that start in the bin,
+    those whose last base is in the bin and the bases of the bin
+    covered by the fragments. Returns the chromosome, the first bin
+    and the three arrays of uint32, or None if there are no fragments.
+
+    >>> test = countReadsPerBin.Tester()
+    >>> options = getIndexOptions(0, False)
+    >>> chrom, first, starts, ends, bases = countFragments_worker(
+    ... '3R', 0, 200, test.bamFile2, 50, options)
+    >>> first, list(starts), list(ends), list(bases)
+    (1, [1, 1, 2], [1, 1, 2], [50, 50, 100])
+    """
+    bamHandle = fileHandles.getBam(bamFile)
+    length = bamHandle.lengths[list(bamHandle.references).index(chrom)]
+    reads = [r for r in bamHandle.fetch(chrom, start, end)]
+
+    readArrays, fragmentStart, fragmentEnd, keep = \
+        countReadsPerBin.getFragmentsOfReads(
+            reads, options['fragmentLength'], options['extendPairedEnds'],
+            options['maxPairedFragmentLength'],
+            options['minMappingQuality'], options['ignoreDuplicates'])
+
+    # each read is counted by the region in which it starts
+    pos = readArrays[0]
+    keep &= (pos >= start) & (pos < end)
+    fragmentStart = np.maximum(fragmentStart[keep], 0)
+    fragmentEnd = np.minimum(fragmentEnd[keep], length)
+    # fragments that end before they start (pairs with negative
+    # tlen) do not cover any base
+    valid = fragmentStart < fragmentEnd
+    fragmentStart, fragmentEnd = fragmentStart[valid], fragmentEnd[valid]
+    perfLog.countReads(len(reads), len(fragmentStart))
+    if not len(fragmentStart):
+        return None
+
+    startBins = fragmentStart // resolution
+    endBins = (fragmentEnd - 1) // resolution
+    first = startBins.min()
+    bins = endBins.max() + 1 - first
+    starts = np.bincount(startBins - first, minlength=bins)
+    ends = np.bincount(endBins - first, minlength=bins)
+
+    # a bin is covered by the fragments that started before or in it
+    # and that did not end before it. The bases not covered are those
+    # before the start of the fragments that start in the bin and
+    # those after the end of the fragments that end in it.
+    coverage = np.cumsum(starts) - np.cumsum(ends) + ends
+    notCovered = np.bincount(startBins - first, minlength=bins,
+                             weights=fragmentStart - startBins * resolution) + \
+        np.bincount(endBins - first, minlength=bins,
+                    weights=(endBins + 1) * resolution - fragmentEnd)
+    bases = coverage * resolution - np.rint(notCovered).astype('int64')
+
+    return (chrom, int(first), starts.astype('uint32'),
+            ends.astype('uint32'), bases.astype('uint32'))
+
+
+def buildIndex(bamFile, options, resolution=50, fileName=None,
+               numberOfProcessors=1, checkpointDir=None, verbose=False):
+    """
+    Counts the fragments of bamFile, processed with the given options
+    (see getIndexOptions), at the given resolution and writes the
+    coverage index into fileName (by default, next to the bam file,
+    where getCoverageOfRegion, countReadsInBins and the heatmapper
+    find it). The file is written under a temporary name and renamed
+    at the end, thus an interrupted build never leaves an index.
+
+    >>> test = countReadsPerBin.Tester()
+    >>> import tempfile
+    >>> fileName = tempfile.NamedTemporaryFile(suffix='.covidx').name
+    >>> buildIndex(test.bamFile2, getIndexOptions(0, False), 10, fileName)
+    >>> index = CoverageIndex(fileName)
+    >>> index.getCoverage('3R', 0, 200, 50)
+    array([0, 1, 1, 2], dtype=uint32)
+    >>> index.getBaseCoverage('3R', 145, 155)
+    array([ 1.,  1.,  1.,  1.,  1.,  2.,  2.,  2.,  2.,  2.])
+    >>> os.remove(fileName)
+    """
+    if fileName is None:
+        fileName = getIndexFileName(bamFile, options)
+    bamHandle = bamHandler.openBam(bamFile)
+    chromSizes = zip(bamHandle.references, bamHandle.lengths)
+    bamHandle.close()
+    header = {'version': VERSION,
+              'resolution': resolution,
+              'options': options,
+              'bamFiles': [getBamEntry(bamFile)],
+              'chromosomes': []}
+
+    # the offset of the arrays of each chromosome, in uint32
+    offset = 0
+    for chrom, length in chromSizes:
+        header['chromosomes'].append([chrom, length, offset])
+        offset += len(ARRAYS) * (numberOfBins(length, resolution) + 1)
+
+    tempFileName = fileName + ".tmp"
+    handle = open(tempFileName, 'wb')
+    writeHeader(handle, header)
+    for counts in countChromosomes(bamFile, chromSizes, options, resolution,
+                                   numberOfProcessors, checkpointDir,
+                                   verbose):
+        counts.astype('<u4').tofile(handle)
+    handle.close()
+    os.rename(tempFileName, fileName)
+    if verbose:
+        print "coverage index written to {}".format(fileName)
+
+
+def addToIndex(fileName, bamFile, numberOfProcessors=1, checkpointDir=None,
+               verbose=False):
+    """
+    Adds the fragments of bamFile (for example, an extra sequencing
+    lane of the sample) to the coverage index fileName. The fragments
+    are counted with the options and the resolution of the index and
+    added to its counts, and the mapped reads of bamFile are added to
+    those of the index (see CoverageIndex.getMapped). The tools that
+    use the index then give the coverage of all the bam files of the
+    index, without reading them again.
+
+    >>> test = countReadsPerBin.Tester()
+    >>> import tempfile
+    >>> fileName = tempfile.NamedTemporaryFile(suffix='.covidx').name
+    >>> buildIndex(test.bamFile1, getIndexOptions(0, False), 10, fileName)
+    >>> CoverageIndex(fileName).getCoverage('3R', 0, 200, 50)
+    array([0, 0, 1, 1], dtype=uint32)
+    >>> addToIndex(fileName, test.bamFile2)
+    >>> index = CoverageIndex(fileName)
+    >>> index.getCoverage('3R', 0, 200, 50)
+    array([0, 1, 2, 3], dtype=uint32)
+    >>> index.getMapped() == sum([bam['mapped'] for bam in index.bamFiles])
+    True
+    >>> os.remove(fileName)
+    """
+    index = CoverageIndex(fileName)
+    if not index.isCurrent():
+        raise NameError("The bam files of {} changed after the index "
+                        "was built, build it again".format(fileName))
+    if os.path.abspath(bamFile) in [bam['fileName']
+                                    for bam in index.bamFiles]:
+        raise NameError("{} is already in {}".format(bamFile, fileName))
+
+    bamHandle = bamHandler.openBam(bamFile)
+    bamSizes = dict(zip(bamHandle.references, bamHandle.lengths))
+    bamHandle.close()
+    for chrom, length in index.chromSizes:
+        if chrom in bamSizes and bamSizes[chrom] != length:
+            raise NameError("The length of chromosome {} is different "
+                            "in {} and in {}".format(chrom, bamFile,
+                                                     fileName))
+
+    header = dict(index.header)
+    header['bamFiles'] = index.bamFiles + [getBamEntry(bamFile)]
+
+    tempFileName = fileName + ".tmp"
+    handle = open(tempFileName, 'wb')
+    writeHeader(handle, header)
+    # the cumulative counts modulo 2**32 are added element wise
+    for (chrom, length), counts in zip(
+            index.chromSizes,
+            countChromosomes(bamFile, index.chromSizes, index.options,
+                             index.resolution, numberOfProcessors,
+                             checkpointDir, verbose)):
+        (index.getArrays(chrom) + counts).astype('<u4').tofile(handle)
+    handle.close()
+    index.close()
+    os.rename(tempFileName, fileName)
+    if verbose:
+        print "{} added to the coverage index {}".format(bamFile, fileName)
+
+
+def getBamEntry(bamFile):
+    """
+    Returns the description of a bam file kept in the index header:
+    its name, size and modification time, to detect changes, and its
+    mapped reads, in total and per chromosome, for the normalization.
+    """
+    bamHandle = bamHandler.openBam(bamFile)
+    stat = os.stat(bamFile)
+    entry = {'fileName': os.path.abspath(bamFile),
+             'size': stat.st_size,
+             'mtime': int(stat.st_mtime),
+             'mapped': bamHandle.mapped,
+             'chromMapped': bamHandler.getMappedPerChrom(bamFile)}
+    bamHandle.close()
+    return entry
+
+
+def countChromosomes(bamFile, chromSizes, options, resolution,
+                     numberOfProcessors=1, checkpointDir=None, verbose=False):
+    """
+    Counts the fragments of bamFile and yields, for each chromosome
+    of chromSizes, the cumulative arrays of the index (see
+    CoverageIndex). The chromosomes that are not in the bam file
+    have no fragments.
+    """
+    bamHandle = bamHandler.openBam(bamFile)
+    bamChroms = [(chrom, length) for chrom, length in chromSizes
+                 if chrom in bamHandle.references]
+    # about 2e6 reads per chunk
+    readsPerBp = float(max(bamHandle.mapped, 1)) / \
+        max(sum(bamHandle.lengths), 1)
+    genomeChunkLength = int(min(5e6, 2e6 / readsPerBp))
+    genomeChunkLength = max(genomeChunkLength -
+                            genomeChunkLength % resolution, resolution)
+    bamHandle.close()
+
+    res = []
+    if bamChroms:
+        res = mapReduce.imapReduce((bamFile, resolution, options),
+                                   countFragments_wrapper,
+                                   bamChroms,
+                                   genomeChunkLength=genomeChunkLength,
+                                   numberOfProcessors=numberOfProcessors,
+                                   bamFilesList=[bamFile],
+                                   tileSize=resolution,
+                                   checkpointDir=checkpointDir,
+                                   verbose=verbose)
+
+    # the results come in the order of the chromosomes, thus each
+    # chromosome is yielded once the results of the next one arrive
+    results = (result for result in res if result is not None)
+    result = next(results, None)
+    for chrom, length in chromSizes:
+        counts = np.zeros((len(ARRAYS), numberOfBins(length, resolution) + 1),
+                          dtype='uint32')
+        while result is not None and result[0] == chrom:
+            first, starts, ends, bases = result[1:]
+            # the cumulative arrays begin with the boundary before bin 0
+            counts[:, first + 1:first + 1 + len(starts)] += \
+                np.array([starts, ends, bases], dtype='uint32')
+            result = next(results, None)
+        yield np.cumsum(counts, axis=1, dtype='uint32')
+
+
+def writeHeader(handle, header):
+    data = json.dumps(header, sort_keys=True)
+    handle.write(MAGIC)
+    handle.write(struct.pack('<Q', len(data)))
+    handle.write(data)
+    handle.write("\0" * (getDataOffset(len(data)) - handle.tell()))
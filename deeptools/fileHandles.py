@@ -0,0 +1,112 @@
+import os
+import sys
+from collections import OrderedDict
+
+# own modules
+import bamHandler
+
+# handles of the files opened by the current process. They are kept
+# open such that the following tasks of a worker can reuse them
+# instead of opening the files (and loading the indices) again.
+# The handles are kept in the order of their last use.
+_handles = OrderedDict()
+# process that opened the handles
+_pid = None
+# maximum number of handles kept by a process (see getHandle)
+maxHandles = 64
+
+
+def getHandle(fileName, openFunc):
+    """
+    Returns the handle of fileName obtained with openFunc. The file is
+    only opened the first time it is requested by a process, later
+    requests return the same handle.
+
+    Handles inherited from the parent process after a fork are never
+    returned, because the parent and the child would share the file
+    offsets.
+
+    At most maxHandles handles are kept, such that a process that
+    reads many files (for example bamCoverage with many bam files)
+    does not reach the limit of open files. When the limit is
+    reached, the least recently used handle is forgotten and closed.
+    If the handle is still used elsewhere, for example by a task that
+    reads more than maxHandles files, it is only closed once it is no
+    longer referenced.
+
+    >>> bam = getHandle("./test/test_data/test1.bam", bamHandler.openBam)
+    >>> bam is getHandle("./test/test_data/test1.bam", bamHandler.openBam)
+    True
+    >>> closeHandles()
+    """
+    if _pid != os.getpid():
+        resetHandles()
+    key = (openFunc, fileName)
+    if key in _handles:
+        # move the handle to the end of the order of use
+        _handles[key] = _handles.pop(key)
+        return _handles[key]
+
+    while len(_handles) >= max(maxHandles, 1):
+        oldKey, oldHandle = _handles.popitem(last=False)
+        # the only references left are oldHandle and the argument
+        if hasattr(oldHandle, 'close') and sys.getrefcount(oldHandle) <= 2:
+            oldHandle.close()
+        del oldHandle
+    _handles[key] = openFunc(fileName)
+    return _handles[key]
+
+
+def resetHandles():
+    """
+    Forgets the handles opened by other processes. This is the
+    initializer of the mapReduce workers. The handles are not closed
+    because they may still be used by the process that opened them.
+    """
+    global _handles, _pid
+    _handles = OrderedDict()
+    _pid = os.getpid()
+
+
+def closeHandles():
+    """
+    Closes the handles opened by the current process. Handles
+    without a close method (2bit and bigwig readers, blacklists)
+    are closed once they are no longer referenced.
+    """
+    if _pid == os.getpid():
+        for handle in _handles.values():
+            if hasattr(handle, 'close'):
+                handle.close()
+    resetHandles()
+
+
+def openTwoBit(fileName):
+    from bx.seq import twobit
+    return twobit.TwoBitFile(open(fileName))
+
+
+def openBigWig(fileName):
+    from bx.bbi.bigwig_file import BigWigFile
+    return BigWigFile(file=open(fileName, 'rb'))
+
+
+def openBlackList(fileName):
+    from blackList import BlackList
+    return BlackList(fileName)
+
+
+def getBam(bamFile):
+    return getHandle(bamFile, bamHandler.openBam)
+
+
+def getTwoBit(twoBitFile):
+    return getHandle(twoBitFile, openTwoBit)
+
+
+def getBigWig(bigwigFile):
+    return getHandle(bigwigFile, openBigWig)
+
+
+def getBlackList(blackListFile):
+    return getHandle(blackListFile, openBlackList)
@@ -4,68 +4,62 @@ import numpy as np
 def getRatio(tileCoverage, args):
     r"""
     The mapreduce method calls this function
-    for each tile. The parameters (args) are fixed
-    in the main method.
+    with the coverage of the two files (rows)
+    in each tile (columns). The parameters (args)
+    are fixed in the main method.
 
     >>> funcArgs= {'missingDataAsZero': True, 'valueType': 'ratio',
     ... 'scaleFactors': (1,1), 'p1': 0, 'p2': 0}
-    >>> getRatio([10,20], funcArgs)
-    0.5
-    >>> getRatio([0,0], funcArgs)
-    1.0
-    >>> getRatio([np.nan,np.nan], funcArgs)
-    1.0
+    >>> getRatio(np.array([[10, 0, np.nan], [20, 0, np.nan]]), funcArgs)
+    array([ 0.5,  1. ,  1. ])
     >>> funcArgs['missingDataAsZero'] = False
-    >>> getRatio([10,np.nan], funcArgs)
-    nan
+    >>> getRatio(np.array([[10], [np.nan]]), funcArgs)
+    array([ nan])
     >>> funcArgs['valueType'] ='subtract'
-    >>> getRatio([20,10], funcArgs)
-    10
+    >>> getRatio(np.array([[20], [10]]), funcArgs)
+    array([ 10.])
     >>> funcArgs['scaleFactors'] = (1, 0.5)
-    >>> getRatio([10,20], funcArgs)
-    0.0
+    >>> getRatio(np.array([[10], [20]]), funcArgs)
+    array([ 0.])
+    >>> funcArgs = {'missingDataAsZero': True, 'valueType': 'log2',
+    ... 'scaleFactors': (1,1), 'p1': 1, 'p2': 1}
+    >>> getRatio(np.array([[0, 3, 8], [0, 0, 2]]), funcArgs)
+    array([ 0.,  2.,  2.])
     """
-
+    tileCoverage = np.asarray(tileCoverage, dtype='float64')
     if not args['missingDataAsZero']:
         if np.isnan(args['scaleFactors'][0]) or \
                 np.isnan(args['scaleFactors'][1]):
-            return np.nan
+            return np.repeat(np.nan, tileCoverage.shape[1])
 
     value1 = args['scaleFactors'][0] * tileCoverage[0]
     value2 = args['scaleFactors'][1] * tileCoverage[1]
-    # case when both tile coverage counts are zero
-    if (value1 == 0.0 or np.isnan(value1)) and \
-            (value2 == 0.0 or np.isnan(value2)):
-        if args['missingDataAsZero']:
-            if args['valueType'] == 'subtract' or \
-                    args['valueType'] == 'log2' or \
-                    args['valueType'] == 'add':
-                ratio = 0.0
-            else:
-                ratio = 1.00
-        else:
-            ratio = np.nan
-    else:
+    missing1 = (value1 == 0.0) | np.isnan(value1)
+    missing2 = (value2 == 0.0) | np.isnan(value2)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
         if args['valueType'] == 'subtract':
             ratio = value1 - value2
         elif args['valueType'] == 'add':
             ratio = value1 + value2
         else:
             # the pseudocount is only useful when ratios are considered
-            if value2 == 0.0 or np.isnan(value2) or \
-                    value1 == 0.0 or np.isnan(value1):
-                ratio = float(value1 + args['p1']) / (value2 + args['p2'])
-            else:
-                ratio = float(value1) / value2
+            ratio = np.where(missing1 | missing2,
+                             (value1 + args['p1']) / (value2 + args['p2']),
+                             value1 / value2)
 
             if args['valueType'] == 'log2':
-                if ratio == 0:
-                    ratio = np.nan
-                else:
-                    ratio = np.log2(ratio)
-            elif args['valueType'] == 'reciprocal_ratio':
-                # the reciprocal ratio of a/b
-                # is a/b if a/b > 1 else -1* b/a
-                ratio if ratio < 1 else -1.0 / ratio
+                ratio[ratio == 0] = np.nan
+                ratio = np.log2(ratio)
+
+    # case when both tile coverage counts are zero
+    if args['missingDataAsZero']:
+        if args['valueType'] in ('subtract', 'log2', 'add'):
+            ratio[missing1 & missing2] = 0.0
+        else:
+            ratio[missing1 & missing2] = 1.00
+    else:
+        ratio[missing1 & missing2] = np.nan
 
     return ratio
+getRatio.vectorized = True
@@ -2,15 +2,23 @@ import sys
 import gzip
 from collections import OrderedDict
 import numpy as np
-import multiprocessing
 
 # NGS packages
 import pysam
 from bx.intervals.io import GenomicIntervalReader
 
+# own modules
+import coverageIndex
+import mapReduce
+import fileHandles
+import perfLog
+
 
 def compute_sub_matrix_wrapper(args):
-    return heatmapper.compute_sub_matrix_worker(*args)
+    start, end, score_file, regions, matrixCols, parameters = args
+    return heatmapper.compute_sub_matrix_worker(score_file,
+                                                regions[start:end],
+                                                matrixCols, parameters)
 
 
 class heatmapper:
@@ -27,12 +35,16 @@ class heatmapper:
         self.matrixAvgsDict = None
 
     def computeMatrix(self, score_file, regions_file, parameters,
-                      verbose=False):
+                      verbose=False, checkpointDir=None):
         """
         Splits into
         multiple cores the computation of the scores
         per bin for each region (defined by a hash '#'
         in the regions (BED/GFF) file.
+
+        If a checkpointDir is given, the scores of each group of
+        regions are kept in that directory and are reused when
+        the matrix is computed again with the same arguments.
         """
         if parameters['body'] > 0 and \
                 parameters['body'] % parameters['bin size'] > 0:
@@ -59,6 +71,12 @@ class heatmapper:
 
         regionsDict = self.getRegionsAndGroups(regions_file, verbose=verbose)
 
+        # the number of processors does not change the results, thus
+        # it is not sent to the workers (nor used in the checkpoints)
+        workerParameters = dict([(key, value)
+                                 for key, value in parameters.iteritems()
+                                 if key != 'proc number'])
+
         matrixDict = OrderedDict()
         matrixAvgsDict = OrderedDict()
         for label, regions in regionsDict.iteritems():
@@ -66,21 +84,24 @@ class heatmapper:
             mp_args = []
 
             # prepare groups of 400 regions to send to workers.
+            # The regions are sent once to each worker, together with
+            # the other static arguments
             for index in range(0, len(regions), 400):
                 index_end = min(len(regions), index + 400 )
-                mp_args.append((score_file, regions[index:index_end],
-                                matrixCols, parameters))
+                mp_args.append((index, index_end))
 
             if len(mp_args) > 1 and parameters['proc number'] > 1:
                 if parameters['verbose']:
                     print "'{}' total workers: {}, using {} "
                     "processors ".format(label, len(mp_args),
                                          parameters['proc number'])
-                pool = multiprocessing.Pool(parameters['proc number'])
-                res = pool.map_async(compute_sub_matrix_wrapper,
-                                     mp_args).get(9999999)
-            else:
-                res = map(compute_sub_matrix_wrapper, mp_args)
+            res = list(mapReduce.runTasks(
+                compute_sub_matrix_wrapper, mp_args,
+                parameters['proc number'],
+                staticArgs=(score_file, regions, matrixCols,
+                            workerParameters),
+                costs=[end - start for start, end in mp_args],
+                checkpointDir=checkpointDir))
 
             # each worker in the pools returns a tuple containing
             # the submatrix data and the regions that correspond to the
@@ -123,10 +144,9 @@ class heatmapper:
     def compute_sub_matrix_worker(score_file, regions, matrixCols, parameters):
         # read BAM or scores file
         if score_file.endswith(".bam"):
-            bamfile = pysam.Samfile(score_file, 'rb')
+            bamfile = fileHandles.getBam(score_file)
         else:
-            from bx.bbi.bigwig_file import BigWigFile
-            bigwig = BigWigFile(file=open(score_file, 'r') )
+            bigwig = fileHandles.getBigWig(score_file)
         # create an empty to store the matrix values
         subMatrix = np.zeros((len(regions), matrixCols))
         subMatrix[:] = np.NAN
@@ -332,12 +352,33 @@ class heatmapper:
     def coverageFromBam(bamfile, chrom, zones, binSize, avgType):
         start = zones[0][0]
         end = zones[-1][1]
+        # the read coverage can be taken from a coverage index
+        # built without extending the reads. The index only keeps
+        # the mean coverage of its bins, thus it is used for the
+        # mean of bins made of whole index bins
+        if avgType == 'mean':
+            index = coverageIndex.findIndex(
+                bamfile.filename, coverageIndex.getIndexOptions(0, False))
+            if index is not None and index.hasChrom(chrom) and \
+                    heatmapper.zonesAligned(zones, binSize,
+                                            index.resolution):
+                return heatmapper.coverageFromArray(
+                    index.getBaseCoverage(chrom, start, end), zones,
+                    binSize, avgType)
         try:
             valuesArray = np.zeros(end - start)
-            for read in bamfile.fetch(chrom, min(0, start), end):
+            numReads = 0
+            for read in bamfile.fetch(chrom, max(0, start), end):
+                if read.aend is None:
+                    # unmapped read
+                    continue
+                # like the coverage index, the reads cover the
+                # reference from their start to their end
                 indexStart = max(read.pos - start, 0)
-                indexEnd = min(read.pos - start + read.qlen, end - start)
+                indexEnd = min(read.aend - start, end - start)
                 valuesArray[indexStart:indexEnd] += 1
+                numReads += 1
+            perfLog.countReads(numReads, numReads)
         except ValueError:
             sys.stderr.write(
                 "Value out of range for region %s %s %s\n" % (chrom, start, end))
@@ -346,6 +387,27 @@ class heatmapper:
         return heatmapper.coverageFromArray(valuesArray, zones,
                                             binSize, avgType)
 
+    @staticmethod
+    def zonesAligned(zones, binSize, resolution):
+        """
+        Returns True if the binSize and the boundaries and bins
+        of all the zones are multiples of the resolution.
+
+        >>> heatmapper.zonesAligned([(-100, 0, 2), (0, 150, 3)], 50, 50)
+        True
+        >>> heatmapper.zonesAligned([(0, 150, 2)], 75, 50)
+        False
+        """
+        positions = [binSize]
+        for zoneStart, zoneEnd, bins in zones:
+            if bins == 0:
+                continue
+            if (zoneEnd - zoneStart) % bins != 0:
+                return False
+            positions.extend([zoneStart, zoneEnd,
+                              (zoneEnd - zoneStart) / bins])
+        return all([position % resolution == 0 for position in positions])
+
     @staticmethod
     def coverageFromBigWig(bigwig, chrom, zones, binSize, avgType,
                            nansAsZeros=False):
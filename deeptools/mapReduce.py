@@ -1,12 +1,205 @@
+import atexit
+import hashlib
+import heapq
+import importlib
 import multiprocessing
+import multiprocessing.queues
+import os
+import Queue
+import shutil
+import signal
+import sys
+import time
+import traceback
+import tempfile
+import cPickle as pickle
+from collections import deque
+import numpy as np
+
+# own modules
+import fileHandles
+import perfLog
 
 debug = 0
 
+# process pool shared by all the mapReduce calls of a run.
+# It is created on first use and closed when the interpreter exits.
+_pool = None
+
+# executor that runs the tasks instead of the local process pool,
+# for example a remoteExecutor.Coordinator that sends them to
+# agents on other machines (see setExecutionOptions)
+executor = None
+
+# context (static arguments) of the tasks run by a worker
+# and the file from which it was loaded
+_contextFile = None
+_context = None
+
+# maximum number of seconds that a task may run before its worker is
+# considered hung and killed (None to wait forever) and number of
+# times that a failed task is run again before giving up
+taskTimeout = None
+taskRetries = 2
+
+# number of tasks per worker that may be sent ahead of the first
+# task whose result has not been returned yet (see scheduleTasks)
+tasksAhead = 4
+
+# queue in which the workers of the local
+# pool announce the tasks they start
+_started = None
+
+
+def getPool(numberOfProcessors):
+    """
+    Returns the process pool shared by all the mapReduce
+    calls. The pool is only created once and is reused until
+    a different number of processors is requested or
+    closePool is called.
+
+    Because the workers are forked when the pool is created,
+    any module level variable that the workers need has to be
+    set before the first call to this function, otherwise
+    closePool has to be called to get new workers.
+
+    Each worker keeps its own file handles (see fileHandles),
+    which are opened by the first task that needs them. Workers
+    that die are replaced by the pool.
+
+    >>> getPool(2) is getPool(2)
+    True
+    >>> closePool()
+    """
+    global _pool
+    if _pool is not None and _pool.size() != numberOfProcessors:
+        closePool()
+
+    if _pool is None:
+        _pool = LocalExecutor(numberOfProcessors)
+
+    return _pool
+
+
+def closePool():
+    """
+    Closes the shared process pool (if any) and waits for
+    the workers to finish.
+    """
+    global _pool
+    if _pool is not None:
+        _pool.close()
+    _pool = None
+
+atexit.register(closePool)
+
+
+class LocalExecutor(object):
+    """
+    Runs the tasks in a multiprocessing pool of the local machine.
+
+    The executors used by scheduleTasks run one task per worker
+    and, besides apply_async, which may return None if the failed
+    tasks also reach the callback, have the following methods: size
+    returns the number of workers, startedTasks returns the
+    (index, part, attempt, worker) of the tasks that the workers
+    started since the last call, aliveWorkers returns the
+    workers that are alive and killWorker stops a worker. Here,
+    the workers are identified by their process id.
+    """
+
+    def __init__(self, numberOfProcessors):
+        # unlike multiprocessing.Queue, SimpleQueue writes at once,
+        # thus the announcements of workers that die are not lost
+        self.started = multiprocessing.queues.SimpleQueue()
+        self.numberOfProcessors = numberOfProcessors
+        self.pool = multiprocessing.Pool(numberOfProcessors,
+                                         initializer=initWorker,
+                                         initargs=(self.started,))
+
+    def size(self):
+        return self.numberOfProcessors
+
+    def apply_async(self, func, args, callback=None):
+        return self.pool.apply_async(func, args, callback=callback)
+
+    def startedTasks(self):
+        started = []
+        while not self.started.empty():
+            started.append(self.started.get())
+        return started
+
+    def aliveWorkers(self):
+        return set([worker.pid for worker in
+                    multiprocessing.active_children()])
+
+    def killWorker(self, pid):
+        try:
+            os.kill(pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+    def close(self):
+        """
+        Closes the pool and waits for the workers to finish. If
+        the pool still has tasks, which happens when tasks are
+        abandoned after an error or were lost with a dead worker,
+        the workers are terminated.
+        """
+        if self.pool._cache:
+            self.pool.terminate()
+        else:
+            self.pool.close()
+        self.pool.join()
+
+
+def initWorker(started):
+    """
+    Initializer of the pool workers.
+    """
+    global _started
+    _started = started
+    fileHandles.resetHandles()
+
+
+def setExecutionOptions(args):
+    """
+    Sets how the tasks are run from the command line arguments
+    taskTimeout, taskRetries, coordinatorAddress and perfLog (see
+    parserCommon.getParentArgParse).
+
+    If a coordinatorAddress is given, the tasks are sent to the
+    agents (see bin/mapReduceAgent) that connect to that address,
+    instead of being run by the local process pool.
+    """
+    global taskTimeout, taskRetries, executor
+    taskTimeout = args.taskTimeout
+    taskRetries = args.taskRetries
+    if args.perfLog:
+        perfLog.openLog(args.perfLog)
+    if args.coordinatorAddress:
+        import remoteExecutor
+        executor = remoteExecutor.Coordinator(
+            remoteExecutor.parseAddress(args.coordinatorAddress),
+            remoteExecutor.getAuthKey())
+        atexit.register(executor.close)
+
 
 def mapReduce(staticArgs, func, chromSize,
               genomeChunkLength=None,
               region=None,
+              regions=None,
+              blackListFileName=None,
               numberOfProcessors=4,
+              bamFilesList=None,
+              tileSize=1,
+              skipEmptyRegions=False,
+              splitTask=None,
+              mergeResults=None,
+              moduleGlobals=None,
+              checkpointDir=None,
+              saveResult=None,
+              loadResult=None,
               verbose=False):
 
     """
@@ -19,7 +212,8 @@ def mapReduce(staticArgs, func, chromSize,
      chrom, start, end, staticArgs
 
     The *arg* are static, *pickable* variables that need to be sent
-    to workers.
+    to workers. They are sent only once to each worker, together
+    with the moduleGlobals (see scheduleTasks).
 
     The genome chunk length corresponds to a fraction of the genome, in bp,
     that is send to each of the workers for processing.
@@ -27,13 +221,721 @@ def mapReduce(staticArgs, func, chromSize,
     Depending on the type of process a larger or shorter regions may be
     preferred
 
+    If a list of bam files is given, the genome chunks are not of
+    equal length. Instead, the read density found in the bam
+    indices is used to make chunks that contain roughly the same
+    number of reads (see getDensityChunks).
+
     :param chromSize: A list of duples containing the chromome
                       name and its length
     :param region: The format is chr:start:end
+    :param regions: list of (chrom, start, end) intervals to which
+                    the chunks are restricted (see getRegionChunks).
+    :param blackListFileName: BED file of regions to exclude. The
+                              chunks inside them are not processed.
+    :param bamFilesList: bam files used to balance the chunks
+    :param tileSize: the chunk boundaries are multiples of this value
+    :param skipEmptyRegions: if set, regions without reads are not
+                             sent to the workers.
+    :param splitTask, mergeResults: functions used to split the
+                    genome chunks that are waiting when workers
+                    become idle (see scheduleTasks).
+    :param moduleGlobals: dictionary of variables to set in the
+                          module of func before the workers run it.
+    :param checkpointDir: directory where the result of each genome
+                          chunk is saved, such that a rerun only
+                          processes the missing chunks (see runTasks).
+    :param saveResult, loadResult: functions to save and load the
+                                   results in the checkpointDir.
     """
+    return list(imapReduce(staticArgs, func, chromSize,
+                           genomeChunkLength=genomeChunkLength,
+                           region=region,
+                           regions=regions,
+                           blackListFileName=blackListFileName,
+                           numberOfProcessors=numberOfProcessors,
+                           bamFilesList=bamFilesList,
+                           tileSize=tileSize,
+                           skipEmptyRegions=skipEmptyRegions,
+                           splitTask=splitTask,
+                           mergeResults=mergeResults,
+                           moduleGlobals=moduleGlobals,
+                           checkpointDir=checkpointDir,
+                           saveResult=saveResult,
+                           loadResult=loadResult,
+                           verbose=verbose))
+
+
+def imapReduce(staticArgs, func, chromSize,
+               genomeChunkLength=None,
+               region=None,
+               regions=None,
+               blackListFileName=None,
+               numberOfProcessors=4,
+               bamFilesList=None,
+               tileSize=1,
+               skipEmptyRegions=False,
+               splitTask=None,
+               mergeResults=None,
+               moduleGlobals=None,
+               checkpointDir=None,
+               saveResult=None,
+               loadResult=None,
+               verbose=False):
+    """
+    Same as mapReduce but, instead of returning a list once all the
+    genome chunks are processed, the results are yielded as soon as
+    they are available. The results are always yielded in the genome
+    order of the chunks, thus results from chunks that finish early
+    are kept until all the chunks before them are done.
+
+    >>> def _chunkLength(args):
+    ...     return args[0], args[2] - args[1]
+    >>> list(imapReduce([], _chunkLength, [('chr1', 250), ('chr2', 100)],
+    ...                 genomeChunkLength=100, numberOfProcessors=1))
+    [('chr1', 100), ('chr1', 100), ('chr1', 50), ('chr2', 100)]
+    """
+    density = None
+    if bamFilesList and not region:
+        density = getDensity(chromSize, bamFilesList)
+
+    TASKS = getTasks((), chromSize,
+                     genomeChunkLength=genomeChunkLength,
+                     region=region, regions=regions,
+                     blackListFileName=blackListFileName,
+                     bamFilesList=bamFilesList,
+                     tileSize=tileSize, skipEmptyRegions=skipEmptyRegions,
+                     density=density, verbose=verbose)
+
+    costs = None
+    if density is not None:
+        costs = getChunkReads(TASKS, density)
+
+    for res in runTasks(func, TASKS, numberOfProcessors,
+                        staticArgs=staticArgs, moduleGlobals=moduleGlobals,
+                        costs=costs, splitTask=splitTask,
+                        mergeResults=mergeResults,
+                        checkpointDir=checkpointDir, saveResult=saveResult,
+                        loadResult=loadResult, verbose=verbose):
+        yield res
+
+
+def runTasks(func, TASKS, numberOfProcessors, staticArgs=(),
+             moduleGlobals=None, costs=None, splitTask=None,
+             mergeResults=None, checkpointDir=None, saveResult=None,
+             loadResult=None, verbose=False):
+    """
+    Runs func for each of the TASKS, to which the staticArgs are
+    appended, and yields the results in the order of the TASKS. If
+    there is more than one task and more than one processor, the
+    tasks are run by the shared process pool (see scheduleTasks),
+    or by the executor if one is set.
+
+    If a checkpointDir is given, the result of each task is saved in
+    that directory, under a name built from func, the staticArgs,
+    the moduleGlobals and the task. For any file name found in the
+    staticArgs or the moduleGlobals, the size and modification time
+    of the file are used as well. When the same tasks are run again,
+    only the tasks whose result is not in the checkpointDir are
+    processed; the other results are loaded from the directory.
+
+    The results are pickled unless saveResult(result, fileName) and
+    loadResult(fileName) functions are given (see saveResultFile and
+    loadResultFile for tasks that return temporary files).
+
+    The tasks are logged in the perfLog (see perfLog.RunLog), and
+    the summary is written once the last result is obtained, before
+    it is yielded, such that it does not depend on the caller asking
+    for more results.
 
+    >>> _processed = []
+    >>> def _chunkLength(args):
+    ...     _processed.append(args)
+    ...     return args[0], args[2] - args[1]
+    >>> checkpointDir = tempfile.mkdtemp()
+    >>> list(runTasks(_chunkLength, [('chr1', 0, 10)], 1,
+    ...               checkpointDir=checkpointDir))
+    [('chr1', 10)]
+
+    The second time, only the new task is processed
+    >>> list(runTasks(_chunkLength, [('chr1', 0, 10), ('chr1', 10, 15)], 1,
+    ...               checkpointDir=checkpointDir))
+    [('chr1', 10), ('chr1', 5)]
+    >>> _processed
+    [('chr1', 0, 10), ('chr1', 10, 15)]
+    >>> shutil.rmtree(checkpointDir)
+    """
+    staticArgs = tuple(staticArgs)
+    done = [False] * len(TASKS)
+    if checkpointDir:
+        checkpointFiles = getCheckpointFiles(checkpointDir, func, TASKS,
+                                             staticArgs, moduleGlobals)
+        done = [os.path.exists(fileName) for fileName in checkpointFiles]
+        if verbose:
+            print "{} of {} tasks found in {}".format(
+                sum(done), len(TASKS), checkpointDir)
+
+    todo = [index for index in range(len(TASKS)) if not done[index]]
+    todoTasks = [TASKS[index] for index in todo]
+    runLog = perfLog.RunLog(func)
+    if executor is not None and len(todoTasks):
+        results = scheduleTasks(
+            func, todoTasks, numberOfProcessors, staticArgs=staticArgs,
+            moduleGlobals=moduleGlobals,
+            costs=[costs[index] for index in todo] if costs else None,
+            splitTask=splitTask, mergeResults=mergeResults,
+            verbose=verbose, runLog=runLog)
+    elif len(todoTasks) > 1 and numberOfProcessors > 1:
+        if verbose:
+            print ("using {} processors for {} "
+                   "number of tasks".format(numberOfProcessors,
+                                            len(todoTasks)))
+        results = scheduleTasks(
+            func, todoTasks, numberOfProcessors, staticArgs=staticArgs,
+            moduleGlobals=moduleGlobals,
+            costs=[costs[index] for index in todo] if costs else None,
+            splitTask=splitTask, mergeResults=mergeResults,
+            verbose=verbose, runLog=runLog)
+    else:
+        results = runSequentially(func, todoTasks, staticArgs,
+                                  moduleGlobals=moduleGlobals,
+                                  runLog=runLog)
+
+    if not len(TASKS):
+        runLog.logSummary()
+        return
+
+    for index in range(len(TASKS)):
+        if done[index]:
+            res = (loadResult or loadPickle)(checkpointFiles[index])
+        else:
+            res = results.next()
+            if checkpointDir:
+                # the result is renamed once complete, such that
+                # interrupted runs do not leave partial results
+                partialFile = checkpointFiles[index] + ".part"
+                (saveResult or savePickle)(res, partialFile)
+                os.rename(partialFile, checkpointFiles[index])
+        if index == len(TASKS) - 1:
+            # the tasks are done, thus the generator of the results
+            # is closed at once instead of when it is garbage collected
+            results.close()
+            runLog.logSummary()
+        yield res
+
+
+def scheduleTasks(func, TASKS, numberOfProcessors, staticArgs=(),
+                  moduleGlobals=None, costs=None, splitTask=None,
+                  mergeResults=None, verbose=False, runLog=None):
+    """
+    Runs func for each of the TASKS using the shared process pool,
+    or the executor if one is set, and yields the results in the
+    order of the TASKS. Each task is a tuple, usually (chrom, start,
+    end), to which the staticArgs are appended before calling func.
+
+    The staticArgs and the moduleGlobals are not sent with every
+    task. Instead, they are saved once in a context file that each
+    worker loads before running its first task. At that moment,
+    the moduleGlobals, a dictionary of variable names and values,
+    are set in the module of func. Thus, the workers do not rely
+    on variables inherited from the parent process.
+
+    The tasks are sent to the workers starting with the most
+    expensive ones, according to costs (by default the chunk
+    length), such that the small chunks are left for the end
+    of the run. Only the next tasksAhead tasks per worker, counted
+    from the first task whose result has not been returned yet,
+    are considered, which bounds the number of results kept until
+    their turn comes. Only as many tasks as workers are sent at
+    the same time, the rest wait in a queue.
+
+    If splitTask and mergeResults are given, once fewer tasks than
+    workers are waiting, the next waiting task is split into parts
+    such that the workers that become idle at the end of the run
+    still have something to do. splitTask(task, numberOfParts),
+    where task includes the staticArgs, has to return a list of
+    (function, args) tuples, or None if the task can not be split.
+    Like for the tasks, the staticArgs are appended to args before
+    calling function. mergeResults(task, partResults) has to combine
+    the results of the parts, given in the order returned by
+    splitTask, into the same result that func(task) would return.
+
+    The tasks are logged in runLog, a perfLog.RunLog whose summary
+    is left to the caller (see runTasks).
+
+    In the following example there are more workers than tasks,
+    thus the tasks are split
+    >>> def _splitTask(task, numberOfParts):
+    ...     middle = (task[1] + task[2]) / 2
+    ...     return [(list, (task[0], task[1], middle)),
+    ...             (list, (task[0], middle, task[2]))]
+    >>> def _mergeResults(task, partResults):
+    ...     return partResults[0][:2] + partResults[-1][2:]
+    >>> TASKS = [('chr1', 0, 100), ('chr2', 0, 10)]
+    >>> list(scheduleTasks(list, TASKS, 3, splitTask=_splitTask,
+    ...                    mergeResults=_mergeResults, verbose=True))
+    splitting chr1:0-100 into 2 parts
+    splitting chr2:0-10 into 2 parts
+    [['chr1', 0, 100], ['chr2', 0, 10]]
+
+    The static arguments are added to each task
+    >>> list(scheduleTasks(list, TASKS, 2, staticArgs=('a', 1)))
+    [['chr1', 0, 100, 'a', 1], ['chr2', 0, 10, 'a', 1]]
+
+    A task that fails, because func raises an error, the worker
+    dies or the task takes longer than taskTimeout seconds (see
+    getFinishedTask), is run again, up to taskRetries times, while
+    the other tasks keep running. The region of the failed task is
+    written to stderr. If the task keeps failing, its error is raised.
+    >>> list(scheduleTasks(int, TASKS, 2))
+    Traceback (most recent call last):
+    ...
+    TypeError: int() argument must be a string or a number, not 'tuple'
+    >>> closePool()
+    """
+    pool = executor or getPool(numberOfProcessors)
+    staticArgs = tuple(staticArgs)
+    contextFile = saveContext(staticArgs, func.__module__, moduleGlobals)
+    try:
+        for res in _scheduleTasks(pool, contextFile, func, TASKS,
+                                  staticArgs, costs, splitTask,
+                                  mergeResults, verbose,
+                                  runLog or perfLog.RunLog(func)):
+            yield res
+    finally:
+        os.remove(contextFile)
+
+
+def _scheduleTasks(pool, contextFile, func, TASKS, staticArgs, costs,
+                   splitTask, mergeResults, verbose, runLog):
+    if costs is None:
+        costs = [task[2] - task[1] for task in TASKS]
+    # the tasks within the window of tasks that may be sent,
+    # as (-cost, index) such that the most expensive comes first
+    ready = []
+    # index of the next task to add to ready
+    nextTask = 0
+    # retried tasks and parts of split tasks, which are sent before
+    # the ready tasks. Each is stored as (index, part, func, args),
+    # where part is None unless the task is a part of a split chunk
+    waiting = deque()
+    finished = Queue.Queue()
+    running = {}
+    # number of failures of each (index, part)
+    failures = {}
+    # results of the parts of the split tasks
+    parts = {}
+    # results that arrive before the results of the
+    # previous chunks are kept here until their turn comes
+    pending = {}
+    nextIndex = 0
+    try:
+        while nextIndex < len(TASKS):
+            # the number of workers of some executors changes over time
+            numberOfProcessors = pool.size()
+            runLog.workers = max(runLog.workers, numberOfProcessors)
+            limit = min(nextIndex + tasksAhead * numberOfProcessors,
+                        len(TASKS))
+            while nextTask < limit:
+                heapq.heappush(ready, (-costs[nextTask], nextTask))
+                nextTask += 1
+            while len(running) < numberOfProcessors and \
+                    (len(waiting) or len(ready)):
+                if not len(waiting):
+                    index = heapq.heappop(ready)[1]
+                    waiting.append((index, None, func, TASKS[index]))
+                numberWaiting = len(waiting) + len(ready) + \
+                    len(TASKS) - nextTask
+                if splitTask and mergeResults and \
+                        numberWaiting < numberOfProcessors and \
+                        waiting[0][1] is None:
+                    index, part, taskFunc, task = waiting[0]
+                    subTasks = splitTask(task + staticArgs,
+                                         numberOfProcessors -
+                                         numberWaiting + 1)
+                    if subTasks and len(subTasks) > 1:
+                        if verbose:
+                            print "splitting {}:{}-{} into {} parts".format(
+                                task[0], task[1], task[2], len(subTasks))
+                        waiting.popleft()
+                        # part results and number of parts not yet finished
+                        parts[index] = ([None] * len(subTasks), len(subTasks))
+                        for part in reversed(range(len(subTasks))):
+                            subFunc, subArgs = subTasks[part]
+                            waiting.appendleft((index, part, subFunc, subArgs))
+
+                job = waiting.popleft()
+                index, part, taskFunc, task = job
+                attempt = failures.get((index, part), 0)
+                args = (index, part, attempt, taskFunc, task, contextFile)
+                running[(index, part)] = {
+                    'job': job, 'attempt': attempt, 'worker': None,
+                    'start': time.time(),
+                    'result': pool.apply_async(scheduledTask_wrapper, (args,),
+                                               callback=finished.put)}
+
+            job, success, res, stats = getFinishedTask(pool, finished,
+                                                       running)
+            index, part, taskFunc, task = job
+            if not success:
+                error, trace = res
+                failures[(index, part)] = failures.get((index, part), 0) + 1
+                reportFailure(task, failures[(index, part)], error, trace)
+                if failures[(index, part)] > taskRetries:
+                    raise error
+                # only the failed task is run again, as soon as possible
+                waiting.appendleft(job)
+                continue
+
+            runLog.logTask(task, part, failures.get((index, part), 0),
+                           stats, res)
+            if part is not None:
+                partResults, remaining = parts[index]
+                partResults[part] = res
+                parts[index] = (partResults, remaining - 1)
+                if remaining > 1:
+                    continue
+                res = mergeResults(TASKS[index] + staticArgs,
+                                   parts.pop(index)[0])
+
+            pending[index] = res
+            while nextIndex in pending:
+                yield pending.pop(nextIndex)
+                nextIndex += 1
+    finally:
+        # the tasks still running after an error, or when the
+        # results are no longer wanted, are stopped
+        if running and pool is _pool:
+            closePool()
+
+
+def getFinishedTask(pool, finished, running):
+    """
+    Waits until one of the running tasks finishes and returns its
+    job, whether it succeeded, its result and the measures of the
+    task (see perfLog.measureTask). For failed tasks the result is
+    the error and its traceback, and there are no measures.
+
+    A task fails when func raises an error, when the worker running
+    it dies (for example killed because it ran out of memory) or
+    when it runs for longer than taskTimeout seconds, in which case
+    the worker is killed. The pool replaces the dead workers.
+    """
+    while True:
+        try:
+            index, part, attempt, success, res, stats = \
+                finished.get(timeout=1)
+        except Queue.Empty:
+            failure = checkRunningTasks(pool, running)
+            if failure is not None:
+                return failure
+            continue
+        # results of abandoned attempts are ignored
+        key = (index, part)
+        if key in running and running[key]['attempt'] == attempt:
+            return running.pop(key)['job'], success, res, stats
+
+
+def checkRunningTasks(pool, running):
+    """
+    Looks for a running task that failed without returning
+    a result. If there is one, it is removed from running and
+    its job, False, (error, traceback) and None are returned.
+    """
+    # the workers announce the tasks they start. Tasks whose
+    # worker dies before the announcement can only be detected
+    # by the timeout, counted from the moment they were sent.
+    for index, part, attempt, worker in pool.startedTasks():
+        key = (index, part)
+        if key in running and running[key]['attempt'] == attempt:
+            running[key]['worker'] = worker
+            running[key]['start'] = time.time()
+
+    alive = pool.aliveWorkers()
+    for key, task in running.items():
+        error = None
+        trace = ""
+        result = task['result']
+        if result is not None and result.ready() and \
+                not result.successful():
+            # tasks that fail because their result can not be
+            # sent back never reach the finished queue
+            try:
+                result.get()
+            except Exception as error:
+                trace = traceback.format_exc()
+        elif task['worker'] is not None and task['worker'] not in alive:
+            error = RuntimeError("the worker process {} died".format(
+                task['worker']))
+        elif taskTimeout and time.time() - task['start'] > taskTimeout:
+            if task['worker'] is not None:
+                pool.killWorker(task['worker'])
+            error = RuntimeError("no result after {} seconds".format(
+                taskTimeout))
+        if error is not None:
+            return running.pop(key)['job'], False, (error, trace), None
+    return None
+
+
+def runSequentially(func, TASKS, staticArgs=(), moduleGlobals=None,
+                    runLog=None):
+    """
+    Runs func for each of the TASKS, to which the staticArgs are
+    appended, in the current process and yields the results. The
+    moduleGlobals are set in the module of func, as in the workers
+    of the pool (see setContext). Unlike
+    in the pool, there are no timeouts or lost workers, thus a task
+    that raises an error is not run again and the error is raised.
+    The tasks are logged in runLog, as in scheduleTasks.
+
+    >>> list(runSequentially(len, [('chr1', 0, 10)], ('a',)))
+    [4]
+    >>> list(runSequentially(int, [('chr1', 0, 10)]))
+    Traceback (most recent call last):
+    ...
+    TypeError: int() argument must be a string or a number, not 'tuple'
+    """
+    runLog = runLog or perfLog.RunLog(func)
+    if moduleGlobals:
+        vars(sys.modules[func.__module__]).update(moduleGlobals)
+    for task in TASKS:
+        res, stats = perfLog.measureTask(func, task + staticArgs)
+        runLog.logTask(task, None, 0, stats, res)
+        yield res
+
+
+def reportFailure(task, failures, error, trace=""):
+    """
+    Writes to stderr why the task failed and whether
+    it is going to be run again.
+    """
+    sys.stderr.write(trace or "{}: {}\n".format(type(error).__name__, error))
+    if failures > taskRetries:
+        sys.stderr.write("{} failed {} times, giving up\n".format(
+            taskName(task), failures))
+    else:
+        sys.stderr.write("{} failed, running it again ({} of {})\n".format(
+            taskName(task), failures, taskRetries))
+
+
+def taskName(task):
+    """
+    Returns the genomic region of a task as chrom:start-end,
+    or the task itself for other kinds of tasks.
+
+    >>> taskName(('chr1', 0, 100, 'static'))
+    'chr1:0-100'
+    >>> taskName((0, 10))
+    '(0, 10)'
+    """
+    if len(task) >= 3 and isinstance(task[0], basestring):
+        return "{}:{}-{}".format(task[0], task[1], task[2])
+    return str(task)
+
+
+def scheduledTask_wrapper(args):
+    index, part, attempt, func, task, contextFile = args
+    if _started is not None:
+        _started.put((index, part, attempt, os.getpid()))
+    try:
+        res, stats = perfLog.measureTask(func,
+                                         task + getContext(contextFile))
+        return index, part, attempt, True, res, stats
+    except Exception as error:
+        trace = traceback.format_exc()
+        try:
+            pickle.dumps(error)
+        except Exception:
+            error = Exception(str(error))
+        return index, part, attempt, False, (error, trace), None
+
+
+def getCheckpointFiles(checkpointDir, func, TASKS, staticArgs=(),
+                       moduleGlobals=None):
+    """
+    Returns the names of the files in which the results of
+    the TASKS are saved (see runTasks).
+
+    >>> def _func(args):
+    ...     pass
+    >>> TASKS = [('chr1', 0, 10), ('chr1', 10, 20)]
+    >>> files = getCheckpointFiles("/tmp", _func, TASKS, ('a',))
+    >>> len(set(files))
+    2
+    >>> files == getCheckpointFiles("/tmp", _func, TASKS, ('a',))
+    True
+    >>> files == getCheckpointFiles("/tmp", _func, TASKS, ('b',))
+    False
+    """
+    if not os.path.isdir(checkpointDir):
+        os.makedirs(checkpointDir)
+    key = hashlib.sha1(stableRepr((func, staticArgs, moduleGlobals)))
+    checkpointFiles = []
+    for task in TASKS:
+        taskKey = key.copy()
+        taskKey.update(stableRepr(task))
+        checkpointFiles.append(os.path.join(checkpointDir,
+                                            taskKey.hexdigest()))
+    return checkpointFiles
+
+
+def stableRepr(obj):
+    """
+    Returns a representation of obj that, unlike repr, does not
+    change between runs: functions are represented by their name,
+    dictionaries are sorted and file names are followed by
+    the size and modification time of the file.
+
+    >>> stableRepr({'b': [1, 2.5], 'a': (stableRepr, None)})
+    "{'a': (deeptools.mapReduce.stableRepr, None), 'b': [1, 2.5]}"
+    """
+    if isinstance(obj, dict):
+        return "{" + ", ".join(sorted(
+            ["{}: {}".format(stableRepr(key), stableRepr(value))
+             for key, value in obj.iteritems()])) + "}"
+    if isinstance(obj, list):
+        return "[" + ", ".join([stableRepr(x) for x in obj]) + "]"
+    if isinstance(obj, tuple):
+        return "(" + ", ".join([stableRepr(x) for x in obj]) + ")"
+    if isinstance(obj, np.ndarray):
+        return stableRepr(obj.tolist())
+    if hasattr(obj, '__module__') and hasattr(obj, '__name__'):
+        return "{}.{}".format(obj.__module__, obj.__name__)
+    if isinstance(obj, basestring) and os.path.isfile(obj):
+        stat = os.stat(obj)
+        return repr((os.path.abspath(obj), stat.st_size, stat.st_mtime))
+    return repr(obj)
+
+
+def savePickle(res, fileName):
+    with open(fileName, 'wb') as fh:
+        pickle.dump(res, fh, pickle.HIGHEST_PROTOCOL)
+
+
+def loadPickle(fileName):
+    with open(fileName, 'rb') as fh:
+        return pickle.load(fh)
+
+
+def saveResultFile(tempFileName, fileName):
+    """
+    saveResult function for tasks that return the name of a
+    temporary file: the content of the file is saved. An empty
+    file is saved for tasks that return None.
+    """
+    if tempFileName is None:
+        open(fileName, 'wb').close()
+    else:
+        shutil.copyfile(tempFileName, fileName)
+
+
+def loadResultFile(fileName):
+    """
+    loadResult function for tasks that return the name of a temporary
+    file: the saved content is copied into a new temporary file, whose
+    name is returned, such that it can be removed like the temporary
+    files returned by the tasks. None is returned for empty files.
+    """
+    if os.path.getsize(fileName) == 0:
+        return None
+
+    # is /dev/shm available?
+    # working in this directory speeds the process
+    try:
+        _file = tempfile.NamedTemporaryFile(dir="/dev/shm", delete=False)
+    except OSError:
+        _file = tempfile.NamedTemporaryFile(delete=False)
+
+    shutil.copyfileobj(open(fileName, 'rb'), _file)
+    _file.close()
+    return _file.name
+
+
+def saveContext(staticArgs, moduleName, moduleGlobals=None):
+    """
+    Saves the static arguments of the tasks, and the variables
+    to set in the module moduleName, into a temporary file
+    whose name is returned.
+    """
+    # is /dev/shm available?
+    # working in this directory speeds the process
+    try:
+        _file = tempfile.NamedTemporaryFile(dir="/dev/shm", suffix=".pkl",
+                                            delete=False)
+    except OSError:
+        _file = tempfile.NamedTemporaryFile(suffix=".pkl", delete=False)
+
+    pickle.dump((staticArgs, moduleName, moduleGlobals), _file,
+                pickle.HIGHEST_PROTOCOL)
+    _file.close()
+    return _file.name
+
+
+def getContext(contextFile):
+    """
+    Returns the static arguments saved in contextFile. The file is
+    only read by the first task of a worker that uses it, which also
+    sets the module variables saved with the static arguments.
+
+    >>> contextFile = saveContext(('a', 1), __name__, {'_test': 2})
+    >>> getContext(contextFile)
+    ('a', 1)
+    >>> vars(sys.modules[__name__]).pop('_test')
+    2
+    >>> os.remove(contextFile)
+    """
+    if contextFile != _contextFile:
+        setContext(contextFile, open(contextFile, 'rb').read())
+    return _context
+
+
+def setContext(contextFile, data):
+    """
+    Sets the context saved in contextFile from data, the content
+    of the file. This is how the workers of other machines, which
+    can not read the file, get the context (see remoteExecutor).
+    The module of the tasks is imported if the worker has not
+    imported it yet.
+    """
+    global _contextFile, _context
+    staticArgs, moduleName, moduleGlobals = pickle.loads(data)
+    if moduleGlobals:
+        module = importlib.import_module(moduleName)
+        vars(module).update(moduleGlobals)
+    _contextFile, _context = contextFile, staticArgs
+
+
+def getTasks(staticArgs, chromSize, genomeChunkLength=None,
+             region=None, bamFilesList=None, tileSize=1,
+             skipEmptyRegions=False, density=None, verbose=False,
+             regions=None, blackListFileName=None):
+    """
+    Splits the genome into chunks of genomeChunkLength and
+    returns a list of tuples containing the chunk chromosome,
+    start and end followed by the staticArgs.
+
+    If bamFilesList is given, the chunks are based on the read
+    density of the bam files (see getDensityChunks), which can
+    be given if it was already computed by getDensity.
+
+    >>> getTasks(('a',), [('chr1', 250)], genomeChunkLength=100)
+    [('chr1', 0, 100, 'a'), ('chr1', 100, 200, 'a'), ('chr1', 200, 250, 'a')]
+
+    If regions, a list of (chrom, start, end) intervals, are given,
+    only the regions are split into chunks (see getRegionChunks).
+    If skipEmptyRegions is set and the density is given, the chunks
+    without reads nearby (see padDensity) are skipped.
+    >>> getTasks((), [('chr1', 250)], genomeChunkLength=100,
+    ...          regions=[('chr1', 30, 60), ('chr1', 200, 240)],
+    ...          tileSize=20)
+    [('chr1', 20, 60), ('chr1', 200, 240)]
+
+    The chunks that are completely inside the regions of the
+    blackListFileName (see blackList.BlackList) are skipped.
+    """
     if not genomeChunkLength:
         genomeChunkLength = 1e5
+    genomeChunkLength = int(genomeChunkLength)
 
     if verbose:
         print "genome partition size for multiprocessing: {}".format(
@@ -44,36 +946,347 @@ def mapReduce(staticArgs, func, chromSize,
     # if a region is set, that means that the task should be only cover
     # the given genomic possition
 
+    chunks = None
     if region:
         chromSize, regionStart, regionEnd, genomeChunkLength = \
             getUserRegion(chromSize, region)
         if verbose:
             print (chromSize, regionStart, regionEnd, genomeChunkLength)
+    elif regions is not None:
+        chunks = getRegionChunks(chromSize, regions, genomeChunkLength,
+                                 tileSize=tileSize)
+        if skipEmptyRegions and density is not None:
+            chunks = [chunk for chunk, reads in
+                      zip(chunks, getChunkReads(chunks, padDensity(density)))
+                      if reads > 0]
+        if verbose:
+            print "{} genome chunks covering the {} regions".format(
+                len(chunks), len(regions))
+    elif bamFilesList:
+        chunks = getDensityChunks(chromSize, bamFilesList,
+                                  genomeChunkLength, tileSize=tileSize,
+                                  skipEmptyRegions=skipEmptyRegions,
+                                  density=density)
+        if verbose and chunks is not None:
+            print "{} genome chunks based on the read density".format(
+                len(chunks))
+
+    if chunks is None:
+        chunks = []
+        # iterate over all chromosomes
+        for chrom, size in chromSize:
+            # the start is zero unless a specific region is defined
+            start = 0 if regionStart == 0 else regionStart
+            for startPos in xrange(start, size, genomeChunkLength):
+                endPos = min(size, startPos + genomeChunkLength)
+                chunks.append((chrom, startPos, endPos))
+
+    if blackListFileName:
+        blackList = fileHandles.getBlackList(blackListFileName)
+        chunks = [chunk for chunk in chunks if not blackList.covers(*chunk)]
 
     TASKS = []
-    # iterate over all chromosomes
+    for chrom, startPos, endPos in chunks:
+        argsList = [chrom, startPos, endPos]
+        # add to argument list the static list received the the function
+        argsList.extend(staticArgs)
+        TASKS.append(tuple(argsList))
+
+    return TASKS
+
+
+def getDensityChunks(chromSize, bamFilesList, genomeChunkLength,
+                     tileSize=1, skipEmptyRegions=False, density=None):
+    """
+    Splits the genome into chunks that contain roughly the same
+    number of reads. The number of reads per genomic window is
+    estimated from the bam indices (see bamHandler.getReadDensity)
+    and is summed over all the bam files.
+
+    The number of reads per chunk is chosen such that the number
+    of chunks is about the same as when the genome is split into
+    chunks of genomeChunkLength. Chunks are never longer than
+    twice the genomeChunkLength, and windows containing more reads
+    than the target number are split into several chunks.
+
+    All chunk boundaries, except chromosome ends, are multiples of
+    tileSize. If skipEmptyRegions is set, regions for which the
+    index reports no reads, neither in the region nor in the
+    neighbouring windows (see padDensity), are not part of any chunk.
+
+    Returns a list of (chrom, start, end) tuples, or None if the
+    read density could not be obtained from the bam indices. The
+    density can be given if it was already computed by getDensity.
+
+    The test bam file has 144 reads in a single index window. For
+    chunks of 1000 bp the expected number of reads per chunk is 96,
+    thus the window is split into two chunks
+    >>> getDensityChunks([('3R', 1500)],
+    ... ["./test/test_data/test1.bam"], 1000, tileSize=25)
+    [('3R', 0, 750), ('3R', 750, 1500)]
+
+    Chromosomes without reads are skipped
+    >>> getDensityChunks([('3R', 1500), ('chrX', 500)],
+    ... ["./test/test_data/test1.bam"], 1500, tileSize=25,
+    ... skipEmptyRegions=True)
+    [('3R', 0, 750), ('3R', 750, 1500)]
+
+    The reads of test_gap.bam are in the second and the fifth windows.
+    Only the last window, which is not next to any window with reads,
+    is skipped
+    >>> getDensityChunks([('chr1', 100000)],
+    ... ["./test/test_data/test_gap.bam"], 50000, tileSize=50,
+    ... skipEmptyRegions=True)
+    [('chr1', 0, 16350), ('chr1', 16350, 24550), ('chr1', 24550, 32750), ('chr1', 32750, 98300)]
+    """
+    import bamHandler
+
+    window = bamHandler.LINEAR_INDEX_WINDOW
+    if density is None:
+        density = getDensity(chromSize, bamFilesList)
+    if density is None:
+        return None
+
+    genomeSize = sum([size for chrom, size in chromSize])
+    totalReads = sum([density[chrom].sum() for chrom, size in chromSize])
+    if totalReads == 0:
+        return [] if skipEmptyRegions else None
+
+    genomeChunkLength = max(int(genomeChunkLength), 1)
+    readsPerChunk = totalReads * genomeChunkLength / genomeSize
+    maxChunkLength = 2 * genomeChunkLength
+
+    if skipEmptyRegions:
+        paddedDensity = padDensity(density)
+
+    chunks = []
     for chrom, size in chromSize:
-        # the start is zero unless a specific region is defined
-        start = 0 if regionStart == 0 else regionStart
-        for startPos in xrange(start, size, genomeChunkLength):
-            endPos = min(size, startPos + genomeChunkLength)
-            argsList = [chrom, startPos, endPos]
-            # add to argument list the static list received the the function
-            argsList.extend(staticArgs)
-            TASKS.append(tuple(argsList))
-
-    if len(TASKS) > 1 and numberOfProcessors > 1:
-        if verbose:
-            print ("using {} processors for {} "
-                   "number of tasks".format(numberOfProcessors,
-                                            len(TASKS)))
+        # the chromosome is first divided into consecutive
+        # segments that are either used or skipped. The segment
+        # boundaries are later moved to match the tileSize.
+        boundaries = [0]
+        skip = []
+        reads = 0
+        for index, windowReads in enumerate(density[chrom]):
+            windowStart = index * window
+            windowEnd = min(size, windowStart + window)
+            if windowStart >= size:
+                break
+            if skipEmptyRegions and paddedDensity[chrom][index] == 0:
+                if boundaries[-1] < windowStart:
+                    boundaries.append(windowStart)
+                    skip.append(False)
+                if len(skip) and skip[-1] is True:
+                    boundaries[-1] = windowEnd
+                else:
+                    boundaries.append(windowEnd)
+                    skip.append(True)
+                reads = 0
+                continue
 
-        pool = multiprocessing.Pool(numberOfProcessors)
-        res = pool.map_async(func, TASKS).get(9999999)
-    else:
-        res = map(func, TASKS)
+            if windowReads > readsPerChunk:
+                # dense window, split it evenly
+                if boundaries[-1] < windowStart:
+                    boundaries.append(windowStart)
+                    skip.append(False)
+                parts = int(np.ceil(windowReads / readsPerChunk))
+                for part in range(1, parts + 1):
+                    boundaries.append(windowStart + (windowEnd - windowStart) *
+                                      part / parts)
+                    skip.append(False)
+                reads = 0
+                continue
+
+            reads += windowReads
+            if reads >= readsPerChunk or \
+                    windowEnd - boundaries[-1] >= maxChunkLength:
+                boundaries.append(windowEnd)
+                skip.append(False)
+                reads = 0
+
+        if boundaries[-1] < size:
+            boundaries.append(size)
+            skip.append(False)
+
+        # make the boundaries multiples of tileSize
+        boundaries = [x - x % tileSize if x < size else size
+                      for x in boundaries]
+        for index in range(len(skip)):
+            start, end = boundaries[index], boundaries[index + 1]
+            if skip[index] or start >= end:
+                continue
+            if len(chunks) and chunks[-1][0] == chrom and \
+                    chunks[-1][2] == start and \
+                    end - chunks[-1][1] <= tileSize:
+                # merge chunks that became too short
+                chunks[-1] = (chrom, chunks[-1][1], end)
+                continue
+            chunks.append((chrom, start, end))
+
+    return chunks
+
+
+def getDensity(chromSize, bamFilesList):
+    """
+    Returns a dictionary containing, for each chromosome, the estimated
+    number of reads per bam index window summed over all the bam
+    files (see bamHandler.getReadDensity), or None if any of the
+    indices can not be read.
+
+    >>> getDensity([('3R', 1500)], ["./test/test_data/test1.bam"] * 2)
+    {'3R': array([ 288.])}
+    """
+    import bamHandler
 
-    return res
+    density = None
+    for bamFile in bamFilesList:
+        bamDensity = bamHandler.getReadDensity(bamFile, chromSize)
+        if bamDensity is None:
+            return None
+        if density is None:
+            density = bamDensity
+        else:
+            for chrom in density:
+                density[chrom] += bamDensity[chrom]
+    return density
+
+
+def padDensity(density):
+    """
+    Returns a copy of the density in which the reads of each window
+    are also added to the neighbouring windows. The fragments of the
+    reads can extend into the neighbouring windows, thus the windows
+    without reads are only skipped when both neighbours have no reads
+    either. This holds as long as the fragments are shorter than
+    the index window.
+
+    >>> padDensity({'chr1': np.array([0., 0., 5., 0., 0., 0.])})
+    {'chr1': array([ 0.,  5.,  5.,  5.,  0.,  0.])}
+    """
+    padded = {}
+    for chrom, values in density.iteritems():
+        padded[chrom] = np.array(values, dtype='float64')
+        padded[chrom][1:] += values[:-1]
+        padded[chrom][:-1] += values[1:]
+    return padded
+
+
+def getChunkReads(chunks, density):
+    """
+    Returns, for each (chrom, start, end) chunk, the number
+    of reads estimated from the density computed by getDensity.
+    The reads of an index window are assumed to be evenly
+    distributed along the window.
+
+    >>> getChunkReads([('3R', 0, 4096), ('3R', 4096, 16384)],
+    ...               {'3R': np.array([144.])})
+    [36.0, 108.0]
+    """
+    import bamHandler
+
+    window = bamHandler.LINEAR_INDEX_WINDOW
+    chunkReads = []
+    for chrom, start, end in chunks:
+        reads = 0.0
+        chromDensity = density.get(chrom, [])
+        for index in xrange(start / window,
+                            min((end - 1) / window + 1, len(chromDensity))):
+            overlap = min(end, (index + 1) * window) - \
+                max(start, index * window)
+            reads += float(chromDensity[index]) * overlap / window
+        chunkReads.append(reads)
+    return chunkReads
+
+
+def getRegionChunks(chromSize, regions, genomeChunkLength, tileSize=1):
+    """
+    Returns the (chrom, start, end) chunks covering the regions, a
+    list of (chrom, start, end) intervals. The intervals are extended
+    to multiples of tileSize, clipped to the chromosome size and
+    merged when they overlap or touch. Merged intervals longer than
+    genomeChunkLength are split into several chunks. The chunks are
+    sorted in the order of chromSize, and the regions on chromosomes
+    not in chromSize are skipped.
+
+    >>> getRegionChunks([('chr1', 1000), ('chr2', 480)],
+    ... [('chr2', 10, 20), ('chr1', 120, 180), ('chr1', 0, 30),
+    ...  ('chr1', 170, 260), ('chrX', 0, 10), ('chr2', 470, 600)],
+    ... 100, tileSize=50)
+    [('chr1', 0, 50), ('chr1', 100, 200), ('chr1', 200, 300), ('chr2', 0, 50), ('chr2', 450, 480)]
+
+    >>> getRegionChunks([('chr1', 1000)], [('chrX', 0, 10)], 100)
+    Traceback (most recent call last):
+    ...
+    NameError: None of the regions is on a known chromosome. Known chromosomes are: ['chr1']
+    """
+    tileSize = max(int(tileSize), 1)
+    # the chunks are split at multiples of tileSize
+    genomeChunkLength = max(int(genomeChunkLength), tileSize)
+    genomeChunkLength -= genomeChunkLength % tileSize
+
+    chromRegions = {}
+    for chrom, start, end in regions:
+        chromRegions.setdefault(chrom, []).append((start, end))
+    if len(regions) and \
+            not any([chrom in chromRegions for chrom, size in chromSize]):
+        raise NameError("None of the regions is on a known chromosome. "
+                        "Known chromosomes are: {}".format(
+                            [chrom for chrom, size in chromSize]))
+
+    chunks = []
+    for chrom, size in chromSize:
+        if chrom not in chromRegions:
+            continue
+        intervals = np.array(chromRegions[chrom], dtype='int64')
+        starts = np.clip(intervals[:, 0], 0, size)
+        starts -= starts % tileSize
+        ends = np.clip(intervals[:, 1], 0, size)
+        ends = np.minimum(ends + (-ends) % tileSize, size)
+        keep = starts < ends
+        order = np.argsort(starts[keep], kind='mergesort')
+        starts = starts[keep][order]
+        ends = ends[keep][order]
+        if len(starts) == 0:
+            continue
+        # an interval that starts after the end of all the previous
+        # ones begins a new merged interval
+        maxEnds = np.maximum.accumulate(ends)
+        first = np.flatnonzero(np.r_[True, starts[1:] > maxEnds[:-1]])
+        last = np.r_[first[1:] - 1, len(starts) - 1]
+        for start, end in zip(starts[first].tolist(),
+                              maxEnds[last].tolist()):
+            for chunkStart in xrange(start, end, genomeChunkLength):
+                chunks.append((chrom, chunkStart,
+                               min(end, chunkStart + genomeChunkLength)))
+    return chunks
+
+
+def getBedRegions(fileName):
+    """
+    Returns the (chrom, start, end) intervals of a BED file.
+    Track, browser and comment lines are skipped.
+
+    >>> bedFile = tempfile.NamedTemporaryFile(suffix='.bed')
+    >>> bedFile.write("track name=targets\\nchr1\\t10\\t20\\tA\\n"
+    ...               "# comment\\nchr2\\t5\\t8\\n")
+    >>> bedFile.flush()
+    >>> getBedRegions(bedFile.name)
+    [('chr1', 10, 20), ('chr2', 5, 8)]
+    >>> bedFile.close()
+    """
+    from bx.intervals.io import GenomicIntervalReader, GenomicInterval
+    from bx.tabular.io import ParseError
+
+    regions = []
+    try:
+        for ginterval in GenomicIntervalReader(open(fileName)):
+            if isinstance(ginterval, GenomicInterval):
+                regions.append((ginterval.chrom, ginterval.start,
+                                ginterval.end))
+    except ParseError as error:
+        raise NameError("{} is not a valid BED file: {}".format(
+            fileName, error))
+    return regions
 
 
 def getUserRegion(chromSizes, regionString, max_chunk_size=1e6):
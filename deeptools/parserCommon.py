@@ -1,15 +1,31 @@
 import argparse
 import config as cfg
+import mapReduce
+from blackList import BlackList
 
 
-def output(args=None):
+def output(args=None, multipleOutputs=None, required=True):
+    """
+    output file options. If multipleOutputs is given, several output
+    file names can be given, one for each of the multipleOutputs
+    (for example '--ratio operation').
+    """
     parser = argparse.ArgumentParser(add_help=False)
     group = parser.add_argument_group('Output')
-    group.add_argument('--outFileName', '-o',
-                       help='Output file name.',
-                       metavar='FILENAME',
-                       type=writableFile,
-                       required=True)
+    if multipleOutputs:
+        group.add_argument('--outFileName', '-o',
+                           help='Output file name(s), one for each '
+                           '{}, in the same order.'.format(multipleOutputs),
+                           metavar='FILENAME',
+                           nargs='+',
+                           type=writableFile,
+                           required=required)
+    else:
+        group.add_argument('--outFileName', '-o',
+                           help='Output file name.',
+                           metavar='FILENAME',
+                           type=writableFile,
+                           required=required)
 
     group.add_argument('--outFileFormat', '-of',
                        help='Output file type. Either "bigwig" or "bedgraph"',
@@ -19,6 +35,45 @@ def output(args=None):
     return parser
 
 
+def regions(args=None):
+    """
+    option to restrict the output to a set of regions
+    """
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('--regionsFile',
+                        help='BED file with the regions of the genome to '
+                        'limit the operation to, for example the targets '
+                        'of a capture panel. Only the bins overlapping the '
+                        'regions are computed and written, thus the '
+                        'computing time depends on the length of the '
+                        'regions instead of the genome size. Can not be '
+                        'used together with --region.',
+                        metavar='BED file',
+                        type=bedRegions,
+                        required=False)
+
+    return parser
+
+
+def blackList(args=None):
+    """
+    option to exclude the regions of a blacklist
+    """
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('--blackListFileName', '-bl',
+                        help='BED file with the regions of the genome to '
+                        'exclude, for example the ENCODE blacklist of '
+                        'artifact regions. The bins overlapping them are '
+                        'skipped and the reads inside them are not '
+                        'counted, except for the total number of mapped '
+                        'reads used to normalize.',
+                        metavar='BED file',
+                        type=blackListFile,
+                        required=False)
+
+    return parser
+
+
 def bam(args=None):
     """
     common bam processing options
@@ -118,6 +173,69 @@ def getParentArgParse(args=None):
                         help='Set to see processing messages.',
                         action='store_true')
 
+    executionOptions(parser)
+
+    return parser
+
+
+def executionOptions(parser):
+    """
+    Adds to parser, or to an argument group of a parser, the options
+    that set how the parts of the genome are processed (see
+    mapReduce.setExecutionOptions).
+    """
+    parser.add_argument('--checkpointDir',
+                        help='Directory in which the results of each '
+                        'part of the genome are kept. If the program is '
+                        'interrupted, running it again with the same '
+                        'arguments only processes the missing parts.',
+                        metavar="DIR",
+                        required=False)
+
+    parser.add_argument('--taskTimeout',
+                        help='Maximum number of seconds that a processor '
+                        'may spend on a part of the genome. If it takes '
+                        'longer, the processor is considered hung, it is '
+                        'stopped and the part is processed again. By '
+                        'default there is no limit.',
+                        metavar="SECONDS",
+                        type=int,
+                        required=False)
+
+    parser.add_argument('--taskRetries',
+                        help='Number of times that a part of the genome is '
+                        'processed again when it fails, because of an error, '
+                        'a processor that dies or the --taskTimeout, before '
+                        'giving up.',
+                        metavar="INT",
+                        type=int,
+                        default=2,
+                        required=False)
+
+    parser.add_argument('--coordinatorAddress',
+                        help='Instead of using the processors of this '
+                        'machine, send the parts of the genome to the '
+                        'mapReduceAgent programs that connect to this '
+                        'address, which can run on any machine sharing '
+                        'the file system. Use :PORT to accept agents on '
+                        'all the network interfaces. The environment '
+                        'variable DEEPTOOLS_AUTHKEY has to be set to the '
+                        'same secret here and for the agents.',
+                        metavar="HOST:PORT",
+                        required=False)
+
+    parser.add_argument('--perfLog',
+                        help='File in which the performance of each part '
+                        'of the genome is written, one JSON object per '
+                        'line: region, processor (host and pid), wall '
+                        'and cpu seconds, reads fetched and kept, bytes of '
+                        'output and seconds waited before being processed. '
+                        'A summary with the parallel efficiency follows '
+                        'the parts of each step. This is useful to choose '
+                        'the number of processors.',
+                        metavar="FILE",
+                        required=False)
+
     return parser
 
 
@@ -161,6 +279,27 @@ def genomicRegion(string):
     return region
 
 
+def bedRegions(string):
+    try:
+        regions = mapReduce.getBedRegions(string)
+    except (IOError, NameError) as error:
+        raise argparse.ArgumentTypeError(
+            "{} can not be read: {}".format(string, error))
+    if len(regions) == 0:
+        raise argparse.ArgumentTypeError(
+            "{} does not contain any region".format(string))
+    return regions
+
+
+def blackListFile(string):
+    try:
+        BlackList(string)
+    except (IOError, NameError) as error:
+        raise argparse.ArgumentTypeError(
+            "{} can not be read: {}".format(string, error))
+    return string
+
+
 def writableFile(string):
     """
     Simple function that tests if a given path is writable
@@ -389,6 +528,9 @@ def computeMatrixOptArgs(case=['scale-regions', 'reference-point'][0]):
                           default=cfg.config.get('general',
                                                  'default_proc_number'),
                           required=False)
+
+    executionOptions(optional)
+
     return parser
 
 
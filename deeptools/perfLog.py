@@ -0,0 +1,167 @@
+import json
+import os
+import socket
+import time
+import numpy as np
+
+# file in which the performance of the tasks is logged (see openLog)
+_logFile = None
+
+# reads fetched and kept by the task running in this process
+_readsFetched = 0
+_readsKept = 0
+
+
+def openLog(fileName):
+    """
+    Starts logging the performance of the tasks run by mapReduce
+    into fileName, as one JSON object per line (see logTask and
+    logSummary).
+    """
+    global _logFile
+    closeLog()
+    _logFile = open(fileName, 'w')
+
+
+def closeLog():
+    global _logFile
+    if _logFile is not None:
+        _logFile.close()
+    _logFile = None
+
+
+def isLogging():
+    return _logFile is not None
+
+
+def countReads(fetched, kept):
+    """
+    Adds to the number of reads fetched from the bam files, and
+    of those reads that were used, by the current task. The
+    workers call this function, the counts are reported with
+    the other measures of the task (see measureTask).
+    """
+    global _readsFetched, _readsKept
+    _readsFetched += fetched
+    _readsKept += kept
+
+
+def measureTask(func, args):
+    """
+    Returns the result of func(args) and a dictionary with the
+    host and process id of the worker, the time at which the task
+    started, the wall and cpu seconds that it took and the reads
+    that it fetched and kept.
+
+    >>> res, stats = measureTask(len, [1, 2])
+    >>> res, stats['pid'] == os.getpid(), stats['readsFetched']
+    (2, True, 0)
+    """
+    global _readsFetched, _readsKept
+    _readsFetched = _readsKept = 0
+    start = time.time()
+    cpuStart = sum(os.times()[:2])
+    res = func(args)
+    stats = {'host': socket.gethostname(),
+             'pid': os.getpid(),
+             'start': start,
+             'wall': time.time() - start,
+             'cpu': sum(os.times()[:2]) - cpuStart,
+             'readsFetched': _readsFetched,
+             'readsKept': _readsKept}
+    return res, stats
+
+
+def resultBytes(res):
+    """
+    Returns the size in bytes of a task result. For results
+    that are the name of a (temporary) file, the file size.
+
+    >>> resultBytes(np.zeros(10))
+    80
+    >>> resultBytes(None)
+    0
+    """
+    if res is None:
+        return 0
+    if isinstance(res, np.ndarray):
+        return res.nbytes
+    if isinstance(res, basestring) and os.path.isfile(res):
+        return os.path.getsize(res)
+    if isinstance(res, (list, tuple)):
+        return sum([resultBytes(x) for x in res])
+    return len(json.dumps(res, default=str))
+
+
+class RunLog(object):
+    """
+    Collects the measures of the tasks of a mapReduce call. Each
+    task is logged as it finishes, with the measures returned by
+    measureTask plus its region, the bytes of its result and the
+    seconds that it waited, from the start of the call until a
+    worker started it. In the case of workers of other machines
+    (see remoteExecutor), the waiting time depends on their clocks.
+
+    The summary, logged at the end of the call, gives the parallel
+    efficiency: the time that the workers spent on the tasks divided
+    by the time that they were available (elapsed time times the
+    number of workers).
+    """
+
+    def __init__(self, func):
+        self.function = "{}.{}".format(func.__module__, func.__name__)
+        self.start = time.time()
+        self.records = []
+        self.workers = 1
+
+    def logTask(self, task, part, attempt, stats, res):
+        if _logFile is None or stats is None:
+            return
+        record = {'function': self.function}
+        if len(task) >= 3 and isinstance(task[0], basestring):
+            record['chrom'], record['start'], record['end'] = task[:3]
+        else:
+            record['task'] = list(task)
+        record['part'] = part
+        record['attempt'] = attempt
+        record['host'] = stats['host']
+        record['pid'] = stats['pid']
+        record['wall'] = round(stats['wall'], 4)
+        record['cpu'] = round(stats['cpu'], 4)
+        record['readsFetched'] = stats['readsFetched']
+        record['readsKept'] = stats['readsKept']
+        record['outputBytes'] = resultBytes(res)
+        record['queueWait'] = round(max(stats['start'] - self.start, 0), 4)
+        self.records.append(record)
+        writeRecord(record)
+
+    def logSummary(self):
+        if _logFile is None:
+            return
+        elapsed = time.time() - self.start
+        busy = sum([record['wall'] for record in self.records])
+        cpu = sum([record['cpu'] for record in self.records])
+        summary = {'function': self.function,
+                   'summary': True,
+                   'tasks': len(self.records),
+                   'workers': self.workers,
+                   'elapsed': round(elapsed, 4),
+                   'busy': round(busy, 4),
+                   'cpu': round(cpu, 4),
+                   'efficiency': round(busy / (elapsed * self.workers), 4)
+                   if elapsed else None,
+                   'cpuPerWall': round(cpu / busy, 4) if busy else None,
+                   'maxQueueWait': max([record['queueWait']
+                                        for record in self.records] or [0]),
+                   'readsFetched': sum([record['readsFetched']
+                                        for record in self.records]),
+                   'readsKept': sum([record['readsKept']
+                                     for record in self.records]),
+                   'outputBytes': sum([record['outputBytes']
+                                       for record in self.records])}
+        writeRecord(summary)
+
+
+def writeRecord(record):
+    _logFile.write(json.dumps(record, sort_keys=True) + "\n")
+    _logFile.flush()
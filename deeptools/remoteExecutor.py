@@ -0,0 +1,430 @@
+import multiprocessing
+import os
+import Queue
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import traceback
+import cPickle as pickle
+from multiprocessing.connection import Listener, Client
+
+# own modules
+import fileHandles
+import mapReduce
+
+debug = 0
+
+# maximum number of seconds that the coordinator waits for a worker
+# to connect when none is connected (see Coordinator.waitForWorkers)
+agentTimeout = 600
+
+
+def parseAddress(address):
+    """
+    Returns the (host, port) tuple of an address given as host:port.
+    Without host, the coordinator listens on all the interfaces.
+
+    >>> parseAddress("node1:5000")
+    ('node1', 5000)
+    >>> parseAddress("5000")
+    ('', 5000)
+    """
+    host, _, port = address.rpartition(':')
+    return host, int(port)
+
+
+def getAuthKey():
+    """
+    Returns the secret shared by the coordinator and the agents.
+    It is read from the DEEPTOOLS_AUTHKEY environment variable,
+    such that it does not show in the list of processes. Keep it
+    secret: the agents run the code sent by any coordinator that
+    knows it.
+    """
+    authkey = os.environ.get('DEEPTOOLS_AUTHKEY')
+    if not authkey:
+        raise NameError("Set the environment variable DEEPTOOLS_AUTHKEY "
+                        "to the same secret for the coordinator and "
+                        "the agents")
+    return authkey
+
+
+class Coordinator(object):
+    """
+    Executor (see mapReduce.LocalExecutor) that sends the tasks
+    over TCP to the workers of the agents (see runAgent) that connect
+    to address. The agents can run on any machine that shares the
+    file system with the coordinator.
+
+    Each worker keeps a connection open and gets one task at a
+    time. Before the first task of a mapReduce call, the content of
+    the context file (see mapReduce.saveContext), which is the last
+    argument of the tasks, is sent to the worker. The workers are
+    identified by host:pid. The functions of the tasks are pickled
+    by name, thus they have to be defined in an importable module,
+    not in the script run by the coordinator.
+
+    For testing, the agents can run on the same machine
+    >>> coordinator = Coordinator(('localhost', 0), 'secret')
+    >>> agent = startLocalAgent(coordinator.address, 'secret', 2)
+    >>> mapReduce.executor = coordinator
+    >>> TASKS = [('chr1', 0, 10), ('chr2', 0, 5), ('chr3', 0, 8)]
+    >>> list(mapReduce.scheduleTasks(list, TASKS, 1, staticArgs=('a',)))
+    [['chr1', 0, 10, 'a'], ['chr2', 0, 5, 'a'], ['chr3', 0, 8, 'a']]
+    >>> mapReduce.executor = None
+    >>> coordinator.close()
+    >>> agent.terminate()
+    """
+
+    def __init__(self, address, authkey):
+        self.listener = Listener(address, authkey=authkey)
+        self.address = self.listener.address
+        self.tasks = Queue.Queue()
+        self.started = Queue.Queue()
+        # connection and sending lock of each connected worker
+        self.workers = {}
+        self.lock = threading.Lock()
+        self.threads = []
+        self.closed = False
+        thread = threading.Thread(target=self.acceptWorkers)
+        thread.daemon = True
+        thread.start()
+
+    def size(self):
+        """
+        Returns the number of connected workers. If none is
+        connected, waits for one (see waitForWorkers).
+        """
+        self.waitForWorkers(agentTimeout)
+        with self.lock:
+            return len(self.workers)
+
+    def waitForWorkers(self, timeout):
+        """
+        Waits until a worker is connected. If none connects within
+        timeout seconds, for example because the agents were given
+        another address or DEEPTOOLS_AUTHKEY, an error is raised.
+
+        >>> coordinator = Coordinator(('localhost', 0), 'secret')
+        >>> coordinator.waitForWorkers(0)
+        Traceback (most recent call last):
+        ...
+        NameError: No mapReduceAgent connected to ... within 0 seconds. Check that the agents are running with the same --coordinatorAddress and DEEPTOOLS_AUTHKEY
+        >>> coordinator.close()
+        """
+        start = time.time()
+        warned = False
+        while True:
+            with self.lock:
+                if len(self.workers):
+                    return
+            if time.time() - start >= timeout:
+                raise NameError(
+                    "No mapReduceAgent connected to {}:{} within {} "
+                    "seconds. Check that the agents are running with the "
+                    "same --coordinatorAddress and DEEPTOOLS_AUTHKEY".format(
+                        self.address[0], self.address[1], timeout))
+            if not warned:
+                sys.stderr.write("waiting for mapReduceAgent programs to "
+                                 "connect to {}:{}\n".format(*self.address))
+                warned = True
+            time.sleep(0.5)
+
+    def apply_async(self, func, args, callback=None):
+        """
+        Queues func(*args) to be run by the next free worker.
+        The result is given to callback. Nothing is returned
+        because the failures also reach the callback.
+        """
+        self.tasks.put((func, args, callback))
+
+    def startedTasks(self):
+        started = []
+        while True:
+            try:
+                started.append(self.started.get_nowait())
+            except Queue.Empty:
+                return started
+
+    def aliveWorkers(self):
+        with self.lock:
+            return set(self.workers.keys())
+
+    def killWorker(self, name):
+        with self.lock:
+            if name not in self.workers:
+                return
+            conn, sendLock = self.workers[name]
+        try:
+            with sendLock:
+                conn.send(('kill',))
+        except (IOError, EOFError):
+            pass
+
+    def close(self):
+        """
+        Stops accepting workers. The connected workers are told
+        to stop, after which they connect again to wait for the
+        next coordinator.
+        """
+        self.closed = True
+        self.listener.close()
+        for thread in self.threads:
+            thread.join(2)
+
+    def acceptWorkers(self):
+        while not self.closed:
+            try:
+                conn = self.listener.accept()
+            except Exception as detail:
+                # wrong authkey, or the listener was closed
+                if debug:
+                    print "worker not accepted: {}".format(detail)
+                continue
+            thread = threading.Thread(target=self.serveWorker, args=(conn,))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def serveWorker(self, conn):
+        try:
+            name = conn.recv()
+        except (IOError, EOFError):
+            return
+        sendLock = threading.Lock()
+        with self.lock:
+            self.workers[name] = (conn, sendLock)
+        if debug:
+            print "worker {} connected".format(name)
+
+        contextFile = None
+        try:
+            while True:
+                try:
+                    task = self.tasks.get(timeout=1)
+                except Queue.Empty:
+                    if self.closed:
+                        break
+                    continue
+                func, args, callback = task
+                # (index, part, attempt, func, task, contextFile)
+                taskArgs = args[0]
+                if not os.path.exists(taskArgs[-1]):
+                    # left by a mapReduce call that ended with an error
+                    continue
+                try:
+                    with sendLock:
+                        if taskArgs[-1] != contextFile:
+                            contextFile = taskArgs[-1]
+                            conn.send(('context', contextFile,
+                                       open(contextFile, 'rb').read()))
+                        conn.send(('task', pickle.dumps(
+                            (func, args), pickle.HIGHEST_PROTOCOL)))
+                except (IOError, EOFError):
+                    # the task never reached the worker
+                    self.tasks.put(task)
+                    raise
+                self.started.put(tuple(taskArgs[:3]) + (name,))
+
+                reply = conn.recv()
+                if reply[0] == 'result':
+                    res = reply[1]
+                elif reply[0] == 'file':
+                    res = reply[1] + (writeTempFile(reply[2]),) + reply[3]
+                else:
+                    res = tuple(taskArgs[:3]) + (False, reply[1:], None)
+                if callback:
+                    callback(res)
+
+            with sendLock:
+                conn.send(('stop',))
+        except (IOError, EOFError):
+            pass
+        finally:
+            with self.lock:
+                self.workers.pop(name, None)
+            conn.close()
+            if debug:
+                print "worker {} disconnected".format(name)
+
+
+def runWorker(address, authkey):
+    """
+    Connects to the coordinator at address and runs the tasks
+    that it sends until the coordinator stops.
+    """
+    conn = Client(address, authkey=authkey)
+    conn.send("{}:{}".format(socket.gethostname(), os.getpid()))
+    messages = Queue.Queue()
+    receiver = threading.Thread(target=receiveMessages,
+                                args=(conn, messages))
+    receiver.daemon = True
+    receiver.start()
+
+    # the files may have changed since the previous coordinator
+    fileHandles.closeHandles()
+    while True:
+        message = messages.get()
+        if message[0] == 'stop':
+            break
+        elif message[0] == 'context':
+            mapReduce.setContext(message[1], message[2])
+        elif message[0] == 'task':
+            reply = runTask(message[1])
+            try:
+                conn.send(reply)
+            except (IOError, EOFError):
+                break
+            except Exception as error:
+                # the result can not be pickled
+                conn.send(('failed', picklableError(error),
+                           traceback.format_exc()))
+    conn.close()
+
+
+def receiveMessages(conn, messages):
+    """
+    Puts the messages of the coordinator in the messages queue,
+    except for the kill message, which is handled at once, even
+    if a task is running.
+    """
+    try:
+        while True:
+            message = conn.recv()
+            if message[0] == 'kill':
+                # the task is hung. The agent starts a new worker
+                os._exit(1)
+            messages.put(message)
+    except (IOError, EOFError):
+        messages.put(('stop',))
+
+
+def runTask(data):
+    """
+    Runs a task sent by the coordinator and returns the reply
+    for the coordinator.
+
+    >>> runTask(pickle.dumps((len, ('abc',))))
+    ('result', 3)
+    >>> runTask(pickle.dumps((len, (1,))))[:2]
+    ('failed', TypeError("object of type 'int' has no len()",))
+    """
+    try:
+        func, args = pickle.loads(data)
+        res = func(*args)
+    except Exception as error:
+        return ('failed', picklableError(error), traceback.format_exc())
+
+    # some tasks (correctGCBias writing a bam file) return the name of a
+    # temporary file, which other machines can not read. The content
+    # of the file is sent instead. The result of the tasks run by
+    # mapReduce is (index, part, attempt, success, result, measures).
+    if isinstance(res, tuple) and len(res) == 6 and res[3] and \
+            isTempFile(res[4]):
+        content = open(res[4], 'rb').read()
+        os.remove(res[4])
+        return ('file', res[:4], content, res[5:])
+    return ('result', res)
+
+
+def isTempFile(fileName):
+    """
+    >>> isTempFile(os.path.join(tempfile.gettempdir(), 'missing'))
+    False
+    >>> isTempFile(3)
+    False
+    """
+    if not isinstance(fileName, basestring) or \
+            not os.path.isfile(fileName):
+        return False
+    return os.path.dirname(os.path.abspath(fileName)) in \
+        ('/dev/shm', os.path.abspath(tempfile.gettempdir()))
+
+
+def writeTempFile(content):
+    """
+    Writes content into a new temporary file, whose name is returned.
+    """
+    # is /dev/shm available?
+    # working in this directory speeds the process
+    try:
+        _file = tempfile.NamedTemporaryFile(dir="/dev/shm", delete=False)
+    except OSError:
+        _file = tempfile.NamedTemporaryFile(delete=False)
+
+    _file.write(content)
+    _file.close()
+    return _file.name
+
+
+def picklableError(error):
+    try:
+        pickle.dumps(error)
+    except Exception:
+        error = Exception(str(error))
+    return error
+
+
+def runAgent(address, authkey, numberOfProcessors, verbose=False):
+    """
+    Keeps numberOfProcessors workers connected to the coordinator
+    at address. Dead workers are replaced. Once the coordinator
+    finishes, the workers wait for the next one, thus the agent
+    serves any number of runs until it is stopped.
+    """
+    if verbose:
+        print "agent with {} workers for {}:{}".format(
+            numberOfProcessors, address[0], address[1])
+    workers = []
+
+    def stopAgent(signum, frame):
+        for worker in workers:
+            worker.terminate()
+        sys.exit(0)
+    signal.signal(signal.SIGTERM, stopAgent)
+
+    while True:
+        workers[:] = [worker for worker in workers if worker.is_alive()]
+        while len(workers) < numberOfProcessors:
+            worker = multiprocessing.Process(
+                target=agentWorker,
+                args=(address, authkey, os.getpid(), verbose))
+            worker.start()
+            workers.append(worker)
+        time.sleep(1)
+
+
+def agentWorker(address, authkey, agentPid, verbose=False):
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    # the worker stops with its agent
+    while os.getppid() == agentPid:
+        try:
+            runWorker(address, authkey)
+        except multiprocessing.AuthenticationError:
+            print "the coordinator at {}:{} has another key".format(
+                address[0], address[1])
+            time.sleep(10)
+        except (IOError, EOFError):
+            # no coordinator is running
+            if verbose:
+                print "waiting for coordinator {}:{}".format(
+                    address[0], address[1])
+            time.sleep(2)
+
+
+def startLocalAgent(address, authkey, numberOfProcessors):
+    """
+    Starts an agent on this machine and returns its process. The
+    agent runs in a new interpreter, like the agents of other
+    machines, such that it does not inherit the coordinator socket.
+    """
+    env = dict(os.environ, DEEPTOOLS_AUTHKEY=authkey,
+               PYTHONPATH=os.pathsep.join(sys.path))
+    command = ("from deeptools import remoteExecutor\n"
+               "remoteExecutor.runAgent({!r}, remoteExecutor.getAuthKey(), "
+               "{})".format(tuple(address), numberOfProcessors))
+    return subprocess.Popen([sys.executable, '-c', command], env=env)
@@ -1,17 +1,34 @@
 import os
-import shutil
 import tempfile
+from collections import namedtuple
 import numpy as np
 
 # own modules
 import mapReduce
 from utilities import getCommonChrNames
-from countReadsPerBin import getCoverageOfRegion, getSmoothRange
-import config as cfg
+from countReadsPerBin import getCoverageCounts, getSmoothCoverage
 import bamHandler
+import bigWig
+import coverageIndex
+import fileHandles
 
 debug = 0
 
+# run of tiles having the same value, as returned by the workers.
+# decimals is the precision of the value in a bedgraph file
+BEDGRAPH_RUN = np.dtype([('start', '<i4'), ('end', '<i4'),
+                         ('value', '<f8'), ('decimals', 'u1')])
+
+# arguments of writeBedGraph_worker, by which the tasks are split
+# and merged (see splitBedGraphTask)
+BedGraphTask = namedtuple('BedGraphTask', [
+    'chrom', 'start', 'end', 'tileSize', 'defaultFragmentLength',
+    'bamFilesList', 'func', 'funcArgs', 'extendPairedEnds', 'smoothLength',
+    'zerosToNans', 'minMappingQuality', 'ignoreDuplicates',
+    'fragmentFromRead_func', 'wholeChromosome', 'blackListFileName'])
+BedGraphTask.__new__.__defaults__ = (True, 0, True, None, False, None,
+                                     False, None)
+
 
 def writeBedGraph_wrapper(args):
     return writeBedGraph_worker(*args)
@@ -22,184 +39,583 @@ def writeBedGraph_worker(chrom, start, end, tileSize, defaultFragmentLength,
                          smoothLength=0, zerosToNans=True,
                          minMappingQuality=None,
                          ignoreDuplicates=False,
-                         fragmentFromRead_func=None):
+                         fragmentFromRead_func=None, wholeChromosome=False,
+                         blackListFileName=None):
 
     r"""
-    Writes a bedgraph having as base a number of bam files.
+    Returns the runs (see getTileRuns) of a bedgraph having as
+    base a number of bam files.
 
     The given func is called to compute the desired bedgraph value
     using the funcArgs
 
+    If wholeChromosome is set, the tiles get the values that they
+    would have if the whole chromosome was processed at once, thus
+    the fragments of the reads before the chunk are counted (see
+    getTileValues). This is used for the short chunks covering a
+    list of regions.
+
+    The tiles overlapping the regions of the blackListFileName, a BED
+    file, are skipped.
+
     tileSize
     >>> test = Tester()
     >>> funcArgs = {'scaleFactor': 1.0}
-    >>> tempFile = writeBedGraph_worker( '3R', 0, 200, 50, 0,
+    >>> res = writeBedGraph_worker( '3R', 0, 200, 50, 0,
     ... [test.bamFile1], scaleCoverage, funcArgs, True, 0, False)
-    >>> open(tempFile, 'r').readlines()
+    >>> getBedGraphLines(*res).splitlines(True)
     ['3R\t0\t100\t0.00\n', '3R\t100\t200\t1.0\n']
-    >>> os.remove(tempFile)
 
     Test the file being writen for single end reads with
     no extension and no smoothing
-    >>> tempFile = writeBedGraph_worker( '3R', 0, 200, 50, 0,
+    >>> res = writeBedGraph_worker( '3R', 0, 200, 50, 0,
     ... [test.bamFile1], scaleCoverage, funcArgs)
-    >>> open(tempFile, 'r').readlines()
+    >>> getBedGraphLines(*res).splitlines(True)
     ['3R\t100\t200\t1.0\n']
-    >>> os.remove(tempFile)
 
     Test scaling
     >>> funcArgs = {'scaleFactor': 3.0}
-    >>> tempFile = writeBedGraph_worker( '3R', 0, 200, 50, 0,
+    >>> res = writeBedGraph_worker( '3R', 0, 200, 50, 0,
     ... [test.bamFile1], scaleCoverage, funcArgs)
-    >>> open(tempFile, 'r').readlines()
+    >>> getBedGraphLines(*res).splitlines(True)
     ['3R\t100\t200\t3.0\n']
-    >>> os.remove(tempFile)
 
     Test ignore duplicates
     >>> funcArgs = {'scaleFactor': 1.0}
-    >>> tempFile = writeBedGraph_worker( '3R', 0, 200, 50, 0,
+    >>> res = writeBedGraph_worker( '3R', 0, 200, 50, 0,
     ... [test.bamFile2], scaleCoverage, funcArgs, ignoreDuplicates=True)
-    >>> open(tempFile, 'r').readlines()
+    >>> getBedGraphLines(*res).splitlines(True)
     ['3R\t50\t200\t1.0\n']
-    >>> os.remove(tempFile)
 
     Test smoothing
     >>> funcArgs = {'scaleFactor': 1.0}
-    >>> tempFile = writeBedGraph_worker( '3R', 100, 200, 20, 0,
+    >>> res = writeBedGraph_worker( '3R', 100, 200, 20, 0,
     ... [test.bamFile2], scaleCoverage, funcArgs, smoothLength=60)
-    >>> open(tempFile, 'r').readlines()
+    >>> getBedGraphLines(*res).splitlines(True)
     ['3R\t100\t120\t1.00\n', '3R\t120\t140\t1.67\n', '3R\t140\t160\t2.00\n', '3R\t160\t180\t2.33\n', '3R\t180\t200\t2.0\n']
-    >>> os.remove(tempFile)
 
     Test ratio (needs two bam files)
     >>> funcArgs = {}
-    >>> tempFile = writeBedGraph_worker( '3R', 100, 200, 50, 0,
+    >>> res = writeBedGraph_worker( '3R', 100, 200, 50, 0,
     ... [test.bamFile1, test.bamFile2], ratio , funcArgs)
-    >>> open(tempFile, 'r').readlines()
+    >>> getBedGraphLines(*res).splitlines(True)
     ['3R\t100\t150\t1.00\n', '3R\t150\t200\t0.5\n']
-    >>> os.remove(tempFile)
+
+    With a list of funcArgs, the runs of each are returned
+    >>> res = writeBedGraph_worker( '3R', 0, 200, 50, 0,
+    ... [test.bamFile1], scaleCoverage, [{'scaleFactor': 1.0},
+    ... {'scaleFactor': 2.0}])
+    >>> [getBedGraphLines(*outputRes) for outputRes in res]
+    ['3R\t100\t200\t1.0\n', '3R\t100\t200\t2.0\n']
+
+    The read at 100-150, extended to 100 bp, is only counted
+    in the chunk after it if wholeChromosome is set
+    >>> funcArgs = {'scaleFactor': 1.0}
+    >>> res = writeBedGraph_worker( '3R', 150, 200, 50, 100,
+    ... [test.bamFile1], scaleCoverage, funcArgs)
+    >>> getBedGraphLines(*res).splitlines(True)
+    ['3R\t150\t200\t1.0\n']
+    >>> res = writeBedGraph_worker( '3R', 150, 200, 50, 100,
+    ... [test.bamFile1], scaleCoverage, funcArgs, wholeChromosome=True)
+    >>> getBedGraphLines(*res).splitlines(True)
+    ['3R\t150\t200\t2.0\n']
+
+    Test blacklist
+    >>> res = writeBedGraph_worker( '3R', 0, 200, 50, 0,
+    ... [test.bamFile2], scaleCoverage, funcArgs, True, 0, False,
+    ... blackListFileName=test.blackListFile)
+    >>> getBedGraphLines(*res).splitlines(True)
+    ['3R\t100\t150\t1.00\n', '3R\t150\t200\t2.0\n']
     """
     if start > end:
         raise NameError("start position ({0}) bigger "
                         "than end position ({1})".format(start, end))
 
-    coverage = []
+    chunkStart = chunkEnd = None
+    if wholeChromosome:
+        chunkStart, chunkEnd = 0, getChromLength(bamFilesList[0], chrom)
+
+    values = getTileValues(chrom, start, end, tileSize,
+                           defaultFragmentLength, bamFilesList, func,
+                           funcArgs, extendPairedEnds=extendPairedEnds,
+                           smoothLength=smoothLength,
+                           zerosToNans=zerosToNans,
+                           minMappingQuality=minMappingQuality,
+                           ignoreDuplicates=ignoreDuplicates,
+                           fragmentFromRead_func=fragmentFromRead_func,
+                           chunkStart=chunkStart, chunkEnd=chunkEnd,
+                           blackListFileName=blackListFileName)
+
+    if isinstance(funcArgs, list):
+        return [getTileRuns(chrom, start, end, tileSize, outputValues)
+                for outputValues in values]
+    return getTileRuns(chrom, start, end, tileSize, values)
+
+
+def tileValues_wrapper(args):
+    # the part of a task (see splitBedGraphTask) is followed by the
+    # arguments of the task that come after its region
+    chrom, start, end, chunkStart, chunkEnd = args[:5]
+    task = BedGraphTask(chrom, start, end, *args[5:])
+    # the wholeChromosome argument of the task is already
+    # taken into account by the chunkStart and chunkEnd
+    return getTileValues(chrom, start, end, task.tileSize,
+                         task.defaultFragmentLength, task.bamFilesList,
+                         task.func, task.funcArgs,
+                         extendPairedEnds=task.extendPairedEnds,
+                         smoothLength=task.smoothLength,
+                         zerosToNans=task.zerosToNans,
+                         minMappingQuality=task.minMappingQuality,
+                         ignoreDuplicates=task.ignoreDuplicates,
+                         fragmentFromRead_func=task.fragmentFromRead_func,
+                         chunkStart=chunkStart, chunkEnd=chunkEnd,
+                         blackListFileName=task.blackListFileName)
+
+
+def getTileValues(chrom, start, end, tileSize, defaultFragmentLength,
+                  bamFilesList, func, funcArgs, extendPairedEnds=True,
+                  smoothLength=0, zerosToNans=True,
+                  minMappingQuality=None, ignoreDuplicates=False,
+                  fragmentFromRead_func=None, chunkStart=None,
+                  chunkEnd=None, blackListFileName=None):
+    r"""
+    Returns an array with the value computed by func for each tile
+    of the region. The tiles that overlap the regions of the
+    blackListFileName have nan values.
+
+    The region can be a part of a larger genome chunk (given by
+    chunkStart and chunkEnd), in which case the values are the same
+    that would be obtained for the tiles of the region when processing
+    the whole chunk. For this, the region start has to be at a multiple
+    of tileSize from the chunk start. Only the reads close to the region
+    are fetched, which requires the fragments to be shorter than twice
+    the defaultFragmentLength (or 1000 bp if the length is not given).
+
+    >>> test = Tester()
+    >>> funcArgs = {'scaleFactor': 1.0}
+    >>> getTileValues('3R', 100, 200, 20, 0, [test.bamFile2],
+    ... scaleCoverage, funcArgs, smoothLength=60).tolist()
+    [1.0, 1.6666666666666667, 2.0, 2.3333333333333335, 2.0]
+    >>> getTileValues('3R', 120, 160, 20, 0, [test.bamFile2],
+    ... scaleCoverage, funcArgs, smoothLength=60,
+    ... chunkStart=100, chunkEnd=200).tolist()
+    [1.6666666666666667, 2.0]
+
+    The smoothing of the tiles at the edges of a chunk uses the tiles
+    of the neighboring chunks, thus it is the same for any chunk.
+    >>> getTileValues('3R', 120, 160, 20, 0, [test.bamFile2],
+    ... scaleCoverage, funcArgs, smoothLength=60).tolist()
+    [1.6666666666666667, 2.0]
+    """
+    if chunkStart is None:
+        chunkStart, chunkEnd = start, end
+
+    smoothTiles = smoothLength / tileSize + 1 if smoothLength > 0 else 0
+    if smoothTiles:
+        # the tiles next to the chunk are smoothed using the tiles of
+        # the neighboring chunks, thus the chunk is extended with them.
+        # Only the chromosome edges truncate the smooth range
+        chromLength = getChromLength(bamFilesList[0], chrom)
+        chunkStart -= min(smoothTiles, chunkStart / tileSize) * tileSize
+        chunkEnd = min(chunkEnd + smoothTiles * tileSize,
+                       max(chromLength, chunkEnd))
+
+    # indices of the tiles of the region within the chunk
+    lengthCoverage = (chunkEnd - chunkStart) / tileSize
+    firstTile = (start - chunkStart) / tileSize
+    lastTile = min((end - chunkStart) / tileSize, lengthCoverage)
+
+    coverageStart, coverageEnd = chunkStart, chunkEnd
+    if (chunkStart, chunkEnd) != (start, end):
+        # tiles that can contain reads whose fragments overlap the
+        # region. The margin before the region is doubled such
+        # that duplicated reads are detected as in the whole chunk
+        maxFragmentLength = 2 * defaultFragmentLength \
+            if defaultFragmentLength > 0 else 1000
+        marginTiles = int(np.ceil(float(maxFragmentLength) / tileSize))
+
+        firstCoverageTile = firstTile - smoothTiles - 2 * marginTiles
+        lastCoverageTile = lastTile + smoothTiles + marginTiles
+        if firstCoverageTile > 0:
+            coverageStart = chunkStart + firstCoverageTile * tileSize
+        if lastCoverageTile < lengthCoverage:
+            coverageEnd = chunkStart + lastCoverageTile * tileSize
+    offset = (coverageStart - chunkStart) / tileSize
+
+    blackList = None
+    masked = None
+    if blackListFileName:
+        blackList = fileHandles.getBlackList(blackListFileName)
+        tileStarts = chunkStart + np.arange(firstTile, lastTile) * tileSize
+        masked = blackList.maskBins(chrom, tileStarts, tileStarts + tileSize)
+
+    counts = []
     for bamFile in bamFilesList:
-        bamHandle = openBam(bamFile)
-        coverage.append(
-            getCoverageOfRegion(
-                bamHandle, chrom, start, end, tileSize,
-                defaultFragmentLength, extendPairedEnds, zerosToNans,
-                ignoreDuplicates=ignoreDuplicates,
-                fragmentFromRead_func=fragmentFromRead_func))
-        bamHandle.close()
-
-    # is /dev/shm available?
-    # working in this directory speeds the process
-    try:
-        _file = tempfile.NamedTemporaryFile(dir="/dev/shm",
-                                            suffix=".bg", delete=False)
-    except OSError:
-        _file = tempfile.NamedTemporaryFile(suffix=".bg", delete=False)
-
-    previousValue = None
-
-    lengthCoverage = len(coverage[0])
-    for tileIndex in xrange(lengthCoverage):
-
-        tileCoverage = []
-        for index in range(len(bamFilesList)):
-            if smoothLength > 0:
-                vectorStart, vectorEnd = getSmoothRange(
-                    tileIndex, tileSize, smoothLength, lengthCoverage)
-                tileCoverage.append(
-                    np.mean(coverage[index][vectorStart:vectorEnd]))
-            else:
-                tileCoverage.append(coverage[index][tileIndex])
-
-#        if  zerosToNans == True and sum(tileCoverage) == 0.0:
-#            continue
-
-        value = func(tileCoverage, funcArgs)
-        """
-        # uncomment this lines if fixed step bedgraph is wanted
-        if not  np.isnan(value):
-            writeStart = start + tileIndex*tileSize
-            writeEnd  =  min(writeStart+tileSize, end)
-            _file.write( "%s\t%d\t%d\t%.2f\n" % (chrom, writeStart,
-                                                 writeEnd, value) )
-        """
+        bamHandle = fileHandles.getBam(bamFile)
+        fileCounts, coverageMasked = getCoverageCounts(
+            bamHandle, chrom, coverageStart, coverageEnd, tileSize,
+            defaultFragmentLength, extendPairedEnds,
+            ignoreDuplicates=ignoreDuplicates,
+            fragmentFromRead_func=fragmentFromRead_func,
+            blackList=blackList)
+        counts.append(fileCounts)
+
+    # matrix with the counts of each file (rows) in each tile
+    tileCoverage = np.vstack(counts)
+    if smoothTiles:
+        # the smoothing averages the float coverage, including
+        # the nans of zerosToNans and of the blacklist
+        tileCounts = tileCoverage
+        tileCoverage = tileCounts.astype('float64')
+        if zerosToNans:
+            tileCoverage[tileCounts == 0] = np.nan
+        if coverageMasked is not None:
+            tileCoverage[:, coverageMasked] = np.nan
+        # the coverage ends either at the chunk ends or further than
+        # smoothTiles from the region
+        tileCoverage = getSmoothCoverage(tileCoverage, tileSize,
+                                         smoothLength)
+    tileCoverage = tileCoverage[:, firstTile - offset:lastTile - offset]
+
+    return getValues(func, tileCoverage, funcArgs, masked, zerosToNans)
+
+
+def getChromLength(bamFile, chrom):
+    bamHandle = fileHandles.getBam(bamFile)
+    return bamHandle.lengths[bamHandle.references.index(chrom)]
+
+
+def getValues(func, tileCoverage, funcArgs, masked=None, zerosToNans=False):
+    """
+    Returns an array with the value computed by func for each tile
+    (column) of the tileCoverage matrix, which has one row per file.
+    Functions having the attribute vectorized (like scaleCoverage)
+    receive the whole matrix and return the values of all the tiles
+    at once. Other functions are called for each tile with the list
+    of the file values. If funcArgs is a list, a list with the values
+    for each funcArgs is returned. The values of the tiles where the
+    boolean array masked is True are nan, whatever func returns.
+
+    The tileCoverage can also hold integer counts, which are only
+    converted to float here (see getFloatCoverage), with nan for the
+    zeros if zerosToNans.
+
+    >>> tileCoverage = np.array([[1.0, 2.0, 0.0], [2.0, 2.0, 4.0]])
+    >>> getValues(ratio, tileCoverage, {})
+    array([ 0.5,  1. ,  0. ])
+    >>> getValues(lambda x, args: x[0] + x[1], tileCoverage, {})
+    array([ 3.,  4.,  4.])
+    >>> getValues(scaleCoverage, tileCoverage, [{'scaleFactor': 1},
+    ... {'scaleFactor': 2}])
+    [array([ 1.,  2.,  0.]), array([ 2.,  4.,  0.])]
+    >>> getValues(ratio, tileCoverage, {}, np.array([False, True, False]))
+    array([ 0.5,  nan,  0. ])
+    >>> tileCounts = np.array([[0, 2, 0, 0, 0], [0, 1, 0, 0, 4]], 'uint16')
+    >>> getValues(lambda x, args: x[0] + x[1] + 1, tileCounts, {})
+    array([ 1.,  4.,  1.,  1.,  5.])
+    >>> getValues(scaleCoverage, tileCounts, {'scaleFactor': 2},
+    ... zerosToNans=True)
+    array([ nan,   4.,  nan,  nan,  nan])
+    """
+    tileCoverage, nonEmpty = getFloatCoverage(tileCoverage, zerosToNans)
+    if isinstance(funcArgs, list):
+        return [getFuncValues(func, tileCoverage, outputArgs, nonEmpty,
+                              masked)
+                for outputArgs in funcArgs]
+    return getFuncValues(func, tileCoverage, funcArgs, nonEmpty, masked)
 
-        if previousValue is None:
-            writeStart = start + tileIndex * tileSize
-            writeEnd = min(writeStart + tileSize, end)
-            previousValue = value
 
-        elif previousValue == value:
-            writeEnd = min(writeEnd + tileSize, end)
+def getFloatCoverage(tileCoverage, zerosToNans=False):
+    """
+    Returns the float coverage of a tileCoverage matrix of integer
+    counts, with nan for the zero counts if zerosToNans. If most of
+    the tiles (columns) have no counts in any file, as for sparse
+    data with small tiles, only the tiles with counts are converted,
+    followed by a single empty tile, and the boolean array of the
+    converted tiles is returned as well (None otherwise). Matrices
+    that are already float are returned as they are.
+
+    >>> getFloatCoverage(np.array([[0, 2, 0, 0], [0, 1, 0, 0]], 'uint16'),
+    ... zerosToNans=True)
+    (array([[  2.,  nan],
+           [  1.,  nan]]), array([False,  True, False, False], dtype=bool))
+    >>> getFloatCoverage(np.array([[1, 2, 0], [0, 1, 0]], 'uint16'))
+    (array([[ 1.,  2.,  0.],
+           [ 0.,  1.,  0.]]), None)
+    """
+    if not np.issubdtype(tileCoverage.dtype, np.integer):
+        return tileCoverage, None
+
+    nonEmpty = tileCoverage.any(axis=0)
+    numberOfNonEmpty = int(nonEmpty.sum())
+    if 2 * numberOfNonEmpty < len(nonEmpty):
+        tileCounts = np.zeros((tileCoverage.shape[0], numberOfNonEmpty + 1),
+                              dtype=tileCoverage.dtype)
+        tileCounts[:, :-1] = tileCoverage[:, nonEmpty]
+    else:
+        tileCounts = tileCoverage
+        nonEmpty = None
 
-        elif previousValue != value:
-            if not np.isnan(previousValue):
-                _file.write(
-                    "{}\t{}\t{}\t{:.2f}\n".format(chrom, writeStart,
-                                                  writeEnd, previousValue))
-            previousValue = value
-            writeStart = writeEnd
-            writeEnd = min(writeStart + tileSize, end)
+    coverage = tileCounts.astype('float64')
+    if zerosToNans:
+        coverage[tileCounts == 0] = np.nan
+    return coverage, nonEmpty
 
-    # write remaining value if not a nan
-    if previousValue and writeStart != end and not np.isnan(previousValue):
-        _file.write("%s\t%d\t%d\t%.1f\n" % (chrom, writeStart,
-                                            end, previousValue))
 
-    tempFileName = _file.name
-    _file.close()
-    return(tempFileName)
+def getFuncValues(func, tileCoverage, funcArgs, nonEmpty=None, masked=None):
+    """
+    Returns the values of func for the tiles of a float tileCoverage
+    (see getValues). If the tileCoverage only has the nonEmpty tiles
+    and an empty tile (see getFloatCoverage), the value of the empty
+    tile is given to all the other tiles. Thus, func has to compute
+    each tile independently of the others.
+    """
+    if getattr(func, 'vectorized', False):
+        values = np.array(func(tileCoverage, funcArgs), dtype='float64')
+    else:
+        values = np.array([func(list(tileCoverage[:, tileIndex]), funcArgs)
+                           for tileIndex in xrange(tileCoverage.shape[1])],
+                          dtype='float64')
+    if nonEmpty is not None:
+        nonEmptyValues = values
+        values = np.empty(len(nonEmpty))
+        values.fill(nonEmptyValues[-1])
+        values[nonEmpty] = nonEmptyValues[:-1]
+    if masked is not None:
+        values[masked] = np.nan
+    return values
+
+
+def getMappedReads(bamFile, defaultFragmentLength, extendPairedEnds=True,
+                   ignoreDuplicates=False, chrsToSkip=[]):
+    """
+    Returns the mapped reads of the bam file to normalize the values
+    of getTileValues. If the coverage of the bam file comes from a
+    coverage index, the reads of the bam files added to the index are
+    included (see coverageIndex.addToIndex).
 
+    >>> test = Tester()
+    >>> getMappedReads(test.bamFile1, 0)
+    2
+    """
+    bamHandle = fileHandles.getBam(bamFile)
+    # the same options used by getTileValues to get the coverage
+    options = coverageIndex.getIndexOptions(defaultFragmentLength,
+                                            extendPairedEnds,
+                                            ignoreDuplicates=ignoreDuplicates)
+    return coverageIndex.getMappedReads(bamHandle, options, chrsToSkip)
 
-def openBam(bamFile, bamIndex=None):
-    return bamHandler.openBam(bamFile, bamIndex)
 
+def getTileRuns(chrom, start, end, tileSize, values, fixedStep=False):
+    r"""
+    Returns, as (chrom, runs), the runs of consecutive tiles,
+    starting at start, that have the same value. Nan values are
+    skipped. The last run ends at end and is written with one
+    decimal, if its value is not zero. If fixedStep, each tile
+    is a run of its own, including the nan tiles.
+
+    >>> chrom, runs = getTileRuns('3R', 0, 110, 25,
+    ... [0.0, 0.0, np.nan, 1.5, 1.5])
+    >>> runs.tolist()
+    [(0, 50, 0.0, 2), (75, 110, 1.5, 1)]
+    >>> getBedGraphLines(chrom, runs)
+    '3R\t0\t50\t0.00\n3R\t75\t110\t1.5\n'
+    >>> getBedGraphLines(*getTileRuns('3R', 0, 100, 25,
+    ... [np.nan, np.nan, 2.0, 0.0]))
+    '3R\t50\t75\t2.00\n'
+    >>> getBedGraphLines(*getTileRuns('3R', 0, 60, 25,
+    ... [1.0, np.nan, 1.0], fixedStep=True))
+    '3R\t0\t25\t1.00\n3R\t25\t50\tnan\n3R\t50\t60\t1.00\n'
+    """
+    values = np.asarray(values, dtype='float64')
+    if fixedStep:
+        runStart = np.arange(len(values))
+    else:
+        # runs of equal values. Each nan is a run of its own
+        # as nan != nan, but those runs are not kept
+        isRunStart = np.ones(len(values), dtype='bool')
+        isRunStart[1:] = values[1:] != values[:-1]
+        runStart = np.flatnonzero(isRunStart)
+    runEnd = np.append(runStart[1:], len(values))
+
+    runs = np.zeros(len(runStart), dtype=BEDGRAPH_RUN)
+    runs['start'] = np.minimum(start + runStart * tileSize, end)
+    runs['end'] = np.minimum(start + runEnd * tileSize, end)
+    runs['value'] = values[runStart]
+    runs['decimals'] = 2
+    if fixedStep or len(runs) == 0:
+        return chrom, runs
+
+    keep = ~np.isnan(runs['value'])
+    keep[-1] &= runs['value'][-1] != 0 and runs['start'][-1] != end
+    runs['end'][-1] = end
+    runs['decimals'][-1] = 1
+    return chrom, runs[keep]
+
+
+def getBedGraphLines(chrom, runs):
+    """
+    Returns the bedgraph lines of the runs of chrom.
+    """
+    return "".join(["%s\t%d\t%d\t%.*f\n" % (chrom, runStart, runEnd,
+                                             decimals, value)
+                    for runStart, runEnd, value, decimals in runs.tolist()])
 
-def bedGraphToBigWig(chromSizes, bedGraphPath, bigWigPath, sort=True):
+
+def splitBedGraphTask(task, numberOfParts):
     """
-    takes a bedgraph file, orders it and converts it to
-    a bigwig file using command line tools.
+    Splits a writeBedGraph_worker task into parts, at multiples of
+    the tile size, that are processed by getTileValues. The static
+    arguments of the task are appended to the args of the parts by
+    mapReduce. Returns None if the chunk is too short to be split.
+    The parts of a wholeChromosome task are computed as parts of
+    their chromosome.
+
+    >>> task = ('chr1', 0, 100000, 50, 200, ['a.bam'], scaleCoverage, {})
+    >>> [args for partFunc, args in splitBedGraphTask(task, 2)]
+    [('chr1', 0, 50000, 0, 100000), ('chr1', 50000, 100000, 0, 100000)]
+    >>> splitBedGraphTask(('chr1', 0, 1000) + task[3:], 2)
+    """
+    task = BedGraphTask(*task)
+    start, end, tileSize = task.start, task.end, task.tileSize
+    # the parts have to be much longer than the margins
+    # that are added to them to compute the tile values
+    maxFragmentLength = 2 * task.defaultFragmentLength \
+        if task.defaultFragmentLength > 0 else 1000
+    minPartLength = 20 * max(maxFragmentLength, tileSize)
+    numberOfParts = min(numberOfParts, (end - start) / minPartLength)
+    if numberOfParts < 2:
+        return None
+
+    chunkStart, chunkEnd = start, end
+    if task.wholeChromosome:
+        chunkStart, chunkEnd = \
+            0, getChromLength(task.bamFilesList[0], task.chrom)
+
+    tiles = (end - start) / tileSize
+    boundaries = [start + tiles * part / numberOfParts * tileSize
+                  for part in range(numberOfParts)] + [end]
+    return [(tileValues_wrapper,
+             (task.chrom, boundaries[part], boundaries[part + 1],
+              chunkStart, chunkEnd))
+            for part in range(numberOfParts)]
+
+
+def splitSampleTask(task, numberOfParts):
+    """
+    Same as splitBedGraphTask, for the tasks of writeBedGraphs, that
+    carry their arguments instead of having them appended by mapReduce.
 
-    Will fail if the bedGraphToBigWig path changes.
+    >>> task = ('chr1', 0, 100000, 50, 200, ['a.bam'], scaleCoverage, {})
+    >>> splitSampleTask(task, 2)[1][1][:8]
+    ('chr1', 50000, 100000, 0, 100000, 50, 200, ['a.bam'])
     """
+    parts = splitBedGraphTask(task, numberOfParts)
+    if parts is None:
+        return None
+    return [(partFunc, partArgs + tuple(task[3:]))
+            for partFunc, partArgs in parts]
 
-    from tempfile import NamedTemporaryFile
-    from os import remove, system
 
-    # destination to save chromosome names and sizes
-    _file2 = NamedTemporaryFile(delete=False)
+def mergeBedGraphTask(task, partValues):
+    """
+    Returns the runs of the tile values of the parts of a split
+    writeBedGraph_worker task, identical to those of the worker.
+    """
+    task = BedGraphTask(*task)
+    if isinstance(task.funcArgs, list):
+        # the parts have the values of each output
+        return [getTileRuns(task.chrom, task.start, task.end, task.tileSize,
+                            np.concatenate([part[output]
+                                            for part in partValues]))
+                for output in range(len(task.funcArgs))]
+    return getTileRuns(task.chrom, task.start, task.end, task.tileSize,
+                       np.concatenate(partValues))
 
-    # bedGraph to bigwig requires the chromosome sizes to be
-    # saved into a file
-    for chrom, size in chromSizes:
-        _file2.write("{}\t{}\n".format(chrom, size))
-    _file2.close()
 
-    chrSizesFileName = _file2.name
+def openBam(bamFile, bamIndex=None):
+    return bamHandler.openBam(bamFile, bamIndex)
 
-    if sort:
-        sort_cmd = cfg.config.get('external_tools', 'sort')
-        # temporary file to store sorted bedgraph file
-        _file = NamedTemporaryFile(delete=False)
-        tempFileName1 = _file.name
-        system("{} -k1,1 -k2,2n {} > {}".format(sort_cmd,
-                                                bedGraphPath, tempFileName1))
-        bedGraphPath = tempFileName1
-
-    bedgraph_to_bigwig = cfg.config.get('external_tools', 'bedgraph_to_bigwig')
-    system("{} {} {} {}".format(bedgraph_to_bigwig,
-                                bedGraphPath, chrSizesFileName, bigWigPath))
 
+def bedGraphToBigWig(chromSizes, bedGraphPath, bigWigPath, sort=True):
+    """
+    takes a bedgraph file, orders it and converts it to
+    a bigwig file. Without sort, the lines of each chromosome
+    must be together and ordered by position.
+    """
+    bedGraph = open(bedGraphPath)
+    runs = bigWig.readBedGraph(bedGraph)
     if sort:
-        remove(tempFileName1)
+        # the runs of each chromosome are put together, in the
+        # order of chromSizes, and sorted by start
+        runsByChrom = {}
+        for run in runs:
+            runsByChrom.setdefault(run[0], []).append(run[1:])
+        runs = []
+        for chrom, size in chromSizes:
+            if chrom not in runsByChrom:
+                continue
+            starts, ends, values = [np.concatenate(x) for x in
+                                    zip(*runsByChrom.pop(chrom))]
+            order = np.argsort(starts, kind='mergesort')
+            runs.append((chrom, starts[order], ends[order], values[order]))
+
+    writer = bigWig.BigWigWriter(bigWigPath, chromSizes)
+    for chrom, starts, ends, values in runs:
+        writer.addRuns(chrom, starts, ends, values)
+    writer.close()
+    bedGraph.close()
+
+
+class RunsWriter(object):
+    """
+    Writes the runs (see getTileRuns) of the chromosomes, in genome
+    order, to a bedgraph or bigwig file. The bedgraph is written next
+    to outputFileName and renamed once closed.
+    """
+
+    def __init__(self, outputFileName, chromSizes, format="bedgraph"):
+        self.outputFileName = outputFileName
+        self.format = format
+        if format == 'bedgraph':
+            self.outFile = open(outputFileName + ".bg", 'wb')
+        else:
+            self.outFile = bigWig.BigWigWriter(outputFileName, chromSizes)
+
+    def addRuns(self, chrom, runs):
+        if self.format == 'bedgraph':
+            self.outFile.write(getBedGraphLines(chrom, runs))
+        else:
+            self.outFile.addRuns(chrom, runs['start'], runs['end'],
+                                 runs['value'])
+
+    def close(self):
+        self.outFile.close()
+        if self.format == 'bedgraph':
+            os.rename(self.outFile.name, self.outputFileName)
+        if debug:
+            print "output file: %s" % (self.outputFileName)
+
+
+def writeRuns(results, outputFileName, chromSizes, format="bedgraph"):
+    """
+    Writes the (chrom, runs) returned by the workers, in genome
+    order, to a bedgraph or bigwig output file as soon as they
+    are produced. If outputFileName is a list, each result is a
+    list with the (chrom, runs) of each output file.
+    """
+    multipleOutputs = isinstance(outputFileName, list)
+    outputFileNames = outputFileName if multipleOutputs else [outputFileName]
+    writers = [RunsWriter(fileName, chromSizes, format)
+               for fileName in outputFileNames]
+    for res in results:
+        if not multipleOutputs:
+            res = [res]
+        for writer, (chrom, runs) in zip(writers, res):
+            writer.addRuns(chrom, runs)
 
-    remove(chrSizesFileName)
+    for writer in writers:
+        writer.close()
 
 
 def getGenomeChunkLength(bamHandlers, tileSize):
@@ -230,7 +646,8 @@ def writeBedGraph(bamFilesList, outputFileName, fragmentLength,
                   numberOfProcessors=None, format="bedgraph",
                   extendPairedEnds=True, zerosToNans=True, smoothLength=0,
                   minMappingQuality=None, ignoreDuplicates=False,
-                  fragmentFromRead_func=None):
+                  fragmentFromRead_func=None, checkpointDir=None,
+                  regions=None, blackListFileName=None):
 
     r"""
     Given a list of bamfiles, a function and a function arguments,
@@ -239,6 +656,19 @@ def writeBedGraph(bamFilesList, outputFileName, fragmentLength,
     and a value for each tile that corresponds to the given function
     and that is related to the coverage underlying the tile.
 
+    To write several outputs from a single pass over the bam files,
+    outputFileName and funcArgs can be lists of the same length: an
+    output file is written with func and each funcArgs.
+
+    If a checkpointDir is given, the runs of each genome chunk
+    are kept in that directory and is reused when writeBedGraph
+    is called again with the same files and parameters.
+
+    If regions, a list of (chrom, start, end) intervals, are given,
+    only the tiles overlapping them are processed and written
+    (see mapReduce.getRegionChunks). The tiles overlapping the regions
+    of the blackListFileName, a BED file, are not written.
+
     >>> test = Tester()
     >>> outFile = tempfile.NamedTemporaryFile()
     >>> funcArgs = {'scaleFactor': 1.0}
@@ -246,9 +676,24 @@ def writeBedGraph(bamFilesList, outputFileName, fragmentLength,
     ... 0, scaleCoverage, funcArgs, region='3R:0:200')
     >>> open(outFile.name, 'r').readlines()
     ['3R\t100\t200\t1.0\n']
+    >>> outFile2 = tempfile.NamedTemporaryFile()
+    >>> writeBedGraph( [test.bamFile1], [outFile.name, outFile2.name],
+    ... 0, scaleCoverage, [funcArgs, {'scaleFactor': 0.5}],
+    ... region='3R:0:200')
+    >>> open(outFile2.name, 'r').readlines()
+    ['3R\t100\t200\t0.5\n']
+    >>> writeBedGraph( [test.bamFile2], outFile.name,
+    ... 0, scaleCoverage, funcArgs, regions=[('3R', 60, 80)])
+    >>> open(outFile.name, 'r').readlines()
+    ['3R\t50\t100\t1.0\n']
     >>> outFile.close()
+    >>> outFile2.close()
 
     """
+    if isinstance(outputFileName, list) and \
+            (not isinstance(funcArgs, list) or
+             len(outputFileName) != len(funcArgs)):
+        raise NameError("one funcArgs is needed for each output file")
     bamHandlers = [openBam(x) for x in bamFilesList]
     genomeChunkLength = getGenomeChunkLength(bamHandlers, tileSize)
     # check if both bam files correspond to the same species
@@ -259,52 +704,130 @@ def writeBedGraph(bamFilesList, outputFileName, fragmentLength,
         # in case a region is used, append the tilesize
         region += ":{}".format(tileSize)
 
-    res = mapReduce.mapReduce((tileSize, fragmentLength, bamFilesList,
-                               func, funcArgs, extendPairedEnds, smoothLength,
-                               zerosToNans, minMappingQuality,
-                               ignoreDuplicates,
-                               fragmentFromRead_func),
-                              writeBedGraph_wrapper,
-                              chromNamesAndSize,
-                              genomeChunkLength=genomeChunkLength,
-                              region=region,
-                              numberOfProcessors=numberOfProcessors)
-
-    # concatenate intermediary bedgraph files
-    outFile = open(outputFileName + ".bg", 'wb')
-    for tempFileName in res:
-        if tempFileName:
-            # concatenate all intermediate tempfiles into one
-            # bedgraph file
-            shutil.copyfileobj(open(tempFileName, 'rb'), outFile)
-            os.remove(tempFileName)
-
-    bedGraphFile = outFile.name
-    outFile.close()
-    if format == 'bedgraph':
-        os.rename(bedGraphFile, outputFileName)
-        if debug:
-            print "output file: %s" % (outputFileName)
-    else:
-        bedGraphToBigWig(
-            chromNamesAndSize, bedGraphFile, outputFileName, False)
-        if debug:
-            print "output file: %s" % (outputFileName)
-        os.remove(bedGraphFile)
+    res = mapReduce.imapReduce((tileSize, fragmentLength, bamFilesList,
+                                func, funcArgs, extendPairedEnds, smoothLength,
+                                zerosToNans, minMappingQuality,
+                                ignoreDuplicates,
+                                fragmentFromRead_func, regions is not None,
+                                blackListFileName),
+                               writeBedGraph_wrapper,
+                               chromNamesAndSize,
+                               genomeChunkLength=genomeChunkLength,
+                               region=region,
+                               regions=regions,
+                               blackListFileName=blackListFileName,
+                               numberOfProcessors=numberOfProcessors,
+                               bamFilesList=bamFilesList,
+                               tileSize=tileSize,
+                               splitTask=splitBedGraphTask,
+                               mergeResults=mergeBedGraphTask,
+                               checkpointDir=checkpointDir)
+
+    writeRuns(res, outputFileName, chromNamesAndSize, format)
+
+
+def writeBedGraphs(samples, fragmentLength, func, tileSize=25,
+                   region=None, numberOfProcessors=None, format="bedgraph",
+                   extendPairedEnds=True, zerosToNans=True, smoothLength=0,
+                   minMappingQuality=None, ignoreDuplicates=False,
+                   fragmentFromRead_func=None, checkpointDir=None,
+                   verbose=False, regions=None, blackListFileName=None):
+    r"""
+    Same as writeBedGraph for each of the samples, given as
+    (bamFilesList, outputFileName, funcArgs), but the genome chunks
+    of all the samples are processed by the same pool of workers.
+    The chunks of the samples are interleaved, such that the output
+    files are written as the chunks finish and the workers stay busy
+    until the last chunk of the last sample.
+
+    >>> test = Tester()
+    >>> outFile1 = tempfile.NamedTemporaryFile()
+    >>> outFile2 = tempfile.NamedTemporaryFile()
+    >>> writeBedGraphs([([test.bamFile1], outFile1.name,
+    ... {'scaleFactor': 1.0}), ([test.bamFile2], outFile2.name,
+    ... {'scaleFactor': 2.0})], 0, scaleCoverage, region='3R:0:200')
+    >>> open(outFile1.name, 'r').readlines()
+    ['3R\t100\t200\t1.0\n']
+    >>> open(outFile2.name, 'r').readlines()
+    ['3R\t50\t150\t2.00\n', '3R\t150\t200\t4.0\n']
+    >>> outFile1.close()
+    >>> outFile2.close()
+    """
+    if region:
+        # in case a region is used, append the tilesize
+        region += ":{}".format(tileSize)
+
+    # tasks and costs of each sample
+    sampleTasks = []
+    writers = []
+    for bamFilesList, outputFileName, funcArgs in samples:
+        bamHandlers = [openBam(x) for x in bamFilesList]
+        genomeChunkLength = getGenomeChunkLength(bamHandlers, tileSize)
+        chromNamesAndSize = getCommonChrNames(bamHandlers, verbose=False)
+        density = None
+        if not region:
+            density = mapReduce.getDensity(chromNamesAndSize, bamFilesList)
+        chunks = mapReduce.getTasks((), chromNamesAndSize,
+                                    genomeChunkLength=genomeChunkLength,
+                                    region=region, regions=regions,
+                                    blackListFileName=blackListFileName,
+                                    bamFilesList=bamFilesList,
+                                    tileSize=tileSize,
+                                    density=density, verbose=verbose)
+        if density is not None:
+            costs = mapReduce.getChunkReads(chunks, density)
+        else:
+            costs = [end - start for chrom, start, end in chunks]
+        taskArgs = (tileSize, fragmentLength, bamFilesList, func, funcArgs,
+                    extendPairedEnds, smoothLength, zerosToNans,
+                    minMappingQuality, ignoreDuplicates,
+                    fragmentFromRead_func, regions is not None,
+                    blackListFileName)
+        sampleTasks.append([(chunk + taskArgs, cost)
+                            for chunk, cost in zip(chunks, costs)])
+        writers.append(RunsWriter(outputFileName, chromNamesAndSize,
+                                  format))
+
+    # the chunks are taken in turn from each sample
+    TASKS = []
+    costs = []
+    owners = []
+    for turn in range(max([len(tasks) for tasks in sampleTasks] + [0])):
+        for sample, tasks in enumerate(sampleTasks):
+            if turn < len(tasks):
+                TASKS.append(tasks[turn][0])
+                costs.append(tasks[turn][1])
+                owners.append(sample)
+
+    res = mapReduce.runTasks(writeBedGraph_wrapper, TASKS,
+                             numberOfProcessors, costs=costs,
+                             splitTask=splitSampleTask,
+                             mergeResults=mergeBedGraphTask,
+                             checkpointDir=checkpointDir, verbose=verbose)
+    for index, (chrom, runs) in enumerate(res):
+        writers[owners[index]].addRuns(chrom, runs)
+
+    for writer in writers:
+        writer.close()
 
 
 def scaleCoverage(tileCoverage, args):
     """
-    tileCoverage should be an list with only one element
+    tileCoverage should be a matrix with only one row
+
+    >>> scaleCoverage(np.array([[1.0, np.nan, 2.0]]), {'scaleFactor': 2})
+    array([  2.,  nan,   4.])
     """
     return args['scaleFactor'] * tileCoverage[0]
+scaleCoverage.vectorized = True
 
 
 def ratio(tileCoverage, args):
     """
-    tileCoverage should be an list of two elements
+    tileCoverage should be a matrix of two rows
     """
-    return float(tileCoverage[0]) / tileCoverage[1]
+    return np.asarray(tileCoverage[0], dtype='float64') / tileCoverage[1]
+ratio.vectorized = True
 
 
 class Tester():
@@ -328,6 +851,7 @@ class Tester():
         self.bamFile1  = self.root + "testA.bam"
         self.bamFile2  = self.root + "testB.bam"
         self.bamFile_PE  = self.root + "test_paired2.bam"
+        self.blackListFile = self.root + "test_blacklist.bed"
         self.chrom = '3R'
         global debug
         debug = 0
@@ -2,7 +2,6 @@
 #-*- coding: utf-8 -*-
 
 import os
-import shutil
 import tempfile
 import numpy as np
 
@@ -11,18 +10,21 @@ from bx.bbi.bigwig_file import BigWigFile
 
 # own module
 import mapReduce
+import fileHandles
+import bigWig
 from utilities import getCommonChrNames
+from countReadsPerBin import getCoverageOfRegion
 from writeBedGraph import *
-import config as cfg
 
 
 def getCoverageFromBam(bamHandle, chrom, start, end, tileSize,
                        defaultFragmentLength, extendPairedEnds=True,
-                       zerosToNans=True):
+                       zerosToNans=True, blackList=None):
     return getCoverageOfRegion(bamHandle, chrom, start, end, tileSize,
                                defaultFragmentLength,
                                extendPairedEnds=extendPairedEnds,
-                               zerosToNans=zerosToNans)
+                               zerosToNans=zerosToNans,
+                               blackList=blackList)
 
 
 def getCoverageFromBigwig(bigwigHandle, chrom, start, end, tileSize,
@@ -52,158 +54,119 @@ def writeBedGraph_wrapper(args):
 def writeBedGraph_worker(
         chrom, start, end, tileSize, defaultFragmentLength,
         bamOrBwFileList, func, funcArgs, extendPairedEnds=True, smoothLength=0,
-        zerosToNans=True, fixed_step=False):
+        zerosToNans=True, fixed_step=False, blackListFileName=None):
 
     r"""
-    Writes a bedgraph having as base a number of bam files.
+    Returns the runs (see getTileRuns) of a bedgraph having as
+    base a number of bam files.
 
     The given func is called to compute the desired bedgraph value
     using the funcArgs
 
+    The tiles overlapping the regions of the blackListFileName, a BED
+    file, are skipped.
+
     tileSize
     >>> test = Tester()
     >>> funcArgs = {'scaleFactor': 1.0}
-    >>> tempFile = writeBedGraph_worker(
+    >>> res = writeBedGraph_worker(
     ... '3R', 0, 200, 50, 0, [(test.bamFile1,'bam')],
     ... scaleCoverage, funcArgs, True, 0, False)
-    >>> open(tempFile, 'r').readlines()
+    >>> getBedGraphLines(*res).splitlines(True)
     ['3R\t0\t100\t0.00\n', '3R\t100\t200\t1.0\n']
-    >>> os.remove(tempFile)
 
     Test the file being writen for single end reads with no
     extension and no smoothing
-    >>> tempFile = writeBedGraph_worker(
+    >>> res = writeBedGraph_worker(
     ... '3R', 0, 200, 50, 0, [(test.bamFile1,'bam')],
     ... scaleCoverage, funcArgs)
-    >>> open(tempFile, 'r').readlines()
+    >>> getBedGraphLines(*res).splitlines(True)
     ['3R\t100\t200\t1.0\n']
-    >>> os.remove(tempFile)
 
     Test scaling
     >>> funcArgs = {'scaleFactor': 3.0}
-    >>> tempFile = writeBedGraph_worker(
+    >>> res = writeBedGraph_worker(
     ... '3R', 0, 200, 50, 0, [(test.bamFile1,'bam')],
     ... scaleCoverage, funcArgs)
-    >>> open(tempFile, 'r').readlines()
+    >>> getBedGraphLines(*res).splitlines(True)
     ['3R\t100\t200\t3.0\n']
-    >>> os.remove(tempFile)
 
     Test smoothing
     >>> funcArgs = {'scaleFactor': 1.0}
-    >>> tempFile = writeBedGraph_worker(
+    >>> res = writeBedGraph_worker(
     ... '3R', 100, 200, 20, 0, [(test.bamFile2,'bam')],
     ... scaleCoverage, funcArgs, smoothLength=60)
-    >>> open(tempFile, 'r').readlines()
+    >>> getBedGraphLines(*res).splitlines(True)
     ['3R\t100\t120\t1.00\n', '3R\t120\t140\t1.67\n', '3R\t140\t160\t2.00\n', '3R\t160\t180\t2.33\n', '3R\t180\t200\t2.0\n']
-    >>> os.remove(tempFile)
 
     Test ratio (needs two bam files)
     >>> funcArgs = {}
-    >>> tempFile = writeBedGraph_worker(
+    >>> res = writeBedGraph_worker(
     ... '3R', 100, 200, 50, 0, [(test.bamFile1, 'bam'),
     ... (test.bamFile2, 'bam')], ratio , funcArgs)
-    >>> open(tempFile, 'r').readlines()
+    >>> getBedGraphLines(*res).splitlines(True)
     ['3R\t100\t150\t1.00\n', '3R\t150\t200\t0.5\n']
-    >>> os.remove(tempFile)
     """
     if start > end:
         raise NameError("start position ({0}) bigger than "
                         "end position ({1})".format(start, end))
 
+    blackList = None
+    if blackListFileName:
+        blackList = fileHandles.getBlackList(blackListFileName)
+
     coverage = []
 
     for indexFile, fileFormat in bamOrBwFileList:
         if fileFormat == 'bam':
-            bamHandle = openBam(indexFile)
+            bamHandle = fileHandles.getBam(indexFile)
             coverage.append(getCoverageFromBam(
                 bamHandle, chrom, start, end, tileSize,
-                defaultFragmentLength, extendPairedEnds, zerosToNans))
-            bamHandle.close()
+                defaultFragmentLength, extendPairedEnds, zerosToNans,
+                blackList))
         elif fileFormat == 'bigwig':
-            fileHandle = open(indexFile, 'r')
-            bigwigHandle = BigWigFile(file=fileHandle)
+            bigwigHandle = fileHandles.getBigWig(indexFile)
             coverage.append(
                 getCoverageFromBigwig(
                     bigwigHandle, chrom, start, end, tileSize, zerosToNans))
-            fileHandle.close()
-
-    # is /dev/shm available?
-    # working in this directory speeds the process
-    try:
-        _file = tempfile.NamedTemporaryFile(dir="/dev/shm", delete=False)
-    except OSError:
-        _file = tempfile.NamedTemporaryFile(delete=False)
 
-    previousValue = None
+    # matrix with the coverage of each file (rows) in each tile
     lengthCoverage = len(coverage[0])
-    for tileIndex in xrange(lengthCoverage):
-
-        tileCoverage = []
-        for index in range(len(bamOrBwFileList)):
-            if smoothLength > 0:
-                vectorStart, vectorEnd = getSmoothRange(
-                    tileIndex, tileSize, smoothLength, lengthCoverage)
-                tileCoverage.append(
-                    np.mean(coverage[index][vectorStart:vectorEnd]))
-            else:
-                try:
-                    tileCoverage.append(coverage[index][tileIndex])
-                except IndexError:
-                    print "Chromosome {} probably not in one of the bigwig " \
-                        "files. Remove this chromosome from the bigwig file " \
-                        "to continue".format(chrom)
-                    exit(0)
-
-#        if  zerosToNans == True and sum(tileCoverage) == 0.0:
-#            continue
-
-        value = func(tileCoverage, funcArgs)
-
-        if fixed_step:
-            writeStart = start + tileIndex*tileSize
-            writeEnd = min(writeStart + tileSize, end)
-            try:
-                _file.write("%s\t%d\t%d\t%.2f\n" % (chrom, writeStart,
-                                                    writeEnd, value))
-            except TypeError:
-                _file.write("{}\t{}\t{}\t{}\n".format(chrom, writeStart,
-                                                      writeEnd, value))
-        else:
-            if previousValue is None:
-                writeStart = start + tileIndex*tileSize
-                writeEnd = min(writeStart + tileSize, end)
-                previousValue = value
-
-            elif previousValue == value:
-                writeEnd = min(writeEnd + tileSize, end)
-
-            elif previousValue != value:
-                if not np.isnan(previousValue):
-                    _file.write(
-                        "%s\t%d\t%d\t%.2f\n" % (chrom, writeStart,
-                                                writeEnd, previousValue))
-                previousValue = value
-                writeStart = writeEnd
-                writeEnd = min(writeStart + tileSize, end)
-
-    if not fixed_step:
-        # write remaining value if not a nan
-        if previousValue and writeStart != end and \
-                not np.isnan(previousValue):
-            _file.write("%s\t%d\t%d\t%.1f\n" % (chrom, writeStart,
-                                                end, previousValue))
-
-#        """
-    tempFileName = _file.name
-    _file.close()
-    return(tempFileName)
+    if smoothLength > 0:
+        tileCoverage = getSmoothCoverage(
+            np.array(coverage).reshape(len(coverage), -1), tileSize,
+            smoothLength)
+    else:
+        if min([len(fileCoverage) for fileCoverage in coverage]) < \
+                lengthCoverage:
+            print "Chromosome {} probably not in one of the bigwig " \
+                "files. Remove this chromosome from the bigwig file " \
+                "to continue".format(chrom)
+            exit(0)
+        tileCoverage = np.array(
+            [fileCoverage[:lengthCoverage]
+             for fileCoverage in coverage]).reshape(len(coverage), -1)
+
+    masked = None
+    if blackList is not None:
+        tileStarts = start + np.arange(tileCoverage.shape[1]) * tileSize
+        masked = blackList.maskBins(chrom, tileStarts, tileStarts + tileSize)
+
+    values = getValues(func, tileCoverage, funcArgs, masked)
+    if isinstance(funcArgs, list):
+        return [getTileRuns(chrom, start, end, tileSize, outputValues,
+                            fixedStep=fixed_step)
+                for outputValues in values]
+    return getTileRuns(chrom, start, end, tileSize, values,
+                       fixedStep=fixed_step)
 
 
 def writeBedGraph(
         bamOrBwFileList, outputFileName, fragmentLength,
         func, funcArgs, tileSize=25, region=None, numberOfProcessors=None,
         format="bedgraph", extendPairedEnds=True, zerosToNans=True,
-        smoothLength=0, fixed_step=False):
+        smoothLength=0, fixed_step=False, checkpointDir=None,
+        regions=None, blackListFileName=None):
 
     r"""
     Given a list of bamfiles, a function and a function arguments,
@@ -221,10 +184,16 @@ def writeBedGraph(
     ['3R\t100\t200\t1.0\n']
     >>> outFile.close()
 
-
+    As for writeBedGraph.writeBedGraph, outputFileName and funcArgs
+    can be lists, to write one output file for each funcArgs, the
+    output can be restricted to a list of regions and the tiles
+    overlapping the regions of the blackListFileName are skipped.
     """
+    if isinstance(outputFileName, list) and \
+            (not isinstance(funcArgs, list) or
+             len(outputFileName) != len(funcArgs)):
+        raise NameError("one funcArgs is needed for each output file")
 
-    bigwig_info = cfg.config.get('external_tools', 'bigwig_info')
     bamHandlers = [openBam(indexedFile) for
                    indexedFile,
                    fileFormat in bamOrBwFileList if fileFormat == 'bam']
@@ -240,72 +209,46 @@ def writeBedGraph(
         cCommon = []
         chromNamesAndSize = {}
         for bw in bigwigs:
-            inBlock = False
-            for line in os.popen(
-                    "{} -chroms {}".format(bigwig_info, bw)).readlines():
-
-                if line[0:10] == "chromCount":
-                    inBlock = True
-                    continue
-
-                if line[0:5] == "bases":
-                    break
-                if inBlock:
-                    chromName, id, size = line.strip().split(" ")
-                    size = int(size)
-                    if chromName in chromNamesAndSize:
-                        cCommon.append(chromName)
-                        if chromNamesAndSize[chromName] != size:
-                            print "\nWARNING\n" \
-                                "Chromosome {} length reported in the " \
-                                "bigwig files differ.\n{} for {}\n" \
-                                "{} for {}.\n\nThe smallest " \
-                                "length will be used".format(
-                                chromName, chromNamesAndSize[chromName],
-                                bigwigs[0], size, bigwigs[1])
-                            chromNamesAndSize[chromName] = min(
-                                chromNamesAndSize[chromName], size)
-                    else:
-                        chromNamesAndSize[chromName] = size
-
-        # get the list of common chromosome names and sizes
-        chromNamesAndSize = [(k, v) for k, v in chromNamesAndSize.iteritems()
+            for chromName, size in bigWig.getChromSizes(bw):
+                if chromName in chromNamesAndSize:
+                    cCommon.append(chromName)
+                    if chromNamesAndSize[chromName] != size:
+                        print "\nWARNING\n" \
+                            "Chromosome {} length reported in the " \
+                            "bigwig files differ.\n{} for {}\n" \
+                            "{} for {}.\n\nThe smallest " \
+                            "length will be used".format(
+                            chromName, chromNamesAndSize[chromName],
+                            bigwigs[0], size, bw)
+                        chromNamesAndSize[chromName] = min(
+                            chromNamesAndSize[chromName], size)
+                else:
+                    chromNamesAndSize[chromName] = size
+
+        # get the list of common chromosome names and sizes, in the
+        # order of the first bigwig file
+        chromNamesAndSize = [(k, chromNamesAndSize[k]) for k, v in
+                             bigWig.getChromSizes(bigwigs[0])
                              if k in cCommon]
 
     if region:
         # in case a region is used, append the tilesize
         region += ":{}".format(tileSize)
 
-    res = mapReduce.mapReduce((tileSize, fragmentLength, bamOrBwFileList,
-                               func, funcArgs, extendPairedEnds, smoothLength,
-                               zerosToNans, fixed_step),
-                              writeBedGraph_wrapper,
-                              chromNamesAndSize,
-                              genomeChunkLength=genomeChunkLength,
-                              region=region,
-                              numberOfProcessors=numberOfProcessors)
-
-    # concatenate intermediary bedgraph files
-    outFile = open(outputFileName + ".bg", 'wb')
-    for tempFileName in res:
-        if tempFileName:
-            # concatenate all intermediate tempfiles into one
-            # bedgraph file
-            shutil.copyfileobj(open(tempFileName, 'rb'), outFile)
-            os.remove(tempFileName)
-
-    bedGraphFile = outFile.name
-    outFile.close()
-    if format == 'bedgraph':
-        os.rename(bedGraphFile, outputFileName)
-        if debug:
-            print "output file: %s" % (outputFileName)
-    else:
-        bedGraphToBigWig(
-            chromNamesAndSize, bedGraphFile, outputFileName, False)
-        if debug:
-            print "output file: %s" % (outputFileName)
-        os.remove(bedGraphFile)
+    res = mapReduce.imapReduce((tileSize, fragmentLength, bamOrBwFileList,
+                                func, funcArgs, extendPairedEnds, smoothLength,
+                                zerosToNans, fixed_step, blackListFileName),
+                               writeBedGraph_wrapper,
+                               chromNamesAndSize,
+                               genomeChunkLength=genomeChunkLength,
+                               region=region,
+                               regions=regions,
+                               blackListFileName=blackListFileName,
+                               tileSize=tileSize,
+                               numberOfProcessors=numberOfProcessors,
+                               checkpointDir=checkpointDir)
+
+    writeRuns(res, outputFileName, chromNamesAndSize, format)
 
 
 class Tester():
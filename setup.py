@@ -10,7 +10,8 @@ setup(
              'bin/heatmapper', 'bin/bamFingerprint', 'bin/estimateScaleFactor',
              'bin/PE_fragment_size', 'bin/computeMatrix', 'bin/profiler',
              'bin/computeMatrix', 'bin/computeGCBias', 'bin/correctGCBias',
-             'bin/bigwigCompare'],
+             'bin/bigwigCompare', 'bin/mapReduceAgent',
+             'bin/computeCoverageIndex'],
     include_package_data = True,
 #    data_files=[('config', ['config/deepTools.cfg']),
 #                ('galaxy', ['galaxy/bamCompare.xml','galaxy/bamCoverage.xml',